@@ -1,6 +1,12 @@
 from common import database
 from common import TaskQueues, get_object_store
+from common.filecache import get_file_cache
+from common.logwriter import BufferedLogWriter, notify
+from common import process
+from common.docker import DockerClient
 from common.utils import setup_logging, shell_escape
+from common.workers import WorkerPool
+import functools
 import json
 import logging
 import os
@@ -10,38 +16,25 @@ import tempfile
 
 
 SQLSession = None
-object_store = None
+docker_client = None
 
 
 # IP as understood by Docker daemon, not this container
 DOCKER_REGISTRY = os.environ.get('REGISTRY', 'localhost:5000')
 
 
-def run_cmd_and_log(session, experiment_hash, cmd):
-    session.add(database.BuildLogLine(
-        experiment_hash=experiment_hash,
-        line=' '.join(cmd)))
-    session.commit()
-    proc = subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    proc.stdin.close()
+def run_cmd_and_log(log, cmd):
+    log.write(' '.join(cmd))
     try:
-        for line in iter(proc.stdout.readline, ''):
-            logging.info("> %s", line)
-            session.add(database.BuildLogLine(
-                experiment_hash=experiment_hash,
-                line=line.rstrip()))
-            session.commit()
-        ret = proc.wait()
-        if ret != 0:
-            return "Process returned %d" % proc.returncode
+        ret = process.run_cmd_and_log(log, cmd)
     except IOError:
         return "Got IOError"
+    if ret != 0:
+        return "Process returned %d" % ret
 
 
-def build_request(channel, method, _properties, body):
+def build_request(object_store, file_cache, channel, method, _properties,
+                  body):
     """Process a build task.
 
     Lookup the experiment in the database, and the file on S3. Then, do the
@@ -49,8 +42,15 @@ def build_request(channel, method, _properties, body):
     """
     logging.info("Build request received: %r", body)
 
-    # Look up the experiment in the database
     session = SQLSession()
+    try:
+        _build(session, object_store, file_cache, channel, method, body)
+    finally:
+        session.close()
+
+
+def _build(session, object_store, file_cache, channel, method, body):
+    # Look up the experiment in the database
     experiment = session.query(database.Experiment).get(body)
     if not experiment:
         logging.error("Got a build request but couldn't get the experiment "
@@ -67,27 +67,37 @@ def build_request(channel, method, _properties, body):
     experiment.docker_image = None
     experiment.parameters[:] = []
     experiment.paths[:] = []
-    experiment.log[:] = []
+    notify(session, 'build', experiment.hash)
     session.commit()
     logging.info("Set status to BUILDING")
 
+    # Build log, written to the object store in segments
+    log = BufferedLogWriter(SQLSession, object_store,
+                            'build', experiment.hash)
+
     # Make build directory
     directory = tempfile.mkdtemp('build_%s' % experiment.hash)
 
     def set_error(msg):
         logging.warning("Got error: %s", msg)
+        try:
+            log.write(msg)
+            log.flush()
+        except Exception:
+            logging.exception("Error writing log")
         experiment.status = database.Status.ERROR
-        session.add(database.BuildLogLine(experiment_hash=experiment.hash,
-                                          line=msg))
+        notify(session, 'build', experiment.hash)
         session.commit()
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
     try:
+        log.clear()
+
         # Get experiment file
         logging.info("Downloading file...")
         local_path = os.path.join(directory, 'experiment.rpz')
         build_dir = os.path.join(directory, 'build_dir')
-        object_store.download_file('experiments', experiment.hash, local_path)
+        file_cache.download_file('experiments', experiment.hash, local_path)
         logging.info("Got file, %d bytes", os.stat(local_path).st_size)
 
         # Get metadata
@@ -100,29 +110,25 @@ def build_request(channel, method, _properties, body):
         info = json.loads(info_stdout.decode('utf-8'))
         logging.info("Got metadata, %d runs", len(info['runs']))
 
-        # Remove previous build log
-        experiment.log[:] = []
-        session.commit()
-
         # Build the experiment
         image_name = 'rpuz_exp_%s' % experiment.hash
         fq_image_name = '%s/%s' % (DOCKER_REGISTRY, image_name)
         logging.info("Building image %s...", fq_image_name)
-        err = run_cmd_and_log(session, experiment.hash,
+        err = run_cmd_and_log(log,
                               ['reprounzip', '-v', 'docker', 'setup',
                                '--image-name', fq_image_name,
                                local_path, build_dir])
         if err is not None:
             return set_error(err)
 
-        session.add(database.BuildLogLine(experiment_hash=experiment.hash,
-                                          line="Build successful"))
+        log.write("Build successful")
+        log.flush()
         experiment.docker_image = image_name
         session.commit()
         logging.info("Build over, pushing image")
 
         # Push image to Docker repository
-        subprocess.check_call(['docker', 'push', fq_image_name])
+        docker_client.push(fq_image_name)
         logging.info("Push complete, finishing up")
 
         # Add parameters
@@ -156,6 +162,7 @@ def build_request(channel, method, _properties, body):
 
         # Set status
         experiment.status = database.Status.BUILT
+        notify(session, 'build', experiment.hash)
         # ACK
         session.commit()
         channel.basic_ack(delivery_tag=method.delivery_tag)
@@ -171,10 +178,22 @@ def build_request(channel, method, _properties, body):
             # NACK the task in RabbitMQ
             channel.basic_nack(delivery_tag=method.delivery_tag)
     finally:
+        # Write remaining log lines
+        try:
+            log.close()
+        except Exception:
+            logging.exception("Error writing log")
         # Remove build directory
         shutil.rmtree(directory)
 
 
+def make_worker():
+    # boto3 resources can't be shared between threads
+    object_store = get_object_store()
+    return functools.partial(build_request, object_store,
+                             get_file_cache(object_store))
+
+
 def main():
     setup_logging('REPROSERVER-BUILDER')
 
@@ -182,13 +201,11 @@ def main():
     global SQLSession
     engine, SQLSession = database.connect()
 
-    # AMQP
-    tasks = TaskQueues()
-
-    # Object storage
-    global object_store
-    object_store = get_object_store()
+    # Connections to the Docker daemon, shared by the workers
+    global docker_client
+    docker_client = DockerClient()
 
     # Wait for tasks
+    nb_workers = int(os.environ.get('BUILDER_WORKERS', '1'), 10)
     logging.info("Ready, listening for requests")
-    tasks.consume_build_tasks(build_request)
+    WorkerPool(nb_workers, TaskQueues.consume_build_tasks, make_worker).run()
@@ -0,0 +1,474 @@
+"""Client for the Docker Engine API.
+"""
+
+import base64
+import contextlib
+import json
+import logging
+import os
+import posixpath
+import socket
+import struct
+import tarfile
+import threading
+import time
+
+try:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode
+except ImportError:  # Python 2
+    import httplib
+    from urllib import quote, urlencode
+
+
+__all__ = ['DockerError', 'DockerClient']
+
+
+API_VERSION = '1.24'
+
+# Size of the chunks read from and sent to the daemon
+CHUNK_SIZE = 1 << 20
+
+# Errors meaning a kept-alive connection was closed by the daemon
+CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+# Streams in the multiplexed output of a container
+STDOUT = 1
+STDERR = 2
+
+
+class DockerError(Exception):
+    """An error reported by the Docker daemon.
+
+    `status` is the HTTP status of the response, for example 404 if the
+    container or the path doesn't exist. It is None for errors reported in
+    the middle of a streamed response, such as a failed push.
+    """
+    def __init__(self, status, message):
+        super(DockerError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return "Docker error %s: %s" % (self.status, self.message)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a unix socket.
+    """
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.socket_timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def _tar_file(header, size, fileobj):
+    """Generate a tar archive containing a single file, as chunks.
+    """
+    yield header
+    remaining = size
+    while remaining:
+        chunk = fileobj.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError("File is shorter than expected (missing %d "
+                          "bytes)" % remaining)
+        remaining -= len(chunk)
+        yield chunk
+    # Pad the content to a full block, then two empty blocks
+    padding = -size % tarfile.BLOCKSIZE
+    yield b'\0' * (padding + 2 * tarfile.BLOCKSIZE)
+
+
+def _read_exactly(response, size):
+    data = b''
+    while len(data) < size:
+        chunk = response.read(size - len(data))
+        if not chunk:
+            raise IOError("Truncated stream from the Docker daemon")
+        data += chunk
+    return data
+
+
+def _split_image(image):
+    """Split an image name into repository and tag.
+    """
+    repository, _, tag = image.rpartition(':')
+    # The colon might be the port of the registry
+    if not repository or '/' in tag:
+        return image, 'latest'
+    return repository, tag
+
+
+class DockerClient(object):
+    """Talks to the Docker daemon.
+
+    `host` is the address of the daemon, in the same format as the
+    `DOCKER_HOST` environment variable which is used by default, for example
+    `unix:///var/run/docker.sock` or `tcp://127.0.0.1:2375`.
+
+    Requests go over kept-alive HTTP connections, up to `pool_size` of which
+    are kept idle for reuse; the client can be shared between threads.
+    Errors from the daemon raise `DockerError`.
+
+    Files are copied in and out of containers as tar streams, the same way
+    `docker cp` does, without going through local files.
+    """
+    def __init__(self, host=None, timeout=None, pool_size=10):
+        if host is None:
+            host = (os.environ.get('DOCKER_HOST') or
+                    'unix:///var/run/docker.sock')
+        if host.startswith('unix://'):
+            self.socket_path = host[7:]
+            self.address = None
+        else:
+            if host.startswith('tcp://'):
+                host = host[6:]
+            self.socket_path = None
+            self.address = host
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool_lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+        else:
+            return httplib.HTTPConnection(self.address, timeout=self.timeout)
+
+    def _get_connection(self):
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, conn, response):
+        """Put a connection back in the pool, once its response is read.
+        """
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self._pool_lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections.
+        """
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _url(self, path, params=None):
+        url = '/v%s%s' % (API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+        return url
+
+    def _request(self, method, path, params=None, body=None, headers=None):
+        """Send a request, returning the connection and the response.
+
+        The caller has to give the connection back with `_release()` once it
+        has read the response, or close it. Raises `DockerError` if the
+        daemon returns an error.
+        """
+        url = self._url(path, params)
+        headers = headers or {}
+        if body is None or isinstance(body, bytes):
+            conn, reused = self._get_connection()
+        else:
+            # A stream can't be sent again, don't risk a stale connection
+            conn, reused = self._connect(), False
+        try:
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            except CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # The daemon closed the idle connection, try a new one
+                conn.close()
+                conn = self._connect()
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            if response.status >= 400:
+                message = self._error_message(response)
+                self._release(conn, response)
+                raise DockerError(response.status, message)
+        except DockerError:
+            raise
+        except Exception:
+            conn.close()
+            raise
+        return conn, response
+
+    @staticmethod
+    def _error_message(response):
+        data = response.read()
+        try:
+            return json.loads(data.decode('utf-8'))['message']
+        except (ValueError, KeyError, TypeError):
+            return data.decode('utf-8', 'replace').strip()
+
+    def _call(self, method, path, params=None, body=None):
+        """Send a request with an optional JSON body, returning the decoded
+        JSON response (or None if it's empty).
+        """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        conn, response = self._request(method, path, params, body, headers)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, response)
+        if not data:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    def _call_progress(self, method, path, params=None, headers=None):
+        """Send a request returning a stream of JSON progress messages.
+
+        Raises `DockerError` if the stream reports an error, which is how
+        pushes and pulls fail once they have started.
+        """
+        conn, response = self._request(method, path, params, None, headers)
+        try:
+            buf = b''
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf += chunk
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    message = json.loads(line.decode('utf-8'))
+                    if 'error' in message:
+                        raise DockerError(None, message['error'])
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, response)
+
+    # Containers
+
+    def create_container(self, image, command=None, name=None, cpus=None,
+                         memory=None, disk=None):
+        """Create a container, returning its ID.
+
+        `cpus` is a number of CPUs (can be fractional), `memory` and `disk`
+        are sizes in bytes.
+        """
+        host_config = {}
+        if cpus is not None:
+            host_config['CpuPeriod'] = 100000
+            host_config['CpuQuota'] = int(cpus * 100000)
+        if memory is not None:
+            host_config['Memory'] = memory
+        if disk is not None:
+            host_config['StorageOpt'] = {'size': '%d' % disk}
+        config = {'Image': image, 'HostConfig': host_config}
+        if command is not None:
+            config['Cmd'] = command
+        params = {'name': name} if name is not None else None
+        result = self._call('POST', '/containers/create', params, config)
+        for warning in result.get('Warnings') or ():
+            logging.warning("Creating container: %s", warning)
+        return result['Id']
+
+    def start(self, container):
+        self._call('POST', '/containers/%s/start' % quote(container,
+                                                          safe=''))
+
+    @contextlib.contextmanager
+    def attach(self, container, logs=False):
+        """Attach to the output of a container.
+
+        Yields an iterator over `(stream, data)` pairs, where `stream` is
+        `STDOUT` or `STDERR`, until the container stops. Use `logs=True` to
+        also get what it output before attaching. The container has to have
+        been created without a TTY.
+        """
+        conn, response = self._request(
+            'POST', '/containers/%s/attach' % quote(container, safe=''),
+            {'stream': '1', 'stdout': '1', 'stderr': '1',
+             'logs': '1' if logs else '0'})
+        try:
+            yield self._frames(response)
+        finally:
+            # The connection was hijacked, it can't be reused
+            conn.close()
+
+    @contextlib.contextmanager
+    def logs(self, container, follow=False):
+        """Get the output of a container.
+
+        Yields an iterator over `(stream, data)` pairs, like `attach()`. With
+        `follow=True`, it keeps going until the container stops.
+        """
+        conn, response = self._request(
+            'GET', '/containers/%s/logs' % quote(container, safe=''),
+            {'stdout': '1', 'stderr': '1',
+             'follow': '1' if follow else '0'})
+        try:
+            yield self._frames(response)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _frames(response):
+        while True:
+            header = response.read(8)
+            if not header:
+                return
+            if len(header) < 8:
+                header += _read_exactly(response, 8 - len(header))
+            stream, size = struct.unpack('>BxxxL', header)
+            yield stream, _read_exactly(response, size)
+
+    def wait(self, container):
+        """Wait for a container to stop, returning its exit status.
+        """
+        result = self._call('POST', '/containers/%s/wait' % quote(container,
+                                                                  safe=''))
+        return result['StatusCode']
+
+    def inspect_container(self, container):
+        return self._call('GET', '/containers/%s/json' % quote(container,
+                                                               safe=''))
+
+    def remove_container(self, container, force=False):
+        self._call('DELETE', '/containers/%s' % quote(container, safe=''),
+                   {'force': '1' if force else '0', 'v': '1'})
+
+    # Copying files
+
+    def put_archive(self, container, path, chunks, length):
+        """Extract a tar archive in a directory of the container.
+
+        `chunks` is an iterable of bytes, `length` bytes in total.
+        """
+        conn, response = self._request(
+            'PUT', '/containers/%s/archive' % quote(container, safe=''),
+            {'path': path}, chunks,
+            {'Content-Type': 'application/x-tar',
+             'Content-Length': str(length)})
+        try:
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, response)
+
+    @contextlib.contextmanager
+    def get_archive(self, container, path):
+        """Get a path from a container, as a tar stream.
+        """
+        conn, response = self._request(
+            'GET', '/containers/%s/archive' % quote(container, safe=''),
+            {'path': path})
+        try:
+            yield response
+        except Exception:
+            conn.close()
+            raise
+        if response.isclosed():
+            self._release(conn, response)
+        else:
+            conn.close()
+
+    def put_file(self, container, path, fileobj, size):
+        """Write a file in a container, reading `size` bytes from `fileobj`.
+
+        The directory containing `path` has to exist in the container.
+        """
+        directory, name = posixpath.split(path)
+        header = _tar_header(name, size)
+        length = (len(header) + size + -size % tarfile.BLOCKSIZE +
+                  2 * tarfile.BLOCKSIZE)
+        self.put_archive(container, directory or '/',
+                         _tar_file(header, size, fileobj), length)
+        logging.info("Copied %d bytes to %s:%s", size, container, path)
+
+    @contextlib.contextmanager
+    def get_file(self, container, path):
+        """Read a file from a container.
+
+        Yields a file object reading its content from the daemon, and its
+        size. Raises `DockerError` if it doesn't exist or is not a file.
+        """
+        with self.get_archive(container, path) as response:
+            tar = tarfile.open(fileobj=response, mode='r|')
+            member = tar.next()
+            if member is None or not member.isfile():
+                raise DockerError(None, "%s is not a file" % path)
+            yield tar.extractfile(member), member.size
+
+    # Images
+
+    def inspect_image(self, image):
+        """Get information on an image, or None if it doesn't exist.
+        """
+        try:
+            return self._call('GET', '/images/%s/json' % quote(image,
+                                                               safe='/:'))
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def list_images(self):
+        """List the tags of all the images.
+        """
+        tags = []
+        for image in self._call('GET', '/images/json'):
+            for tag in image.get('RepoTags') or ():
+                if tag != '<none>:<none>':
+                    tags.append(tag)
+        return tags
+
+    def pull(self, image):
+        repository, tag = _split_image(image)
+        self._call_progress('POST', '/images/create',
+                            {'fromImage': repository, 'tag': tag},
+                            {'X-Registry-Auth': self._registry_auth()})
+        logging.info("Pulled image %s", image)
+
+    def push(self, image):
+        repository, tag = _split_image(image)
+        self._call_progress('POST',
+                            '/images/%s/push' % quote(repository, safe='/:'),
+                            {'tag': tag},
+                            {'X-Registry-Auth': self._registry_auth()})
+        logging.info("Pushed image %s", image)
+
+    def remove_image(self, image):
+        self._call('DELETE', '/images/%s' % quote(image, safe='/:'))
+
+    @staticmethod
+    def _registry_auth():
+        # No credentials, but recent daemons require the header
+        return base64.b64encode(b'{}').decode('ascii')
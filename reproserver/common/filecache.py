@@ -0,0 +1,239 @@
+import contextlib
+import errno
+import fcntl
+from hashlib import sha256
+import logging
+import os
+import shutil
+
+from . import metrics
+from .utils import parse_size
+
+
+__all__ = ['FileCache', 'get_file_cache']
+
+
+def get_file_cache(object_store):
+    """Get a cache in front of the object store, configured from environment.
+    """
+    directory = os.environ.get('CACHE_DIR') or '/tmp/reproserver-cache'
+    max_size = parse_size(os.environ.get('CACHE_SIZE') or '10g')
+    return FileCache(object_store, directory, max_size)
+
+
+def _hash_file(path):
+    hasher = sha256()
+    with open(path, 'rb') as fp:
+        chunk = fp.read(1 << 20)
+        while chunk:
+            hasher.update(chunk)
+            chunk = fp.read(1 << 20)
+    return hasher.hexdigest()
+
+
+class _FileLock(object):
+    def __init__(self, path, blocking=True, shared=False):
+        self.path = path
+        self.blocking = blocking
+        self.shared = shared
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.path, 'a')
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fp.fileno(), flags)
+        except IOError:
+            self.fp.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        self.fp.close()
+
+
+class _CachingReader(object):
+    """Reads a stream, hashing it and writing a copy to a file.
+    """
+    def __init__(self, stream, fp):
+        self.stream = stream
+        self.fp = fp
+        self.hasher = sha256()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hasher.update(chunk)
+        self.fp.write(chunk)
+        return chunk
+
+
+class FileCache(object):
+    """On-disk LRU cache of content-addressed objects.
+
+    Objects in the 'experiments' and 'inputs' buckets are named after the
+    sha256 of their content, so they never change and can be kept locally.
+    Each object has a lock file, so that concurrent workers (threads or
+    processes sharing the directory) only download it once: readers of an
+    object already in the cache share the lock, while filling and evicting
+    take it exclusively. Objects are checked against their hash when written
+    (they are only renamed into place if it matches), and the least recently
+    used ones are removed when the cache grows over `max_size` bytes.
+    """
+    def __init__(self, object_store, directory, max_size):
+        self.object_store = object_store
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, bucket, objectname):
+        if (not objectname or '/' in objectname or
+                objectname.startswith('.')):
+            raise ValueError("Invalid object name %r" % objectname)
+        directory = os.path.join(self.directory, bucket)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.path.join(directory, objectname)
+
+    def _check_cached(self, bucket, objectname, path, record=True):
+        """Whether the object is in the cache.
+
+        Has to be called with the object's lock held. The content was checked
+        when it was written, so this doesn't hash it again. If `record` is
+        False, hits and misses are not counted (for checking again after
+        taking the exclusive lock).
+        """
+        if not os.path.exists(path):
+            if record:
+                metrics.counter('file_cache_misses').inc()
+            return False
+        logging.info("Got %s/%s from cache", bucket, objectname)
+        if record:
+            metrics.counter('file_cache_hits').inc()
+        os.utime(path, None)
+        return True
+
+    @staticmethod
+    def _link(path, filename):
+        # Hard-link it, so it stays valid even if evicted from the cache
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            os.link(path, filename)
+        except OSError:
+            shutil.copyfile(path, filename)
+
+    def download_file(self, bucket, objectname, filename):
+        """Get an object into a local file, downloading it if necessary.
+
+        Same as `ObjectStore.download_file()`; `objectname` has to be the
+        sha256 of the content.
+        """
+        path = self._path(bucket, objectname)
+        lock = path + '.lock'
+        with _FileLock(lock, shared=True):
+            cached = self._check_cached(bucket, objectname, path)
+            if cached:
+                self._link(path, filename)
+
+        if not cached:
+            # flock() can't upgrade atomically, so check again once we have
+            # the exclusive lock, another worker might have filled it
+            with _FileLock(lock):
+                if not self._check_cached(bucket, objectname, path,
+                                          record=False):
+                    temp = '%s.part' % path
+                    try:
+                        self.object_store.download_file(bucket, objectname,
+                                                        temp)
+                        if _hash_file(temp) != objectname:
+                            raise IOError("Downloaded %s/%s doesn't match "
+                                          "its hash" % (bucket, objectname))
+                        os.rename(temp, path)
+                    finally:
+                        if os.path.exists(temp):
+                            os.remove(temp)
+                self._link(path, filename)
+
+        self.evict()
+
+    @contextlib.contextmanager
+    def open(self, bucket, objectname):
+        """Read an object as a stream, yielding a file object and its size.
+
+        If the object is not in the cache, it is streamed from the object
+        store, and written to the cache on the way; it is only kept if the
+        whole content was read and matches its hash, otherwise an `IOError`
+        is raised once the stream is consumed.
+        """
+        path = self._path(bucket, objectname)
+        lock = path + '.lock'
+        with _FileLock(lock, shared=True):
+            cached = self._check_cached(bucket, objectname, path)
+            if cached:
+                with open(path, 'rb') as fp:
+                    yield fp, os.fstat(fp.fileno()).st_size
+
+        if not cached:
+            # Check again with the exclusive lock, see download_file()
+            with _FileLock(lock):
+                if self._check_cached(bucket, objectname, path,
+                                      record=False):
+                    with open(path, 'rb') as fp:
+                        yield fp, os.fstat(fp.fileno()).st_size
+                else:
+                    temp = '%s.part' % path
+                    body, size = self.object_store.open_object(bucket,
+                                                               objectname)
+                    try:
+                        with open(temp, 'wb') as fp:
+                            reader = _CachingReader(body, fp)
+                            yield reader, size
+                        if reader.hasher.hexdigest() != objectname:
+                            raise IOError("Downloaded %s/%s doesn't match "
+                                          "its hash" % (bucket, objectname))
+                        os.rename(temp, path)
+                    finally:
+                        body.close()
+                        if os.path.exists(temp):
+                            os.remove(temp)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used objects until under the size limit.
+        """
+        entries = []
+        total = 0
+        for bucket in os.listdir(self.directory):
+            directory = os.path.join(self.directory, bucket)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.lock') or name.endswith('.part'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                with _FileLock(path + '.lock', blocking=False):
+                    if os.path.exists(path):
+                        os.remove(path)
+                        logging.info("Evicted %s from cache", path)
+            except IOError:
+                # Being used, skip it
+                continue
+            total -= size
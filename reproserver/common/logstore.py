@@ -0,0 +1,74 @@
+"""Storage of build and run logs as compressed segments.
+
+Logs are written as append-only gzip segments in the 'logs' bucket of the
+object store. The database only keeps a small index: one row per segment in
+the `log_segments` table, with the number of the first line it holds and its
+number of lines. Readers only download the segments covering the lines they
+need.
+"""
+
+import gzip
+import io
+
+
+__all__ = ['NOTIFY_CHANNEL', 'segment_prefix', 'segment_name',
+           'encode_segment', 'decode_segment', 'LogStore']
+
+
+# Postgres channel on which the workers announce new log lines and status
+# changes, with payload 'build:<experiment hash>' or 'run:<run id>'
+NOTIFY_CHANNEL = 'reproserver_updates'
+
+
+def segment_prefix(kind, owner):
+    """Get the prefix of the segments of a log.
+
+    `kind` is either 'build' (then `owner` is the experiment hash) or 'run'
+    (then `owner` is the run ID).
+    """
+    if kind not in ('build', 'run'):
+        raise ValueError("Invalid log kind %s" % kind)
+    return '%s/%s/' % (kind, owner)
+
+
+def segment_name(kind, owner, first_line):
+    return '%s%010d.gz' % (segment_prefix(kind, owner), first_line)
+
+
+def encode_segment(lines):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        fp.write(u'\n'.join(lines).encode('utf-8'))
+    return buf.getvalue()
+
+
+def decode_segment(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as fp:
+        return fp.read().decode('utf-8').split(u'\n')
+
+
+class LogStore(object):
+    """Reads and writes log segments in the object store.
+    """
+    def __init__(self, object_store):
+        self.object_store = object_store
+
+    def write_segment(self, kind, owner, first_line, lines):
+        """Upload a segment, returning its object name.
+        """
+        key = segment_name(kind, owner, first_line)
+        self.object_store.upload_fileobj('logs', key,
+                                         io.BytesIO(encode_segment(lines)))
+        return key
+
+    def read_segment(self, key):
+        """Download a segment, returning the list of its lines.
+        """
+        buf = io.BytesIO()
+        self.object_store.download_fileobj('logs', key, buf)
+        return decode_segment(buf.getvalue())
+
+    def delete_log(self, kind, owner):
+        """Remove all the segments of a log.
+        """
+        self.object_store.delete_prefix('logs', segment_prefix(kind, owner))
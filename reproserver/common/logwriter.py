@@ -0,0 +1,247 @@
+import atexit
+import collections
+import logging
+from sqlalchemy.sql import column, func, select, table
+import threading
+import time
+import weakref
+
+from .logstore import NOTIFY_CHANNEL, LogStore
+
+
+__all__ = ['log_segments', 'notify', 'BufferedLogWriter']
+
+
+# The table behind web.models.LogSegment
+log_segments = table('log_segments',
+                     column('experiment_hash'),
+                     column('run_id'),
+                     column('first_line'),
+                     column('nb_lines'),
+                     column('key'))
+
+
+def notify(session, kind, owner):
+    """Tell the web frontends that a build or run was updated.
+
+    The notification is delivered when the session's transaction commits.
+    """
+    session.execute(select([func.pg_notify(NOTIFY_CHANNEL,
+                                           '%s:%s' % (kind, owner))]))
+
+
+_live_writers = weakref.WeakSet()
+
+
+class BufferedLogWriter(object):
+    """Buffers log lines and writes them out in segments.
+
+    Instead of one INSERT and COMMIT per line, lines are accumulated and
+    written out as a compressed segment in the object store (see
+    `common.logstore`) once `max_lines` are buffered or `max_delay` seconds
+    have passed since the first buffered line. Each segment gets a single row
+    in the `log_segments` table.
+
+    `kind` is 'build' (`owner` is the experiment hash) or 'run' (`owner` is
+    the run ID).
+
+    Segments are shipped from a background thread, in order, so that
+    `write()` doesn't wait on the object store or the database, and the
+    process producing the output keeps being read. If shipping falls more
+    than `max_pending` segments behind, `write()` blocks until it catches up.
+
+    The writer uses its own session (made from `session_factory`) and a
+    background timer, so that a silent process still gets its output written
+    out. Remaining lines are written on `close()`, when leaving a `with`
+    block (even on error), and at interpreter exit.
+    """
+    def __init__(self, session_factory, object_store, kind, owner,
+                 max_lines=500, max_delay=2.0, max_pending=8):
+        self.log_store = LogStore(object_store)
+        self.kind = kind
+        self.owner = owner
+        if kind == 'build':
+            self.fields = {'experiment_hash': owner}
+        else:
+            self.fields = {'run_id': owner}
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._session_factory = session_factory
+        self._session = None
+        # Protects the buffer and the pending segments
+        self._lock = threading.Lock()
+        # Held while writing segments out, so they are written in order
+        self._ship_lock = threading.Lock()
+        self._buffer = []
+        self._pending = collections.deque()
+        self._shipping = False
+        self._next_line = 0
+        self._first_buffered = None
+        self._closed = False
+        self._timer = None
+        _live_writers.add(self)
+
+    def write(self, line):
+        """Add a line to the log.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("Writing to closed log")
+            self._buffer.append(line)
+            if len(self._buffer) >= self.max_lines:
+                self._cut_locked()
+            elif self._first_buffered is None:
+                self._first_buffered = time.time()
+                self._schedule()
+            elif time.time() - self._first_buffered >= self.max_delay:
+                self._cut_locked()
+            if not self._pending:
+                return
+            backlog = len(self._pending) >= self.max_pending
+            if not backlog and not self._shipping:
+                self._shipping = True
+                shipper = threading.Thread(target=self._shipper)
+                shipper.daemon = True
+                shipper.start()
+        if backlog:
+            self._ship()
+
+    def flush(self):
+        """Write all the buffered lines now.
+        """
+        with self._lock:
+            self._cut_locked()
+        self._ship()
+
+    def clear(self):
+        """Remove the whole log, including what was written previously.
+        """
+        with self._ship_lock, self._lock:
+            self._buffer = []
+            self._pending.clear()
+            self._next_line = 0
+            session = self._get_session()
+            try:
+                query = log_segments.delete()
+                for name, value in self.fields.items():
+                    query = query.where(log_segments.c[name] == value)
+                session.execute(query)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            self.log_store.delete_log(self.kind, self.owner)
+
+    def close(self):
+        """Write the remaining lines and release the database session.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._cut_locked()
+        try:
+            self._ship()
+        finally:
+            with self._ship_lock:
+                if self._session is not None:
+                    self._session.close()
+                    self._session = None
+            _live_writers.discard(self)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self._session_factory()
+        return self._session
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.max_delay, self._timer_flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timer_flush(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._cut_locked()
+        try:
+            self._ship()
+        except Exception:
+            logging.exception("Error writing log segment")
+
+    def _shipper(self):
+        while True:
+            try:
+                self._ship()
+            except Exception:
+                logging.exception("Error writing log segment")
+                # Leave it pending, the next flush will try again
+                with self._lock:
+                    self._shipping = False
+                return
+            with self._lock:
+                if not self._pending:
+                    self._shipping = False
+                    return
+
+    def _cut_locked(self):
+        """Move the buffered lines to a new pending segment.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._first_buffered = None
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        self._pending.append((self._next_line, lines))
+        self._next_line += len(lines)
+
+    def _ship(self):
+        """Write out the pending segments, oldest first.
+        """
+        with self._ship_lock:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    first_line, lines = self._pending[0]
+                self._write_segment(first_line, lines)
+                with self._lock:
+                    self._pending.popleft()
+
+    def _write_segment(self, first_line, lines):
+        key = self.log_store.write_segment(self.kind, self.owner,
+                                           first_line, lines)
+        row = dict(self.fields, first_line=first_line, nb_lines=len(lines),
+                   key=key)
+        session = self._get_session()
+        try:
+            session.execute(log_segments.insert().values(row))
+            notify(session, self.kind, self.owner)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+
+@atexit.register
+def _flush_all():
+    for writer in list(_live_writers):
+        try:
+            writer.close()
+        except Exception:
+            logging.exception("Error writing log segment at exit")
@@ -0,0 +1,79 @@
+"""Simple in-process metrics.
+
+Counters and timers are kept in a process-wide registry, and written to the
+log with `log_metrics()`.
+"""
+
+import logging
+import threading
+
+
+__all__ = ['counter', 'timer', 'snapshot', 'log_metrics']
+
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+class Timer(object):
+    """Keeps the number, total and maximum of durations, in seconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        with _lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': self.total / self.count if self.count else 0.0}
+
+
+def _get(name, cls):
+    with _lock:
+        try:
+            metric = _metrics[name]
+        except KeyError:
+            metric = _metrics[name] = cls()
+    if not isinstance(metric, cls):
+        raise TypeError("Metric %s is not a %s" % (name, cls.__name__))
+    return metric
+
+
+def counter(name):
+    return _get(name, Counter)
+
+
+def timer(name):
+    return _get(name, Timer)
+
+
+def snapshot():
+    """Get the current value of all metrics, as a dictionary.
+    """
+    with _lock:
+        return dict((name, metric.as_dict())
+                    for name, metric in _metrics.items())
+
+
+def log_metrics():
+    for name, values in sorted(snapshot().items()):
+        logging.info("Metric %s: %s", name,
+                     ", ".join('%s=%s' % kv for kv in sorted(values.items())))
@@ -1,7 +1,16 @@
 import boto3
+import collections
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from botocore.exceptions import ClientError
+from hashlib import sha256
 import logging
 import os
+import threading
+import uuid
+
+from . import metrics
+from .utils import parse_size
 
 
 def get_object_store(endpoint_url=None):
@@ -9,20 +18,77 @@ def get_object_store(endpoint_url=None):
     if endpoint_url is None:
         endpoint_url = os.environ.get('S3_URL') or None
     bucket_prefix = os.environ['S3_BUCKET_PREFIX']
-    return ObjectStore(endpoint_url, bucket_prefix)
+    part_size = os.environ.get('S3_PART_SIZE')
+    max_concurrency = os.environ.get('S3_MAX_CONCURRENCY')
+    max_bandwidth = os.environ.get('S3_MAX_BANDWIDTH')
+    return ObjectStore(
+        endpoint_url, bucket_prefix,
+        part_size=parse_size(part_size) if part_size else None,
+        max_concurrency=int(max_concurrency) if max_concurrency else None,
+        max_bandwidth=parse_size(max_bandwidth) if max_bandwidth else None)
+
+
+# Buckets whose objects are named after the sha256 of their content, and
+# never change once written
+CONTENT_ADDRESSED = ('experiments', 'inputs', 'outputs')
+
+# Days after which temporary objects and incomplete multipart uploads are
+# removed by the object store
+TMP_EXPIRATION_DAYS = 1
+
+# Content-addressed objects seen in the object store by this process, so
+# their uploads can be skipped without checking again; least recently used
+# first, up to KNOWN_OBJECTS_MAX. This is only a hint: it is never used to
+# decide that an object exists before deleting another copy
+KNOWN_OBJECTS_MAX = 100000
+_known_objects = collections.OrderedDict()
+_known_lock = threading.Lock()
+
+
+def _read_part(fileobj, size):
+    """Read `size` bytes, or less only at the end of the stream.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = fileobj.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
 
 
 class ObjectStore(object):
-    def __init__(self, endpoint_url, bucket_prefix):
+    """Access to the S3 buckets.
+
+    All transfers are managed transfers, split in parts of `part_size` bytes
+    sent over up to `max_concurrency` threads, optionally limited to
+    `max_bandwidth` bytes per second.
+    """
+    def __init__(self, endpoint_url, bucket_prefix, part_size=None,
+                 max_concurrency=None, max_bandwidth=None):
+        transfer_config = {}
+        if part_size is not None:
+            transfer_config['multipart_threshold'] = part_size
+            transfer_config['multipart_chunksize'] = part_size
+        if max_concurrency is not None:
+            transfer_config['max_concurrency'] = max_concurrency
+        if max_bandwidth is not None:
+            transfer_config['max_bandwidth'] = max_bandwidth
+        self.transfer_config = TransferConfig(**transfer_config)
+        # Enough connections for all the transfer threads
+        pool_size = max(10, max_concurrency or 0)
         self.s3 = boto3.resource('s3', endpoint_url=endpoint_url,
                                  aws_access_key_id=os.environ['S3_KEY'],
                                  aws_secret_access_key=os.environ['S3_SECRET'],
                                  region_name='us-east-1',
-                                 config=Config(signature_version='s3v4'))
+                                 config=Config(signature_version='s3v4',
+                                               max_pool_connections=pool_size))
         self.bucket_prefix = bucket_prefix
 
     def bucket_name(self, name):
-        if name not in ('experiments', 'inputs', 'outputs'):
+        if name not in ('experiments', 'inputs', 'outputs', 'logs'):
             raise ValueError("Invalid bucket name %s" % name)
 
         name = '%s-%s-%s' % ('reproserver', self.bucket_prefix, name)
@@ -32,19 +98,198 @@ class ObjectStore(object):
         return self.s3.Bucket(self.bucket_name(name))
 
     def download_file(self, bucket, objectname, filename):
-        self.bucket(bucket).download_file(objectname, filename)
+        self.bucket(bucket).download_file(objectname, filename,
+                                          Config=self.transfer_config)
+
+    def download_fileobj(self, bucket, objectname, fileobj):
+        self.bucket(bucket).download_fileobj(objectname, fileobj,
+                                             Config=self.transfer_config)
+
+    def open_object(self, bucket, objectname):
+        """Read an object as a stream, returning a file object and its size.
+        """
+        response = self.s3.meta.client.get_object(
+            Bucket=self.bucket_name(bucket), Key=objectname)
+        return response['Body'], response['ContentLength']
 
     def upload_fileobj(self, bucket, objectname, fileobj):
-        self.s3.Object(self.bucket_name(bucket), objectname).put(Body=fileobj)
+        self.s3.meta.client.upload_fileobj(fileobj,
+                                           self.bucket_name(bucket),
+                                           objectname,
+                                           Config=self.transfer_config)
+        self._remember(bucket, objectname)
 
     def upload_file(self, bucket, objectname, filename):
         self.s3.meta.client.upload_file(filename,
-                                        self.bucket_name(bucket), objectname)
+                                        self.bucket_name(bucket), objectname,
+                                        Config=self.transfer_config)
+
+    def exists(self, bucket, objectname):
+        try:
+            self.s3.meta.client.head_object(Bucket=self.bucket_name(bucket),
+                                            Key=objectname)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        self._remember(bucket, objectname)
+        return True
+
+    @staticmethod
+    def _remember(bucket, objectname):
+        if bucket in CONTENT_ADDRESSED:
+            key = bucket, objectname
+            with _known_lock:
+                _known_objects.pop(key, None)
+                _known_objects[key] = True
+                if len(_known_objects) > KNOWN_OBJECTS_MAX:
+                    _known_objects.popitem(last=False)
+
+    @staticmethod
+    def _is_known(bucket, objectname):
+        key = bucket, objectname
+        with _known_lock:
+            if key not in _known_objects:
+                return False
+            # Move it to the end, it's the most recently used now
+            _known_objects[key] = _known_objects.pop(key)
+            return True
+
+    @staticmethod
+    def _forget(bucket, objectname):
+        with _known_lock:
+            _known_objects.pop((bucket, objectname), None)
+
+    def skip_upload(self, bucket, objectname, size):
+        """Check whether a content-addressed object is already stored.
+
+        If it is, its upload can be skipped; this is counted in the
+        `object_store_skipped_uploads` and `object_store_skipped_bytes`
+        metrics.
+
+        Objects this process already saw are not checked again.
+        """
+        if not self._is_known(bucket, objectname) and \
+                not self.exists(bucket, objectname):
+            return False
+        logging.info("%s/%s is already stored, skipping upload (%d bytes)",
+                     bucket, objectname, size)
+        metrics.counter('object_store_skipped_uploads').inc()
+        metrics.counter('object_store_skipped_bytes').inc(size)
+        return True
+
+    def upload_fileobj_if_missing(self, bucket, objectname, fileobj, size):
+        """Upload a content-addressed object, unless it is already stored.
+
+        Returns True if it was uploaded.
+        """
+        if self.skip_upload(bucket, objectname, size):
+            return False
+        self.upload_fileobj(bucket, objectname, fileobj)
+        return True
+
+    def delete(self, bucket, objectname):
+        self.s3.meta.client.delete_object(Bucket=self.bucket_name(bucket),
+                                          Key=objectname)
+        self._forget(bucket, objectname)
+
+    def rename(self, bucket, objectname, new_objectname):
+        """Move an object, using a server-side copy.
+        """
+        bucket_name = self.bucket_name(bucket)
+        self.s3.meta.client.copy({'Bucket': bucket_name, 'Key': objectname},
+                                 bucket_name, new_objectname,
+                                 Config=self.transfer_config)
+        self.s3.meta.client.delete_object(Bucket=bucket_name, Key=objectname)
+        self._remember(bucket, new_objectname)
+
+    def create_multipart_upload(self, bucket, objectname):
+        """Start a multipart upload, returning its ID.
+        """
+        return self.s3.meta.client.create_multipart_upload(
+            Bucket=self.bucket_name(bucket), Key=objectname)['UploadId']
+
+    def upload_part(self, bucket, objectname, upload_id, part_number, data):
+        """Upload one part of a multipart upload, returning its ETag.
+        """
+        return self.s3.meta.client.upload_part(
+            Bucket=self.bucket_name(bucket), Key=objectname,
+            UploadId=upload_id, PartNumber=part_number, Body=data)['ETag']
+
+    def complete_multipart_upload(self, bucket, objectname, upload_id,
+                                  etags):
+        """Finish a multipart upload, given the ETags of the parts in order.
+        """
+        self.s3.meta.client.complete_multipart_upload(
+            Bucket=self.bucket_name(bucket), Key=objectname,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': i + 1, 'ETag': etag}
+                                       for i, etag in enumerate(etags)]})
+
+    def abort_multipart_upload(self, bucket, objectname, upload_id):
+        self.s3.meta.client.abort_multipart_upload(
+            Bucket=self.bucket_name(bucket), Key=objectname,
+            UploadId=upload_id)
+
+    def upload_hashed(self, bucket, fileobj):
+        """Upload a stream, naming the object after the sha256 of its content.
+
+        The content is hashed while it is sent to a temporary object as a
+        multipart upload, so the stream is read only once; the object is then
+        renamed. Returns the hash and the size.
+        """
+        part_size = self.transfer_config.multipart_chunksize
+        temp_key = 'tmp/%s' % uuid.uuid4()
+        upload_id = self.create_multipart_upload(bucket, temp_key)
+        hasher = sha256()
+        size = 0
+        etags = []
+        try:
+            while True:
+                # Parts have to be at least 5 MB, except for the last one
+                data = _read_part(fileobj, part_size)
+                if not data and etags:
+                    break
+                hasher.update(data)
+                size += len(data)
+                etags.append(self.upload_part(bucket, temp_key, upload_id,
+                                              len(etags) + 1, data))
+                if len(data) < part_size:
+                    break
+            self.complete_multipart_upload(bucket, temp_key, upload_id,
+                                           etags)
+        except Exception:
+            self.abort_multipart_upload(bucket, temp_key, upload_id)
+            raise
+        filehash = hasher.hexdigest()
+        if self.exists(bucket, filehash):
+            # Don't copy it over, the content is the same
+            self.delete(bucket, temp_key)
+        else:
+            self.rename(bucket, temp_key, filehash)
+        return filehash, size
+
+    def hash_object(self, bucket, objectname):
+        """Read an object, returning its sha256 and size.
+        """
+        body = self.s3.Object(self.bucket_name(bucket), objectname).get()[
+            'Body']
+        hasher = sha256()
+        size = 0
+        chunk = body.read(1 << 20)
+        while chunk:
+            hasher.update(chunk)
+            size += len(chunk)
+            chunk = body.read(1 << 20)
+        return hasher.hexdigest(), size
+
+    def delete_prefix(self, bucket, prefix):
+        self.bucket(bucket).objects.filter(Prefix=prefix).delete()
 
     def create_buckets(self):
         buckets = set(bucket.name for bucket in self.s3.buckets.all())
         missing = []
-        for name in ('experiments', 'inputs', 'outputs'):
+        for name in ('experiments', 'inputs', 'outputs', 'logs'):
             name = self.bucket_name(name)
             if name not in buckets:
                 missing.append(name)
@@ -55,6 +300,36 @@ class ObjectStore(object):
             for name in missing:
                 self.s3.create_bucket(Bucket=name)
 
+        # Clean up what failed uploads leave behind
+        for name in ('experiments', 'inputs', 'outputs'):
+            try:
+                self.s3.meta.client.put_bucket_lifecycle_configuration(
+                    Bucket=self.bucket_name(name),
+                    LifecycleConfiguration={'Rules': [
+                        {'ID': 'expire-tmp',
+                         'Filter': {'Prefix': 'tmp/'},
+                         'Status': 'Enabled',
+                         'Expiration': {'Days': TMP_EXPIRATION_DAYS}},
+                        {'ID': 'abort-multipart',
+                         'Filter': {'Prefix': ''},
+                         'Status': 'Enabled',
+                         'AbortIncompleteMultipartUpload': {
+                             'DaysAfterInitiation': TMP_EXPIRATION_DAYS}},
+                    ]})
+            except ClientError as e:
+                logging.warning("Couldn't set lifecycle rules on %s: %s",
+                                name, e)
+
+    def presigned_upload_part_url(self, bucket, objectname, upload_id,
+                                  part_number, expires=3600):
+        return self.s3.meta.client.generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={'Bucket': self.bucket_name(bucket),
+                    'Key': objectname,
+                    'UploadId': upload_id,
+                    'PartNumber': part_number},
+            ExpiresIn=expires)
+
     def presigned_serve_url(self, bucket, objectname, filename, mime=None):
         return self.s3.meta.client.generate_presigned_url(
             ClientMethod='get_object',
@@ -0,0 +1,70 @@
+"""Running commands and containers for the builder and the runner.
+
+While the command runs, its output is read on the worker's thread and
+`BufferedLogWriter` uploads segments in the background. Before and after it,
+the runner copies a run's files on its `staging_pool` threads, all the inputs
+at once then all the outputs at once; each file is streamed into or out of
+the container rather than going through a temporary file. On top of that,
+the `WorkerPool` threads run several tasks at once.
+
+Workers don't use asyncio. The builder has to run on Python 2.7 for
+reprounzip, and database access goes through synchronous SQLAlchemy
+sessions. pika 0.10 does have an asynchronous `SelectConnection`, but
+consuming with it would only pay off with the rest of the task being
+asynchronous too, so `TaskQueues` keeps its blocking connections.
+"""
+
+import logging
+import subprocess
+
+
+__all__ = ['run_cmd_and_log', 'run_container_and_log']
+
+
+def run_cmd_and_log(log, cmd):
+    """Run a command, streaming its output to a `BufferedLogWriter`.
+
+    stdout and stderr are read line by line as the command produces them;
+    writing to the log doesn't block on the object store or the database, so
+    the pipe keeps being drained. Returns the exit status of the command.
+    """
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    proc.stdin.close()
+    try:
+        for line in iter(proc.stdout.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            logging.info("> %s", line)
+            log.write(line)
+    finally:
+        proc.stdout.close()
+    return proc.wait()
+
+
+def run_container_and_log(log, client, container):
+    """Start a container, streaming its output to a `BufferedLogWriter`.
+
+    `client` is a `DockerClient`. stdout and stderr are interleaved, like
+    `run_cmd_and_log()` does, but each is split in lines separately. Returns
+    the exit status of the container.
+    """
+    partial = {}
+
+    def write(line):
+        line = line.decode('utf-8', 'replace').rstrip()
+        logging.info("> %s", line)
+        log.write(line)
+
+    with client.attach(container) as output:
+        client.start(container)
+        for stream, data in output:
+            lines = (partial.pop(stream, b'') + data).split(b'\n')
+            partial[stream] = lines.pop()
+            for line in lines:
+                write(line)
+    for line in partial.values():
+        if line:
+            write(line)
+    return client.wait(container)
@@ -1,4 +1,7 @@
-__all__ = ['ShortIDs']
+import threading
+
+
+__all__ = ['ShortIDs', 'MultiShortIDs', 'get_short_ids']
 
 
 CHARS = u'023456789abcdefghijkmnopqrstuvwxyz'
@@ -61,6 +64,36 @@ class ShortIDs(object):
         """
         return _decode(shortid, self.cmap)
 
+    def encode_many(self, nbs, min_chars=5):
+        """Encode a list of numbers.
+
+        This only saves the attribute lookups; each number is still encoded
+        one character at a time, like `encode()` does.
+        """
+        chars = self.chars
+        return [_encode(nb, min_chars, chars) for nb in nbs]
+
+    def decode_many(self, shortids):
+        """Decode a list of short IDs, one at a time like `decode()`.
+        """
+        cmap = self.cmap
+        return [_decode(shortid, cmap) for shortid in shortids]
+
+
+_lock = threading.Lock()
+_codecs = {}
+
+
+def _get_codec(salt):
+    # The permutation only depends on the salt, compute it once per process
+    try:
+        return _codecs[salt]
+    except KeyError:
+        with _lock:
+            if salt not in _codecs:
+                _codecs[salt] = ShortIDs(salt)
+            return _codecs[salt]
+
 
 class MultiShortIDs(object):
     """Generates multiple sequences of short IDs.
@@ -72,18 +105,29 @@ class MultiShortIDs(object):
     def __init__(self, salt, min_chars=5):
         self.salt = salt
         self.min_chars = min_chars
-        self.shortids = {}
 
     def encode(self, key, nb):
-        try:
-            s = self.shortids[key]
-        except KeyError:
-            s = self.shortids[key] = ShortIDs(key + self.salt)
-        return s.encode(nb, self.min_chars)
+        return _get_codec(key + self.salt).encode(nb, self.min_chars)
 
     def decode(self, key, shortid):
-        try:
-            s = self.shortids[key]
-        except KeyError:
-            s = self.shortids[key] = ShortIDs(key + self.salt)
-        return s.decode(shortid)
+        return _get_codec(key + self.salt).decode(shortid)
+
+    def encode_many(self, key, nbs):
+        return _get_codec(key + self.salt).encode_many(nbs, self.min_chars)
+
+    def decode_many(self, key, shortids):
+        return _get_codec(key + self.salt).decode_many(shortids)
+
+
+_multi = {}
+
+
+def get_short_ids(salt, min_chars=5):
+    """Get the `MultiShortIDs` for a salt, shared by the whole process.
+    """
+    try:
+        return _multi[(salt, min_chars)]
+    except KeyError:
+        with _lock:
+            return _multi.setdefault((salt, min_chars),
+                                     MultiShortIDs(salt, min_chars))
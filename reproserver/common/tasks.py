@@ -3,27 +3,33 @@ import os
 import pika
 import pika.exceptions
 import time
-import environ
 
-#
+
+QUEUES = ('build_queue', 'run_queue', 'fetch_queue')
+
+
+def connect():
+    """Connect to the AMQP broker and declare the queues.
+
+    Returns the connection and a channel.
+    """
+    logging.info("Connecting to AMQP broker at %s", os.environ['AMQP_HOST'])
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        host=(os.environ['AMQP_HOST']),
+        credentials=pika.PlainCredentials(os.environ['AMQP_USER'],
+                                          os.environ['AMQP_PASSWORD'])))
+    channel = connection.channel()
+    for queue in QUEUES:
+        channel.queue_declare(queue=queue, durable=True)
+    return connection, channel
+
 
 class TaskQueues(object):
     def __init__(self):
         self._connect()
     
     def _connect(self):
-        logging.info("Connecting to AMQP broker")
-        logging.info(os.environ['AMQP_HOST'])
-        logging.info("=======")
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=(os.environ['AMQP_HOST']),
-            credentials=pika.PlainCredentials(os.environ['AMQP_USER'],
-                                              os.environ['AMQP_PASSWORD'])))
-        self.channel = self.connection.channel()
-
-        self.channel.queue_declare(queue='build_queue', durable=True)
-        self.channel.queue_declare(queue='run_queue', durable=True)
-
+        self.connection, self.channel = connect()
         self.channel.basic_qos(prefetch_count=1)
     
 
@@ -48,10 +54,37 @@ class TaskQueues(object):
                                                routing_key='run_queue',
                                                body=body))
 
-    def consume_build_tasks(self, callback):
-        self.channel.basic_consume(callback, queue='build_queue')
-        self._retry(self.channel.start_consuming)
+    def publish_fetch_task(self, body):
+        self._retry(
+            lambda: self.channel.basic_publish('',
+                                               routing_key='fetch_queue',
+                                               body=body))
+
+    def _consume(self, queue, callback, should_stop):
+        if should_stop is None:
+            self.channel.basic_consume(callback, queue=queue)
+            self._retry(self.channel.start_consuming)
+            return
+
+        # Check should_stop() every second, and after each task
+        def consume():
+            for message in self.channel.consume(queue, inactivity_timeout=1):
+                if should_stop():
+                    self.channel.cancel()
+                    return
+                if message is not None:
+                    method, properties, body = message
+                    callback(self.channel, method, properties, body)
+        self._retry(consume)
+
+    def consume_build_tasks(self, callback, should_stop=None):
+        self._consume('build_queue', callback, should_stop)
+
+    def consume_run_tasks(self, callback, should_stop=None):
+        self._consume('run_queue', callback, should_stop)
+
+    def consume_fetch_tasks(self, callback, should_stop=None):
+        self._consume('fetch_queue', callback, should_stop)
 
-    def consume_run_tasks(self, callback):
-        self.channel.basic_consume(callback, queue='run_queue')
-        self._retry(self.channel.start_consuming)
+    def close(self):
+        self.connection.close()
@@ -1,5 +1,6 @@
 from datetime import datetime
 import logging
+import re
 
 
 safe_shell_chars = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -22,6 +23,18 @@ def shell_escape(s):
         return s
 
 
+_size_re = re.compile(r'^([0-9]+)([kmgt]?)b?$')
+
+
+def parse_size(size):
+    """Parse a size like '512m' or '2g' into a number of bytes.
+    """
+    m = _size_re.match(size.strip().lower())
+    if m is None:
+        raise ValueError("Invalid size %r" % size)
+    return int(m.group(1), 10) * 1024 ** ' kmgt'.index(m.group(2) or ' ')
+
+
 class LoggingDateFormatter(logging.Formatter):
     """Formatter that puts milliseconds in the timestamp.
     """
@@ -0,0 +1,113 @@
+import logging
+import signal
+import threading
+
+from .tasks import TaskQueues
+
+
+__all__ = ['WorkerPool']
+
+
+# Delay before restarting a worker that failed
+RESTART_DELAY = 5.0
+
+
+class _TrackingChannel(object):
+    """Wraps a channel to record whether the current task was acked.
+    """
+    def __init__(self, channel):
+        self._channel = channel
+        self.answered = False
+
+    def basic_ack(self, *args, **kwargs):
+        self.answered = True
+        return self._channel.basic_ack(*args, **kwargs)
+
+    def basic_nack(self, *args, **kwargs):
+        self.answered = True
+        return self._channel.basic_nack(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class WorkerPool(object):
+    """Processes tasks from a queue with several concurrent workers.
+
+    pika connections can't be shared between threads, so each worker thread
+    has its own `TaskQueues` (connection and channel, with a prefetch count
+    of 1), and acks the tasks it got on its own channel.
+
+    `make_callback()` is called once in each worker thread, and should return
+    the callback handling the tasks; this is where per-worker resources are
+    created. `consume` is the `TaskQueues` method to use, for example
+    `TaskQueues.consume_build_tasks`.
+
+    If the callback raises an exception without having acked its task, the
+    task is nacked: it is requeued once, and dropped if it fails again. The
+    worker goes on with the next task. If a worker fails otherwise (for
+    example losing its connection), it is restarted after a delay; the other
+    workers are not affected.
+
+    On SIGTERM or SIGINT, the workers stop taking new tasks, and `run()`
+    returns once the tasks in progress are done.
+    """
+    def __init__(self, nb_workers, consume, make_callback):
+        self.nb_workers = nb_workers
+        self.consume = consume
+        self.make_callback = make_callback
+        self.stopping = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping.is_set():
+            logging.info("Stopping, waiting for tasks in progress")
+        self.stopping.set()
+
+    @staticmethod
+    def _safe_callback(callback):
+        def wrapper(channel, method, properties, body):
+            channel = _TrackingChannel(channel)
+            try:
+                callback(channel, method, properties, body)
+            except Exception:
+                logging.exception("Error processing task %r", body)
+                if not channel.answered:
+                    requeue = not method.redelivered
+                    logging.warning("%s task %r",
+                                    "Requeuing" if requeue else "Dropping",
+                                    body)
+                    channel.basic_nack(delivery_tag=method.delivery_tag,
+                                       requeue=requeue)
+        return wrapper
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                callback = self._safe_callback(self.make_callback())
+                tasks = TaskQueues()
+                try:
+                    self.consume(tasks, callback, self.stopping.is_set)
+                finally:
+                    tasks.close()
+            except Exception:
+                logging.exception("Worker failed, restarting in %d seconds",
+                                  RESTART_DELAY)
+                self.stopping.wait(RESTART_DELAY)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        threads = []
+        for i in range(self.nb_workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='worker-%d' % i)
+            thread.start()
+            threads.append(thread)
+        logging.info("Started %d workers", self.nb_workers)
+
+        # Join with a timeout, so that the main thread gets the signals
+        while threads:
+            threads[0].join(1.0)
+            threads = [t for t in threads if t.is_alive()]
+        logging.info("All workers stopped")
@@ -100,6 +100,14 @@ DATABASES = {
 }
 
 
+# Cache, shared by the web application and the fetcher if set to a shared
+# backend, e.g. CACHE_URL=memcache://memcached:11211
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+from common import metrics
+from common.docker import DockerError
+
+
+class ImageCache(object):
+    """Keeps experiment images on the Docker daemon between runs.
+
+    Instead of removing the image after each run, images are kept until
+    their total size goes over `max_size` bytes; then the least recently used
+    ones are removed first. Images used by runs in progress are never
+    removed.
+
+    Sizes are the ones reported by the daemon when inspecting the images,
+    which count shared layers once per image, so this overestimates the
+    actual disk usage.
+
+    An image is marked while it is being removed, and `acquire()` waits for
+    the removal to finish, so a run never starts with an image that is about
+    to disappear; it will see it missing and pull it again.
+    """
+    def __init__(self, docker_client, max_size, prefix):
+        self.docker_client = docker_client
+        self.max_size = max_size
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._evicted = threading.Condition(self._lock)
+        self._in_use = {}
+        self._last_used = {}
+        self._evicting = set()
+
+    def _image_size(self, image):
+        info = self.docker_client.inspect_image(image)
+        if info is None:
+            return None
+        return info['Size']
+
+    def acquire(self, image):
+        """Mark an image as being used by a run.
+
+        Returns True if the image was already present.
+        """
+        with self._lock:
+            while image in self._evicting:
+                self._evicted.wait()
+            self._in_use[image] = self._in_use.get(image, 0) + 1
+            self._last_used[image] = time.time()
+        try:
+            present = self._image_size(image) is not None
+        except Exception:
+            with self._lock:
+                self._decrement(image)
+            raise
+        if present:
+            metrics.counter('image_cache_hits').inc()
+        else:
+            metrics.counter('image_cache_misses').inc()
+        logging.info("Image %s %s", image,
+                     "in cache" if present else "not in cache, will pull")
+        return present
+
+    def release(self, image):
+        """Mark an image as no longer used by a run, and evict images.
+        """
+        with self._lock:
+            self._decrement(image)
+            self._last_used[image] = time.time()
+        self.evict()
+
+    def _decrement(self, image):
+        self._in_use[image] -= 1
+        if not self._in_use[image]:
+            del self._in_use[image]
+
+    def _list_images(self):
+        return [tag for tag in self.docker_client.list_images()
+                if tag.startswith(self.prefix)]
+
+    def evict(self):
+        """Remove least recently used images until under the size limit.
+        """
+        images = []
+        total = 0
+        for image in self._list_images():
+            if image.endswith(':latest'):
+                image = image[:-7]
+            size = self._image_size(image)
+            if size is None:
+                continue
+            with self._lock:
+                # Images we haven't seen used since we started go first
+                last_used = self._last_used.get(image, 0)
+            images.append((last_used, size, image))
+            total += size
+
+        images.sort()
+        for _, size, image in images:
+            if total <= self.max_size:
+                break
+            with self._lock:
+                if image in self._in_use or image in self._evicting:
+                    continue
+                self._evicting.add(image)
+                self._last_used.pop(image, None)
+            try:
+                self.docker_client.remove_image(image)
+            except DockerError as e:
+                logging.warning("Couldn't evict image %s: %s", image, e)
+                continue
+            finally:
+                with self._lock:
+                    self._evicting.discard(image)
+                    self._evicted.notify_all()
+            logging.info("Evicted image %s (%d bytes)", image, size)
+            metrics.counter('image_cache_evictions').inc()
+            total -= size
@@ -1,51 +1,92 @@
 from common import database
 from common import TaskQueues, get_object_store
-from common.utils import setup_logging, shell_escape
+from common import metrics
+from common.docker import DockerClient, DockerError
+from common.logwriter import BufferedLogWriter, notify
+from common.process import run_container_and_log
+from common.filecache import get_file_cache
+from common.utils import parse_size, setup_logging, shell_escape
+from common.workers import WorkerPool
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
 from hashlib import sha256
 import logging
 import os
-import shutil
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import functions
-import subprocess
-import tempfile
+import threading
+import time
+
+from .images import ImageCache
+from .resources import ResourceBudget, host_memory
 
 
 SQLSession = None
-object_store = None
+budget = None
+image_cache = None
+staging_pool = None
+docker_client = None
 
 
 # IP as understood by Docker daemon, not this container
 DOCKER_REGISTRY = os.environ.get('REGISTRY', 'localhost:5000')
 
 
-def run_cmd_and_log(session, run_id, cmd):
-    proc = subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    proc.stdin.close()
-    for line in iter(proc.stdout.readline, b''):
-        line = line.decode('utf-8', 'replace')
-        logging.info("> %s", line)
-        session.add(database.RunLogLine(
-            run_id=run_id,
-            line=line.rstrip()))
-        session.commit()
-    return proc.wait()
+def _size_from_env(name, default=None):
+    value = os.environ.get(name)
+    if value:
+        return parse_size(value)
+    return default
+
 
+# Resources reserved for each run, and enforced with `docker create` flags
+RUN_LIMITS = {
+    'cpus': float(os.environ.get('RUN_CPUS', '1')),
+    'memory': _size_from_env('RUN_MEMORY', parse_size('2g')),
+    'disk': _size_from_env('RUN_DISK'),
+}
 
-def run_request(channel, method, _properties, body):
+
+def run_request(object_store, channel, method, _properties, body):
     """Process a run task.
 
     Lookup a run in the database, get the input files from S3, then do the run
     from the Docker image, upload the log and the output files.
+
+    The run only starts once its resources fit in the runner's budget.
     """
     body = body.decode('ascii')
     logging.info("Run request received: %r", body)
 
-    # Look up the run in the database
+    received = time.time()
     session = SQLSession()
+    try:
+        with budget.reserve(RUN_LIMITS):
+            start = time.time()
+            metrics.timer('run_admission_wait').observe(start - received)
+            try:
+                _run(session, object_store, channel, method, body)
+            finally:
+                # Failed runs are timed too
+                metrics.timer('run_execution').observe(time.time() - start)
+    finally:
+        session.close()
+    metrics.log_metrics()
+
+
+def _timestamp(dt):
+    """Turn a datetime from the database into a Unix timestamp.
+
+    Naive datetimes are in UTC, like Django stores them.
+    """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def _run(session, object_store, channel, method, body):
+    # Look up the run in the database
     exp = joinedload(database.Run.experiment)
     run = (session.query(database.Run)
            .options(joinedload(database.Run.parameter_values),
@@ -65,29 +106,48 @@ def run_request(channel, method, _properties, body):
         logging.warning("Starting run which has already been started")
     else:
         run.started = functions.now()
+        notify(session, 'run', run.id)
         session.commit()
+        # 'started' is only a date, measure from now
+        if run.submitted is not None:
+            metrics.timer('run_queue_wait').observe(
+                time.time() - _timestamp(run.submitted))
 
     # Remove previous info
-    run.log[:] = []
-    run.output_files[:] = []
+    log = BufferedLogWriter(SQLSession, object_store, 'run', run.id)
 
     def set_error(msg):
         logging.warning("Got error: %s", msg)
+        try:
+            # The log might have been closed already, if that's what failed
+            if not log.closed:
+                log.write(msg)
+            log.close()
+        except Exception:
+            logging.exception("Error writing log")
         run.done = functions.now()
-        session.add(database.RunLogLine(run_id=run.id, line=msg))
+        notify(session, 'run', run.id)
         session.commit()
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
+    try:
+        log.clear()
+    except Exception:
+        logging.exception("Error removing previous log")
+        return set_error("Internal error!")
+    run.output_files[:] = []
+
     if run.experiment.status != database.Status.BUILT:
         return set_error("Experiment to run is not BUILT")
 
-    # Make build directory
-    directory = tempfile.mkdtemp('build_%s' % run.experiment_hash)
-
     container = None
     fq_image_name = '%s/%s' % (DOCKER_REGISTRY, run.experiment.docker_image)
+    image_acquired = False
 
     try:
+        image_present = image_cache.acquire(fq_image_name)
+        image_acquired = True
+
         # Get list of parameters
         params = {}
         params_unset = set()
@@ -126,92 +186,88 @@ def run_request(channel, method, _properties, body):
         logging.info("Using %d input files: %s", len(inputs),
                      ", ".join(f.name for f, p in inputs))
 
+        if not image_present:
+            docker_client.pull(fq_image_name)
+
         # Create container
-        container = 'run_%s' % body
-        logging.info("Creating container %s with image %s",
-                     container, run.experiment.docker_image)
+        logging.info("Creating container run_%s with image %s",
+                     body, run.experiment.docker_image)
         # Turn parameters into a command-line
         cmdline = []
         for k, v in params.items():
             if k.startswith('cmdline_'):
                 i = k[8:]
                 cmdline.extend(['cmd', v, 'run', i])
-        cmdline = ['docker', 'create', '-i', '--name', container,
-                   '--', fq_image_name] + cmdline
         logging.info('$ %s', ' '.join(shell_escape(a) for a in cmdline))
-        subprocess.check_call(cmdline)
-
-        for input_file, path in inputs:
-            local_path = os.path.join(directory, 'input_%s' % input_file.hash)
-
-            # Download file from S3
-            logging.info("Downloading input file: %s, %s, %d bytes",
-                         input_file.name, input_file.hash, input_file.size)
-            object_store.download_file('inputs', input_file.hash, local_path)
-
-            # Put file in container
-            logging.info("Copying file to container")
-            subprocess.check_call(['docker', 'cp', '--',
-                                   local_path,
-                                   '%s:%s' % (container, path)])
-
-            # Remove local file
-            os.remove(local_path)
+        container = docker_client.create_container(
+            fq_image_name, cmdline, name='run_%s' % body,
+            cpus=RUN_LIMITS['cpus'], memory=RUN_LIMITS['memory'],
+            disk=RUN_LIMITS['disk'])
+
+        # Download the input files and put them in the container, in
+        # parallel
+        futures = [staging_pool.submit(_stage_input, container,
+                                       input_file, path)
+                   for input_file, path in inputs]
+        failed = []
+        for future, (input_file, path) in zip(futures, inputs):
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Error getting input file %s",
+                                  input_file.name)
+                failed.append(input_file.name)
+        if failed:
+            return set_error("Couldn't get input files: %s" %
+                             ", ".join(failed))
 
         # Start container using parameters
         logging.info("Starting container")
         try:
-            ret = run_cmd_and_log(session, run.id,
-                                  ['docker', 'start', '-ai', '--', container])
-        except IOError:
-            return set_error("Got IOError running experiment")
+            ret = run_container_and_log(log, docker_client, container)
+        except (IOError, DockerError) as e:
+            logging.warning("Error running container: %s", e)
+            return set_error("Got an error running experiment")
         if ret != 0:
             return set_error("Error: Docker returned %d" % ret)
         run.done = functions.now()
 
-        # Get output files
-        for path in run.experiment.paths:
-            if path.is_output:
-                local_path = os.path.join(directory, 'output_%s' % path.name)
-
-                # Copy file out of container
-                logging.info("Getting output file %s", path.name)
-                ret = subprocess.call(['docker', 'cp', '--',
-                                       '%s:%s' % (container, path.path),
-                                       local_path])
-                if ret != 0:
-                    logging.warning("Couldn't get output %s", path.name)
-                    session.add(database.RunLogLine(
-                        run_id=run.id,
-                        line="Couldn't get output %s" % path.name))
-                    continue
-
-                with open(local_path, 'rb') as fp:
-                    # Hash it
-                    hasher = sha256()
-                    chunk = fp.read(4096)
-                    while chunk:
-                        hasher.update(chunk)
-                        chunk = fp.read(4096)
-                    filehash = hasher.hexdigest()
-
-                    # Rewind it
-                    filesize = fp.tell()
-                    fp.seek(0, 0)
-
-                    # Upload file to S3
-                    logging.info("Uploading file, size: %d bytes" % filesize)
-                    object_store.upload_fileobj('outputs', filehash, fp)
-
-                # Add OutputFile to database
-                run.output_files.append(
-                    database.OutputFile(hash=filehash, name=path.name,
-                                        size=filesize))
-
-                # Remove local file
-                os.remove(local_path)
+        # Outputs that earlier runs of this experiment produced, likely to
+        # be the same again
+        produced = set(
+            name for name, in (
+                session.query(database.OutputFile.name)
+                .join(database.Run,
+                      database.OutputFile.run_id == database.Run.id)
+                .filter(database.Run.experiment_hash == run.experiment_hash)
+                .filter(database.Run.id != run.id)
+                .distinct()))
+
+        # Get output files, in parallel
+        outputs = [path for path in run.experiment.paths if path.is_output]
+        futures = [staging_pool.submit(_collect_output, container, path,
+                                       path.name in produced)
+                   for path in outputs]
+        for future, path in zip(futures, outputs):
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception("Error getting output %s", path.name)
+                result = None
+            if result is None:
+                logging.warning("Couldn't get output %s", path.name)
+                log.write("Couldn't get output %s" % path.name)
+                continue
+            filehash, filesize = result
+
+            # Add OutputFile to database
+            run.output_files.append(
+                database.OutputFile(hash=filehash, name=path.name,
+                                    size=filesize))
 
         # ACK
+        log.close()
+        notify(session, 'run', run.id)
         session.commit()
         channel.basic_ack(delivery_tag=method.delivery_tag)
         logging.info("Done!")
@@ -226,13 +282,82 @@ def run_request(channel, method, _properties, body):
             # NACK the task in RabbitMQ
             channel.basic_nack(delivery_tag=method.delivery_tag)
     finally:
+        # Write remaining log lines
+        try:
+            log.close()
+        except Exception:
+            logging.exception("Error writing log")
         # Remove container if created
         if container is not None:
-            subprocess.call(['docker', 'rm', '-f', '--', container])
-        # Remove image
-        subprocess.call(['docker', 'rmi', '--', fq_image_name])
-        # Remove build directory
-        shutil.rmtree(directory)
+            try:
+                docker_client.remove_container(container, force=True)
+            except DockerError as e:
+                logging.warning("Couldn't remove container: %s", e)
+        # Keep image for the next runs, up to the cache size
+        if image_acquired:
+            image_cache.release(fq_image_name)
+
+
+_staging = threading.local()
+
+
+def _staging_stores():
+    """Get the object store and file cache of the current staging thread.
+
+    boto3 resources can't be shared between threads, so each staging thread
+    makes its own, instead of using the ones of the run's worker.
+    """
+    if not hasattr(_staging, 'object_store'):
+        _staging.object_store = get_object_store()
+        _staging.file_cache = get_file_cache(_staging.object_store)
+    return _staging.object_store, _staging.file_cache
+
+
+def _stage_input(container, input_file, path):
+    """Stream an input file into the container.
+    """
+    _, file_cache = _staging_stores()
+    logging.info("Copying input file to container: %s, %s, %d bytes",
+                 input_file.name, input_file.hash, input_file.size)
+    with file_cache.open('inputs', input_file.hash) as (fp, size):
+        docker_client.put_file(container, path, fp, size)
+
+
+def _collect_output(container, path, produced_before):
+    """Stream an output file out of the container, hashing and uploading it.
+
+    If earlier runs produced this output, it is hashed first, and not
+    uploaded if the object store already has that content.
+
+    Returns `(hash, size)`, or None if the container doesn't have the file.
+    """
+    object_store, _ = _staging_stores()
+    logging.info("Getting output file %s", path.name)
+    try:
+        if produced_before:
+            with docker_client.get_file(container, path.path) as (fp, size):
+                hasher = sha256()
+                chunk = fp.read(1 << 20)
+                while chunk:
+                    hasher.update(chunk)
+                    chunk = fp.read(1 << 20)
+            filehash = hasher.hexdigest()
+            if object_store.skip_upload('outputs', filehash, size):
+                return filehash, size
+        with docker_client.get_file(container, path.path) as (fp, _):
+            filehash, filesize = object_store.upload_hashed('outputs', fp)
+    except DockerError as e:
+        logging.info("Can't get output %s: %s", path.name, e)
+        return None
+    logging.info("Uploaded output file %s, size: %d bytes",
+                 path.name, filesize)
+    return filehash, filesize
+
+
+def make_worker():
+    # boto3 resources can't be shared between threads; this one is for the
+    # logs, the staging threads have their own
+    return functools.partial(run_request, get_object_store())
 
 
 def main():
@@ -242,12 +367,38 @@ def main():
     global SQLSession
     engine, SQLSession = database.connect()
 
-    # AMQP
-    tasks = TaskQueues()
-
-    # Object storage
-    global object_store
-    object_store = get_object_store()
+    # Resources available to the runs
+    global budget
+    cpus = float(os.environ.get('RUNNER_CPUS') or os.cpu_count())
+    budget = ResourceBudget(
+        cpus=cpus,
+        memory=_size_from_env('RUNNER_MEMORY', host_memory()),
+        disk=_size_from_env('RUNNER_DISK'))
+    logging.info("Resource budget: %r, per run: %r", budget.total, RUN_LIMITS)
+
+    # Connections to the Docker daemon, shared by all the runs
+    global docker_client
+    docker_client = DockerClient()
+
+    # Experiment images kept between runs
+    global image_cache
+    image_cache = ImageCache(
+        docker_client,
+        _size_from_env('RUNNER_IMAGE_CACHE_SIZE', parse_size('20g')),
+        '%s/rpuz_exp_' % DOCKER_REGISTRY)
+
+    # Threads copying input and output files, shared by all the runs
+    global staging_pool
+    staging_pool = ThreadPoolExecutor(
+        int(os.environ.get('RUNNER_STAGING_THREADS', '8'), 10),
+        thread_name_prefix='staging')
+
+    # Enough workers to fill the budget
+    nb_workers = os.environ.get('RUNNER_WORKERS')
+    if nb_workers:
+        nb_workers = int(nb_workers, 10)
+    else:
+        nb_workers = max(1, int(cpus // RUN_LIMITS['cpus']))
 
     logging.info("Ready, listening for requests")
-    tasks.consume_run_tasks(run_request)
+    WorkerPool(nb_workers, TaskQueues.consume_run_tasks, make_worker).run()
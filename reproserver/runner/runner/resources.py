@@ -0,0 +1,48 @@
+import contextlib
+import os
+import threading
+
+
+def host_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ResourceBudget(object):
+    """Limits the resources used by concurrent runs.
+
+    Each run reserves a number of CPUs and an amount of memory and disk; a run
+    is only admitted when its reservation fits in what's left of the budget.
+    A total of None means there is no limit on that resource.
+    """
+    RESOURCES = ('cpus', 'memory', 'disk')
+
+    def __init__(self, cpus=None, memory=None, disk=None):
+        self.total = {'cpus': cpus, 'memory': memory, 'disk': disk}
+        self.used = dict((k, 0) for k in self.RESOURCES)
+        self._cond = threading.Condition()
+
+    def _fits(self, request):
+        return all(self.total[k] is None or
+                   self.used[k] + (request.get(k) or 0) <= self.total[k]
+                   for k in self.RESOURCES)
+
+    @contextlib.contextmanager
+    def reserve(self, request):
+        """Wait until `request` fits in the budget and reserve it.
+        """
+        for k in self.RESOURCES:
+            if (self.total[k] is not None and
+                    (request.get(k) or 0) > self.total[k]):
+                raise ValueError("Run requests more %s than the total "
+                                 "budget" % k)
+        with self._cond:
+            self._cond.wait_for(lambda: self._fits(request))
+            for k in self.RESOURCES:
+                self.used[k] += request.get(k) or 0
+        try:
+            yield
+        finally:
+            with self._cond:
+                for k in self.RESOURCES:
+                    self.used[k] -= request.get(k) or 0
+                self._cond.notify_all()
@@ -0,0 +1,109 @@
+"""Benchmark of the object store transfers.
+
+Uploads then downloads a file of random data with a single PUT and GET (how
+`upload_fileobj` used to work), then with the managed transfers of
+`ObjectStore` for each combination of part size and concurrency, and reports
+the throughput of each.
+
+Uses the S3 settings from the environment (S3_URL, S3_KEY, S3_SECRET,
+S3_BUCKET_PREFIX); the objects are written under tmp/ in the outputs bucket
+and deleted afterwards.
+
+    python scripts/bench_objectstore.py --size 256m \\
+        --part-sizes 8m,32m --concurrency 1,4,10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from common.objectstore import ObjectStore  # noqa: E402
+from common.utils import parse_size  # noqa: E402
+
+
+BUCKET = 'outputs'
+
+
+def bench_single(store, filename, key):
+    client = store.s3.meta.client
+    bucket = store.bucket_name(BUCKET)
+    start = time.time()
+    with open(filename, 'rb') as fp:
+        client.put_object(Bucket=bucket, Key=key, Body=fp)
+    upload = time.time() - start
+
+    start = time.time()
+    body = client.get_object(Bucket=bucket, Key=key)['Body']
+    with tempfile.TemporaryFile() as fp:
+        chunk = body.read(1 << 20)
+        while chunk:
+            fp.write(chunk)
+            chunk = body.read(1 << 20)
+    download = time.time() - start
+    return upload, download
+
+
+def bench_managed(store, filename, key):
+    start = time.time()
+    with open(filename, 'rb') as fp:
+        store.upload_fileobj(BUCKET, key, fp)
+    upload = time.time() - start
+
+    start = time.time()
+    with tempfile.TemporaryFile() as fp:
+        store.download_fileobj(BUCKET, key, fp)
+    download = time.time() - start
+    return upload, download
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', default='128m',
+                        help="Size of the file to transfer")
+    parser.add_argument('--part-sizes', default='8m,32m',
+                        help="Part sizes to try")
+    parser.add_argument('--concurrency', default='1,4,10',
+                        help="Numbers of transfer threads to try")
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    endpoint_url = os.environ.get('S3_URL') or None
+    bucket_prefix = os.environ['S3_BUCKET_PREFIX']
+
+    with tempfile.NamedTemporaryFile() as data:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            data.write(chunk)
+            remaining -= len(chunk)
+        data.flush()
+
+        runs = [('single PUT/GET', ObjectStore(endpoint_url, bucket_prefix),
+                 bench_single)]
+        for part_size in args.part_sizes.split(','):
+            for concurrency in args.concurrency.split(','):
+                store = ObjectStore(endpoint_url, bucket_prefix,
+                                    part_size=parse_size(part_size),
+                                    max_concurrency=int(concurrency))
+                runs.append(('parts %s x%s' % (part_size, concurrency),
+                             store, bench_managed))
+
+        print("%-20s %15s %15s" % ("", "upload (MB/s)", "download (MB/s)"))
+        for name, store, bench in runs:
+            key = 'tmp/bench-%s' % uuid.uuid4()
+            try:
+                upload, download = bench(store, data.name, key)
+            finally:
+                store.delete(BUCKET, key)
+            print("%-20s %15.1f %15.1f" % (
+                name, size / upload / 1e6, size / download / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark of the short ID codecs.
+
+Compares the time to encode and decode IDs the way the web application used
+to (a new `MultiShortIDs` for each ID, shuffling the characters again), one
+at a time with the codec shared by the process, and in batches with
+`encode_many()` and `decode_many()`.
+
+    python scripts/bench_shortid.py --ids 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from common import shortid  # noqa: E402
+
+
+SALT = 'benchmark salt'
+
+
+def bench_new_codec(nbs):
+    start = time.time()
+    encoded = [shortid.ShortIDs('upload' + SALT).encode(nb) for nb in nbs]
+    encode = time.time() - start
+    start = time.time()
+    decoded = [shortid.ShortIDs('upload' + SALT).decode(s) for s in encoded]
+    decode = time.time() - start
+    assert decoded == nbs
+    return encode, decode
+
+
+def bench_shared(nbs):
+    short_ids = shortid.get_short_ids(SALT)
+    start = time.time()
+    encoded = [short_ids.encode('upload', nb) for nb in nbs]
+    encode = time.time() - start
+    start = time.time()
+    decoded = [short_ids.decode('upload', s) for s in encoded]
+    decode = time.time() - start
+    assert decoded == nbs
+    return encode, decode
+
+
+def bench_batch(nbs):
+    short_ids = shortid.get_short_ids(SALT)
+    start = time.time()
+    encoded = short_ids.encode_many('upload', nbs)
+    encode = time.time() - start
+    start = time.time()
+    decoded = short_ids.decode_many('upload', encoded)
+    decode = time.time() - start
+    assert decoded == nbs
+    return encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ids', type=int, default=100000)
+    parser.add_argument('--start', type=int, default=1,
+                        help="First ID (bigger IDs have more characters)")
+    args = parser.parse_args()
+
+    nbs = list(range(args.start, args.start + args.ids))
+    print("%-18s %14s %14s" % ("", "encode (IDs/s)", "decode (IDs/s)"))
+    for name, bench in [('new codec per ID', bench_new_codec),
+                        ('shared codec', bench_shared),
+                        ('batch', bench_batch)]:
+        encode, decode = bench(nbs)
+        print("%-18s %14.0f %14.0f" % (
+            name, len(nbs) / encode, len(nbs) / decode))
+
+
+if __name__ == '__main__':
+    main()
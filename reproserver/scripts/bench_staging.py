@@ -0,0 +1,108 @@
+"""Benchmark of the input staging and output collection of a run.
+
+Puts a number of input files in the object store, then for each number of
+staging threads, copies them into a container the way the runner does for a
+run request (download through an empty file cache, then copy into the
+container), and collects them back as outputs (copy out, hash, upload).
+Reports the time each phase takes for the whole request.
+
+Needs the runner's environment: the S3 settings (S3_URL, S3_KEY, S3_SECRET,
+S3_BUCKET_PREFIX) and a Docker daemon (DOCKER_HOST).
+
+    python scripts/bench_staging.py --files 50 --size 4m --threads 1,4,8
+"""
+
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'runner'))
+
+from common import get_object_store  # noqa: E402
+from common.docker import DockerClient  # noqa: E402
+from common.utils import parse_size  # noqa: E402
+from runner import main as runner  # noqa: E402
+
+
+InputFile = collections.namedtuple('InputFile', ['name', 'hash', 'size'])
+Path = collections.namedtuple('Path', ['name', 'path'])
+
+
+def stage(pool, container, inputs, outputs):
+    start = time.time()
+    futures = [pool.submit(runner._stage_input, container, input_file, path)
+               for input_file, path in inputs]
+    for future in futures:
+        future.result()
+    staging = time.time() - start
+
+    start = time.time()
+    futures = [pool.submit(runner._collect_output, container, path, False)
+               for path in outputs]
+    results = [future.result() for future in futures]
+    collecting = time.time() - start
+    assert all(result is not None for result in results)
+    return staging, collecting, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--size', default='4m', help="Size of each file")
+    parser.add_argument('--threads', default='1,4,8',
+                        help="Numbers of staging threads to try")
+    parser.add_argument('--image', default='busybox',
+                        help="Image of the container")
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    object_store = get_object_store()
+    runner.docker_client = client = DockerClient()
+    if client.inspect_image(args.image) is None:
+        client.pull(args.image)
+
+    # Random inputs, named by their hash like the web application does
+    inputs = []
+    for i in range(args.files):
+        data = os.urandom(size)
+        filehash = sha256(data).hexdigest()
+        object_store.upload_fileobj('inputs', filehash, io.BytesIO(data))
+        inputs.append((InputFile('input%d' % i, filehash, size),
+                       '/tmp/input%d' % i))
+    outputs = [Path(f.name, path) for f, path in inputs]
+
+    cache_dir = tempfile.mkdtemp(prefix='bench_staging_')
+    os.environ['CACHE_DIR'] = cache_dir
+    container = client.create_container(args.image, ['true'])
+    uploaded = set()
+    try:
+        print("%8s %12s %14s" % ("threads", "staging (s)", "collecting (s)"))
+        for threads in [int(n) for n in args.threads.split(',')]:
+            # Start from an empty cache each time
+            shutil.rmtree(cache_dir)
+            os.mkdir(cache_dir)
+            with ThreadPoolExecutor(threads) as pool:
+                staging, collecting, results = stage(pool, container, inputs,
+                                                     outputs)
+            uploaded.update(filehash for filehash, _ in results)
+            print("%8d %12.2f %14.2f" % (threads, staging, collecting))
+    finally:
+        client.remove_container(container, force=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for input_file, _ in inputs:
+            object_store.delete('inputs', input_file.hash)
+        for filehash in uploaded:
+            object_store.delete('outputs', filehash)
+
+
+if __name__ == '__main__':
+    main()
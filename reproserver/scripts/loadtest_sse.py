@@ -0,0 +1,161 @@
+"""Load test of the Server-Sent Events endpoints.
+
+Opens an increasing number of concurrent watchers on an event stream (for
+example `/events/build/<upload short id>`) of a running web server, and keeps
+them open. For each step, reports how many watchers got their stream, the
+time it took, and how long a plain page takes to load while they are all
+connected, which shows when the web worker runs out of capacity.
+
+    python scripts/loadtest_sse.py http://localhost:8000 \\
+        /events/build/<short id> --steps 50,100,200,500
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    import httplib
+    from urlparse import urlparse
+
+
+class Watcher(threading.Thread):
+    """Reads an event stream until told to stop.
+
+    Getting nothing from the server for `read_timeout` seconds (which should
+    be longer than the server's keepalive interval), or the stream ending
+    early, counts as a failure.
+    """
+    def __init__(self, host, port, path, timeout, read_timeout, stop):
+        super(Watcher, self).__init__()
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.stop = stop
+        self.connected = threading.Event()
+        self.connect_time = None
+        self.error = None
+        self.events = 0
+        self.sock = None
+
+    def run(self):
+        start = time.time()
+        conn = httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+        try:
+            conn.request('GET', self.path,
+                         headers={'Accept': 'text/event-stream'})
+            # The connection lets go of it if the response isn't keep-alive
+            self.sock = conn.sock
+            response = conn.getresponse()
+            if response.status != 200:
+                raise IOError("Status %d" % response.status)
+            self.connect_time = time.time() - start
+            self.connected.set()
+            # A file that timed out can't be read again, so this ends it
+            self.sock.settimeout(self.read_timeout)
+            while not self.stop.is_set():
+                line = response.fp.readline()
+                if not line:
+                    raise IOError("Stream closed by the server")
+                if line.startswith(b'event:'):
+                    self.events += 1
+        except Exception as e:
+            # Errors caused by close() don't count
+            if not self.stop.is_set():
+                self.error = e
+            self.connected.set()
+        finally:
+            conn.close()
+
+    def close(self):
+        """Interrupt the read, once `stop` is set.
+        """
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def page_time(host, port, path, timeout):
+    start = time.time()
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        conn.getresponse().read()
+    except Exception:
+        return None
+    finally:
+        conn.close()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('server', help="Base URL of the web server")
+    parser.add_argument('stream', help="Path of the event stream")
+    parser.add_argument('--steps', default='10,50,100,200,500',
+                        help="Numbers of concurrent watchers to try")
+    parser.add_argument('--page', default='/about',
+                        help="Page loaded while the watchers are connected")
+    parser.add_argument('--hold', type=float, default=5.0,
+                        help="Seconds to keep the watchers connected")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="Seconds to wait for a stream or page to "
+                             "start")
+    parser.add_argument('--read-timeout', type=float, default=60.0,
+                        help="Seconds without data after which a stream is "
+                             "failed; longer than the server's keepalive "
+                             "interval")
+    args = parser.parse_args()
+
+    url = urlparse(args.server)
+    host, port = url.hostname, url.port or 80
+
+    print("%8s %9s %7s %9s %9s %9s %7s" % (
+        "watchers", "connected", "errors", "p50 (s)", "p95 (s)", "page (s)",
+        "events"))
+    for nb in [int(n) for n in args.steps.split(',')]:
+        stop = threading.Event()
+        watchers = [Watcher(host, port, args.stream, args.timeout,
+                            args.read_timeout, stop)
+                    for _ in range(nb)]
+        for watcher in watchers:
+            watcher.start()
+        for watcher in watchers:
+            watcher.connected.wait(args.timeout)
+        page = page_time(host, port, args.page, args.timeout)
+        time.sleep(args.hold)
+        stop.set()
+        for watcher in watchers:
+            watcher.close()
+        for watcher in watchers:
+            watcher.join(args.timeout)
+
+        times = [w.connect_time for w in watchers
+                 if w.connect_time is not None]
+        errors = sum(1 for w in watchers if w.error is not None)
+        events = sum(w.events for w in watchers)
+        print("%8d %9d %7d %9s %9s %9s %7d" % (
+            nb, len(times), errors,
+            '%.3f' % percentile(times, 0.5) if times else '-',
+            '%.3f' % percentile(times, 0.95) if times else '-',
+            '%.3f' % page if page is not None else 'timeout',
+            events))
+
+
+if __name__ == '__main__':
+    main()
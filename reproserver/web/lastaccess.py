@@ -0,0 +1,87 @@
+import atexit
+from datetime import timedelta
+from django.db import connection
+from django.utils import timezone
+import logging
+import threading
+
+from web.models import Experiment
+
+
+__all__ = ['touch', 'flush']
+
+
+class AccessTracker(object):
+    """Updates `Experiment.last_access` in batches.
+
+    Instead of an UPDATE per page view, accesses are recorded in memory,
+    coalesced per experiment, and written out with a single UPDATE every
+    `interval` seconds, from a background timer. Experiments whose
+    `last_access` is less than `threshold` old are not written again, since
+    `last_access` is only used to find experiments that are no longer used.
+    """
+    def __init__(self, interval=30.0, threshold=timedelta(minutes=5)):
+        self.interval = interval
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._pending = set()
+        # Last time we wrote each experiment, to skip it entirely
+        self._written = {}
+        self._timer = None
+
+    def touch(self, experiment_hash):
+        """Record an access to an experiment.
+        """
+        now = timezone.now()
+        with self._lock:
+            written = self._written.get(experiment_hash)
+            if written is not None and now - written < self.threshold:
+                return
+            self._pending.add(experiment_hash)
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Write the recorded accesses now.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, set()
+            if not pending:
+                return
+            now = timezone.now()
+            if len(self._written) > 10000:
+                self._written.clear()
+            for experiment_hash in pending:
+                self._written[experiment_hash] = now
+        updated = (Experiment.objects
+                   .filter(hash__in=pending,
+                           last_access__lt=now - self.threshold)
+                   .update(last_access=now))
+        logging.info("Updated last access of %d/%d experiments",
+                     updated, len(pending))
+
+    def _on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Error updating last access")
+        finally:
+            # This thread's connection is not used for anything else
+            connection.close()
+
+
+_tracker = AccessTracker()
+atexit.register(_tracker.flush)
+
+
+def touch(experiment_hash):
+    _tracker.touch(experiment_hash)
+
+
+def flush():
+    _tracker.flush()
@@ -0,0 +1,208 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+import functools
+import logging
+import os
+import time
+
+from common import TaskQueues, get_object_store
+from common import metrics
+from common.workers import WorkerPool
+from web.models import DirectUpload, Experiment, InputFile, \
+    ProviderImport, Upload
+from web.providers import STALE_TIMEOUT, ProviderError, \
+    get_experiment_from_provider
+
+
+# Don't write the progress to the database more often than this
+PROGRESS_INTERVAL = 1.0
+
+
+def fetch_request(tasks, object_store, channel, method, _properties, body):
+    """Process a fetch task.
+
+    Download the experiment from the provider, then queue its build; or check
+    a file uploaded directly to the object store (body is 'upload/<id>').
+    """
+    body = body.decode('ascii')
+    logging.info("Fetch request received: %r", body)
+    try:
+        if body.startswith('upload/'):
+            _check_upload(object_store, body[7:])
+        else:
+            _fetch(tasks, body)
+    except Exception:
+        logging.exception("Error processing fetch request %r", body)
+        # The connection might be what failed
+        connection.close()
+        _set_error(body)
+    finally:
+        # Don't keep the connection between tasks, it might be gone by then
+        connection.close()
+    channel.basic_ack(delivery_tag=method.delivery_tag)
+    metrics.log_metrics()
+
+
+def _set_error(body):
+    """Mark an import or upload as failed after an unexpected error.
+    """
+    try:
+        if body.startswith('upload/'):
+            DirectUpload.objects.filter(id=int(body[7:])).update(
+                status=DirectUpload.ERROR, error="Internal error",
+                timestamp=timezone.now())
+        else:
+            ProviderImport.objects.filter(id=int(body)).update(
+                status=ProviderImport.ERROR, error="Internal error",
+                timestamp=timezone.now())
+    except Exception:
+        logging.exception("Couldn't record the error for %r", body)
+
+
+def _claim(model, obj, pending, working):
+    """Mark a task as being worked on, unless someone else is doing it.
+
+    A task left in the working status without a heartbeat for
+    `STALE_TIMEOUT` seconds belongs to a worker that died, and is taken over.
+    """
+    stale = timezone.now() - timedelta(seconds=STALE_TIMEOUT)
+    return model.objects.filter(
+        Q(status=pending) | Q(status=working, timestamp__lt=stale),
+        id=obj.id,
+    ).update(status=working, timestamp=timezone.now())
+
+
+def _fetch(tasks, body):
+    imp = ProviderImport.objects.filter(id=int(body)).first()
+    if imp is None:
+        logging.error("Got a fetch request but couldn't get the import from "
+                      "the database (body=%r)", body)
+        return
+    if not _claim(ProviderImport, imp,
+                  ProviderImport.QUEUED, ProviderImport.FETCHING):
+        logging.warning("Import %d is %s, not fetching", imp.id, imp.status)
+        return
+
+    last_update = [0]
+
+    def progress(bytes_done, bytes_total):
+        now = time.time()
+        if now - last_update[0] >= PROGRESS_INTERVAL:
+            last_update[0] = now
+            ProviderImport.objects.filter(id=imp.id).update(
+                bytes_done=bytes_done, bytes_total=bytes_total,
+                timestamp=timezone.now())
+
+    provider, path = imp.provider_key.split('/', 1)
+    try:
+        upload = get_experiment_from_provider(None, imp.submitted_ip,
+                                              provider, path, progress)
+    except ProviderError as e:
+        logging.info("Error fetching %s: %s", imp.provider_key, e)
+        ProviderImport.objects.filter(id=imp.id).update(
+            status=ProviderImport.ERROR, error=str(e),
+            timestamp=timezone.now())
+        return
+    except Exception:
+        logging.exception("Error fetching %s", imp.provider_key)
+        ProviderImport.objects.filter(id=imp.id).update(
+            status=ProviderImport.ERROR,
+            error="Couldn't download the file from the provider",
+            timestamp=timezone.now())
+        return
+
+    ProviderImport.objects.filter(id=imp.id).update(
+        status=ProviderImport.DONE, upload=upload)
+    logging.info("Fetched %s", imp.provider_key)
+
+    # Chain into the build
+    queued = (Experiment.objects
+              .filter(hash=upload.experiment_hash_id, status='1')
+              .update(status='2'))
+    if queued:
+        logging.info("Queuing build of %s", upload.experiment_hash_id)
+        tasks.publish_build_task(upload.experiment_hash_id)
+
+
+def _check_upload(object_store, body):
+    direct_upload = DirectUpload.objects.filter(id=int(body)).first()
+    if direct_upload is None:
+        logging.error("Got an upload check request but couldn't get the "
+                      "upload from the database (body=%r)", body)
+        return
+    if not _claim(DirectUpload, direct_upload,
+                  DirectUpload.PENDING, DirectUpload.CHECKING):
+        logging.warning("Direct upload %d is %s, not checking",
+                        direct_upload.id, direct_upload.status)
+        return
+    bucket, key = direct_upload.bucket, direct_upload.key
+
+    # Read the file back from the object store
+    try:
+        filehash, filesize = object_store.hash_object(bucket, key)
+    except Exception:
+        logging.exception("Error reading direct upload %s/%s", bucket, key)
+        DirectUpload.objects.filter(id=direct_upload.id).update(
+            status=DirectUpload.ERROR, error="Couldn't read the file",
+            timestamp=timezone.now())
+        return
+    if filesize != direct_upload.size or (
+            direct_upload.sha256 and direct_upload.sha256 != filehash):
+        object_store.delete(bucket, key)
+        logging.info("Direct upload %s/%s doesn't match: %d bytes, %s",
+                     bucket, key, filesize, filehash)
+        DirectUpload.objects.filter(id=direct_upload.id).update(
+            status=DirectUpload.ERROR, error="Uploaded file doesn't match",
+            timestamp=timezone.now())
+        return
+
+    # Move it to its content hash, unless we already have it
+    if object_store.exists(bucket, filehash):
+        object_store.delete(bucket, key)
+        logging.info("File exists in storage")
+    else:
+        object_store.rename(bucket, key, filehash)
+        logging.info("Inserted file in storage")
+
+    if bucket == 'inputs':
+        input_file = InputFile.objects.create(
+            hash=filehash, name=direct_upload.filename, size=filesize)
+        DirectUpload.objects.filter(id=direct_upload.id).update(
+            status=DirectUpload.DONE, input_file=input_file,
+            timestamp=timezone.now())
+    else:
+        experiment, _ = Experiment.objects.get_or_create(hash=filehash)
+        upload = Upload.objects.create(
+            experiment_hash=experiment, filename=direct_upload.filename,
+            submitted_ip=direct_upload.submitted_ip)
+        DirectUpload.objects.filter(id=direct_upload.id).update(
+            status=DirectUpload.DONE, upload=upload,
+            timestamp=timezone.now())
+    logging.info("Checked direct upload %s/%s: %s", bucket, key, filehash)
+
+
+def make_worker():
+    # Separate connection to publish the build tasks, the consuming one is
+    # busy in the consume loop; and one object store per thread, boto3
+    # resources can't be shared
+    return functools.partial(fetch_request, TaskQueues(), get_object_store())
+
+
+class Command(BaseCommand):
+    help = ("Downloads experiments from providers and checks files "
+            "uploaded directly to the object store in the background, as "
+            "queued by the web application.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=int(os.environ.get('FETCHER_WORKERS',
+                                                       '4'), 10),
+                            help="Number of concurrent downloads")
+
+    def handle(self, *args, **options):
+        logging.info("Ready, listening for requests")
+        WorkerPool(options['workers'], TaskQueues.consume_fetch_tasks,
+                   make_worker).run()
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from web.models import BuildLogLine, LogSegment, RunLogLine, get_log_store
+
+
+class Command(BaseCommand):
+    help = ("Moves the build and run logs stored one line per row into "
+            "compressed segments in the object store.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segment-lines', type=int, default=5000,
+                            help="Number of lines per segment")
+
+    def handle(self, *args, **options):
+        segment_lines = options['segment_lines']
+        log_store = get_log_store()
+
+        experiments = (BuildLogLine.objects
+                       .values_list('experiment_hash', flat=True)
+                       .distinct())
+        for experiment_hash in experiments:
+            self.migrate_log(log_store, segment_lines, 'build',
+                             experiment_hash,
+                             BuildLogLine.objects
+                             .filter(experiment_hash=experiment_hash),
+                             dict(experiment_hash_id=experiment_hash))
+
+        runs = RunLogLine.objects.values_list('run_id', flat=True).distinct()
+        for run_id in runs:
+            self.migrate_log(log_store, segment_lines, 'run', run_id,
+                             RunLogLine.objects.filter(run_id=run_id),
+                             dict(run_id_id=run_id))
+
+    def migrate_log(self, log_store, segment_lines, kind, owner, rows,
+                    fields):
+        """Move the lines of one log into segments.
+
+        If the log already has segments, it was written again since the
+        upgrade (e.g. the experiment was rebuilt), and the old lines are
+        stale; they are dropped instead.
+        """
+        with transaction.atomic():
+            if LogSegment.objects.filter(**fields).exists():
+                rows.delete()
+                self.stdout.write("Dropped old lines of %s log %s, it was "
+                                  "written again since" % (kind, owner))
+                return
+
+            first_line = 0
+            lines = []
+            values = rows.order_by('id').values_list('line', flat=True)
+            for line in values.iterator():
+                lines.append(line)
+                if len(lines) >= segment_lines:
+                    self.write_segment(log_store, kind, owner, first_line,
+                                       lines, fields)
+                    first_line += len(lines)
+                    lines = []
+            if lines:
+                self.write_segment(log_store, kind, owner, first_line,
+                                   lines, fields)
+                first_line += len(lines)
+
+            rows.delete()
+        self.stdout.write("Moved %d lines of %s log %s" % (
+            first_line, kind, owner))
+
+    def write_segment(self, log_store, kind, owner, first_line, lines,
+                      fields):
+        key = log_store.write_segment(kind, owner, first_line, lines)
+        LogSegment.objects.create(first_line=first_line,
+                                  nb_lines=len(lines), key=key, **fields)
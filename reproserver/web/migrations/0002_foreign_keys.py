@@ -0,0 +1,148 @@
+# Generated by Django 2.1.2 on 2026-10-18 15:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='experiment',
+            name='log',
+        ),
+        migrations.RemoveField(
+            model_name='experiment',
+            name='parameters',
+        ),
+        migrations.RemoveField(
+            model_name='experiment',
+            name='paths',
+        ),
+        migrations.RemoveField(
+            model_name='experiment',
+            name='runs',
+        ),
+        migrations.RemoveField(
+            model_name='experiment',
+            name='uploads',
+        ),
+        migrations.RemoveField(
+            model_name='inputfile',
+            name='run_inputFile',
+        ),
+        migrations.RemoveField(
+            model_name='outputfile',
+            name='run_outputFile',
+        ),
+        migrations.RemoveField(
+            model_name='parametervalue',
+            name='run_parameterValue',
+        ),
+        migrations.RemoveField(
+            model_name='run',
+            name='input_files',
+        ),
+        migrations.RemoveField(
+            model_name='run',
+            name='log',
+        ),
+        migrations.RemoveField(
+            model_name='run',
+            name='output_files',
+        ),
+        migrations.RemoveField(
+            model_name='run',
+            name='parameter_values',
+        ),
+        migrations.RemoveField(
+            model_name='run',
+            name='upload_Run',
+        ),
+        migrations.RemoveField(
+            model_name='runlogline',
+            name='run_RunLogLineß',
+        ),
+        migrations.AlterField(
+            model_name='buildlogline',
+            name='experiment_hash',
+            field=models.ForeignKey(db_column='experiment_hash', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='web.Experiment'),
+        ),
+        migrations.AlterField(
+            model_name='inputfile',
+            name='run_id',
+            field=models.ForeignKey(db_column='run_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='input_files', to='web.Run'),
+        ),
+        migrations.AlterField(
+            model_name='outputfile',
+            name='run_id',
+            field=models.ForeignKey(db_column='run_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='output_files', to='web.Run'),
+        ),
+        migrations.AlterField(
+            model_name='parameter',
+            name='experiment_hash',
+            field=models.ForeignKey(db_column='experiment_hash', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='parameters', to='web.Experiment'),
+        ),
+        migrations.AlterField(
+            model_name='parametervalue',
+            name='run_id',
+            field=models.ForeignKey(db_column='run_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='parameter_values', to='web.Run'),
+        ),
+        migrations.AlterField(
+            model_name='path',
+            name='experiment_hash',
+            field=models.ForeignKey(db_column='experiment_hash', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='paths', to='web.Experiment'),
+        ),
+        migrations.AlterField(
+            model_name='run',
+            name='experiment_hash',
+            field=models.ForeignKey(db_column='experiment_hash', on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='web.Experiment'),
+        ),
+        migrations.AlterField(
+            model_name='run',
+            name='upload_id',
+            field=models.ForeignKey(db_column='upload_id', on_delete=django.db.models.deletion.PROTECT, related_name='runs', to='web.Upload'),
+        ),
+        migrations.AlterField(
+            model_name='runlogline',
+            name='run_id',
+            field=models.ForeignKey(db_column='run_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='web.Run'),
+        ),
+        migrations.AlterField(
+            model_name='upload',
+            name='experiment_hash',
+            field=models.ForeignKey(db_column='experiment_hash', on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='web.Experiment'),
+        ),
+        migrations.AddIndex(
+            model_name='buildlogline',
+            index=models.Index(fields=['experiment_hash', 'id'], name='build_logs_experim_c624be_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inputfile',
+            index=models.Index(fields=['run_id', 'id'], name='input_files_run_id_d6c032_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outputfile',
+            index=models.Index(fields=['run_id', 'id'], name='output_file_run_id_01c64e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='parameter',
+            index=models.Index(fields=['experiment_hash', 'id'], name='parameters_experim_ce2c68_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='parametervalue',
+            index=models.Index(fields=['run_id', 'id'], name='run_paramet_run_id_5c6d16_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='path',
+            index=models.Index(fields=['experiment_hash', 'id'], name='paths_experim_5e3f72_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='runlogline',
+            index=models.Index(fields=['run_id', 'id'], name='run_logs_run_id_9a77d1_idx'),
+        ),
+    ]
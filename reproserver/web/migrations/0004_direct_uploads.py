@@ -0,0 +1,48 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0003_task_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.TextField()),
+                ('key', models.TextField(unique=True)),
+                ('size', models.BigIntegerField()),
+                ('sha256', models.TextField(null=True)),
+                ('filename', models.TextField()),
+                ('status', models.TextField(choices=[('pending', 'Pending'), ('checking', 'Checking'), ('done', 'Done'), ('error', 'Error')], default='pending')),
+                ('error', models.TextField(null=True)),
+                ('submitted_ip', models.TextField(null=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'direct_uploads',
+            },
+        ),
+        migrations.AlterField(
+            model_name='inputfile',
+            name='run_id',
+            field=models.ForeignKey(db_column='run_id', db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='input_files', to='web.Run'),
+        ),
+        migrations.AddField(
+            model_name='directupload',
+            name='input_file',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='web.InputFile'),
+        ),
+        migrations.AddField(
+            model_name='directupload',
+            name='upload',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='web.Upload'),
+        ),
+    ]
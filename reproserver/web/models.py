@@ -1,10 +1,20 @@
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
-from common.shortid import MultiShortIDs
+from common import get_object_store
+from common.logstore import LogStore
+from common.shortid import get_short_ids
 import enum
 import logging
 import os
 
+
+def short_ids():
+    """Get the codec for the IDs in URLs.
+    """
+    return get_short_ids(os.environ['SHORTIDS_SALT'])
+
+
 class Status(enum.Enum):
     ("1", "NOBUILD"),
     ("2","QUEUED"),
@@ -13,6 +23,16 @@ class Status(enum.Enum):
     ("0","ERROR")
 
 
+# Names of the Experiment.status codes
+STATUS_NAMES = {
+    '0': 'ERROR',
+    '1': 'NOBUILD',
+    '2': 'QUEUED',
+    '3': 'BUILDING',
+    '4': 'BUILT',
+}
+
+
 class Experiment(models.Model):
     """Experiments available on the server.
 
@@ -26,16 +46,18 @@ class Experiment(models.Model):
     hash = models.TextField(primary_key=True)
     status = models.TextField(choices = Status, default="1")
     docker_image = models.TextField(null=True)
-    last_access = models.DateTimeField(default=timezone.now())
+    last_access = models.DateTimeField(default=timezone.now)
 
-    uploads = models.ManyToManyField('Upload',related_name='+')
-    runs = models.ManyToManyField('Run', related_name='+')
-    parameters = models.ManyToManyField('Parameter', related_name='+')
-    paths = models.ManyToManyField('Path', related_name='+')
-    log = models.ManyToManyField('BuildLogLine', related_name='+')
+    # Related: uploads, runs, parameters, paths
 
     def get_log(self, from_line=0):
-        return [log.line for log in self.log[from_line:]]
+        return read_log(LogSegment.objects.filter(experiment_hash=self.hash),
+                        from_line)
+
+    def get_log_page(self, cursor=0, limit=None):
+        return read_log_page(
+            LogSegment.objects.filter(experiment_hash=self.hash),
+            cursor, limit)
 
     def __repr__(self):
         return "<Experiment hash=%r, status=%r, docker_image=%r>" % (
@@ -57,29 +79,168 @@ class Upload(models.Model):
     """
     
     filename = models.TextField()
-    experiment_hash = models.ForeignKey(Experiment,unique='True', on_delete=models.CASCADE,related_name="+")
-    
-    # experiment = models.OneToOneField('Experiment', on_delete= models.CASCADE)
-    #back_populates='uploads')
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        on_delete=models.CASCADE,
+                                        related_name='uploads')
     submitted_ip = models.TextField(null=True)
     provider_key = models.TextField(null=True, db_index=True)
     # Since we want a time for everytime its created and dont want to replace the time if modified
-    timestamp = models.DateTimeField(default=timezone.now())
+    timestamp = models.DateTimeField(default=timezone.now)
 
     @property
     def short_id(self):
-        short_ids = MultiShortIDs(os.environ['SHORTIDS_SALT'])
-        return short_ids.encode('uploads', self.id)
+        return short_ids().encode('upload', self.id)
 
     def __repr__(self):
         return ("<Upload id=%d, experiment_hash=%r, filename=%r, "
                 "submitted_ip=%r, timestamp=%r>") % (
-            self.id, self.experiment_hash, self.filename,
+            self.id, self.experiment_hash_id, self.filename,
             self.submitted_ip, self.timestamp)
 
     class Meta:
         db_table = "uploads"
 
+
+class ProviderChecksum(models.Model):
+    """A checksum reported by a provider for an experiment file.
+
+    This lets us recognize a file we already have from its metadata, without
+    downloading it. `algorithm` is 'md5' for content checksums, which are
+    valid across providers, or 'etag:<provider>' for ETags.
+    """
+
+    algorithm = models.TextField()
+    value = models.TextField()
+    size = models.BigIntegerField(null=True)
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        on_delete=models.CASCADE,
+                                        related_name="+")
+
+    def __repr__(self):
+        return ("<ProviderChecksum id=%d, algorithm=%r, value=%r, "
+                "experiment_hash=%r>") % (
+            self.id, self.algorithm, self.value, self.experiment_hash_id)
+
+    class Meta:
+        db_table = "provider_checksums"
+        unique_together = (('algorithm', 'value'),)
+
+
+class ProviderImport(models.Model):
+    """A download of an experiment from a provider.
+
+    Files on providers can be big, so they are downloaded in the background
+    by the fetcher (`manage.py fetch_worker`) rather than during the request.
+    The page shows the progress until `upload` is set.
+    """
+
+    QUEUED = 'queued'
+    FETCHING = 'fetching'
+    DONE = 'done'
+    ERROR = 'error'
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (FETCHING, "Fetching"),
+        (DONE, "Done"),
+        (ERROR, "Error"),
+    ]
+
+    provider_key = models.TextField(unique=True)
+    status = models.TextField(choices=STATUSES, default=QUEUED)
+    bytes_done = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(null=True)
+    error = models.TextField(null=True)
+    submitted_ip = models.TextField(null=True)
+    upload = models.ForeignKey(Upload, null=True, on_delete=models.SET_NULL,
+                               related_name="+")
+    # When the import was queued, last made progress, or failed
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    @property
+    def progress(self):
+        """Percentage downloaded, or None if the size is unknown.
+        """
+        if not self.bytes_total:
+            return None
+        return min(100, self.bytes_done * 100 // self.bytes_total)
+
+    def __repr__(self):
+        return "<ProviderImport id=%d, provider_key=%r, status=%r>" % (
+            self.id, self.provider_key, self.status)
+
+    class Meta:
+        db_table = "provider_imports"
+
+
+class DirectUpload(models.Model):
+    """A file uploaded by the browser straight to the object store.
+
+    The object is at `key` (under `tmp/`) until the fetcher (`manage.py
+    fetch_worker`) has read it back to check its size and hash, and moved it
+    to its content hash. Then `upload` is set for an experiment, or
+    `input_file` for an input file.
+    """
+
+    PENDING = 'pending'
+    CHECKING = 'checking'
+    DONE = 'done'
+    ERROR = 'error'
+    STATUSES = [
+        (PENDING, "Pending"),
+        (CHECKING, "Checking"),
+        (DONE, "Done"),
+        (ERROR, "Error"),
+    ]
+
+    bucket = models.TextField()
+    key = models.TextField(unique=True)
+    size = models.BigIntegerField()
+    # Hash announced by the browser, if any
+    sha256 = models.TextField(null=True)
+    filename = models.TextField()
+    status = models.TextField(choices=STATUSES, default=PENDING)
+    error = models.TextField(null=True)
+    submitted_ip = models.TextField(null=True)
+    upload = models.ForeignKey(Upload, null=True, on_delete=models.SET_NULL,
+                               related_name="+")
+    input_file = models.ForeignKey('InputFile', null=True,
+                                   on_delete=models.SET_NULL,
+                                   related_name="+")
+    # When the upload was completed, or when it was last updated
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    @property
+    def short_id(self):
+        return short_ids().encode('direct_upload', self.id)
+
+    def __repr__(self):
+        return "<DirectUpload id=%d, bucket=%r, key=%r, status=%r>" % (
+            self.id, self.bucket, self.key, self.status)
+
+    class Meta:
+        db_table = "direct_uploads"
+
+
+class OutboxMessage(models.Model):
+    """A task that couldn't be sent to the AMQP broker yet.
+
+    See `web.publisher`; those are sent in the background once the broker is
+    reachable again.
+    """
+
+    queue = models.TextField()
+    body = models.TextField()
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    def __repr__(self):
+        return "<OutboxMessage id=%d, queue=%r, body=%r>" % (
+            self.id, self.queue, self.body)
+
+    class Meta:
+        db_table = "task_outbox"
+
 class Parameter(models.Model):
     """An experiment parameter.
 
@@ -88,9 +249,11 @@ class Parameter(models.Model):
     Those are displayed to the user when running the experiment.
     """
 
-    experiment_hash = models.ForeignKey(Experiment, on_delete=models.CASCADE,related_name="+")
-    # experiment = models.OneToOneField('Experiment', models.CASCADE)
-    
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        db_index=False,
+                                        on_delete=models.CASCADE,
+                                        related_name='parameters')
     name = models.TextField(null=False)
     description = models.TextField()
     optional = models.BooleanField()
@@ -99,20 +262,23 @@ class Parameter(models.Model):
     def __repr__(self):
         return ("<Parameter id=%d, experiment_hash=%r, name=%r, optional=%r, "
                 "default=%r") % (
-            self.id, self.experiment_hash, self.name, self.optional,
+            self.id, self.experiment_hash_id, self.name, self.optional,
             self.default)
     
     class Meta:
         db_table = "parameters"
+        indexes = [models.Index(fields=['experiment_hash', 'id'])]
 
 
 class Path(models.Model):
     """Path to an input/output file in the experiment.
     """
 
-    experiment_hash = models.ForeignKey(Experiment, on_delete=models.CASCADE,related_name="+")
-    # experiment = models.OneToOneField('Experiment', models.CASCADE)
-                              
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        db_index=False,
+                                        on_delete=models.CASCADE,
+                                        related_name='paths')
     is_input = models.BooleanField()
     is_output = models.BooleanField()
     name = models.TextField()
@@ -128,10 +294,11 @@ class Path(models.Model):
         else:
             descr = "(NO FLAG)"
         return "<Path id=%d, experiment_hash=%r, %s, name=%r>" % (
-            self.id, self.experiment_hash, descr, self.name)
+            self.id, self.experiment_hash_id, descr, self.name)
 
     class Meta:
         db_table = "paths"
+        indexes = [models.Index(fields=['experiment_hash', 'id'])]
 
 
 class Run(models.Model):
@@ -141,28 +308,30 @@ class Run(models.Model):
     experiment. It contains logs and the location of output files.
     """
 
-    experiment_hash = models.ForeignKey(Experiment, on_delete=models.CASCADE,related_name="+")
-    # experiment = models.OneToOneField('Experiment',models.CASCADE)
-    
-    upload_id = models.ForeignKey(Upload,on_delete=models.PROTECT,related_name="+")
-    upload_Run = models.OneToOneField('Upload',models.CASCADE)
-    
-    submitted = models.DateTimeField(default=timezone.now())
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        on_delete=models.CASCADE,
+                                        related_name='runs')
+    upload_id = models.ForeignKey(Upload, db_column='upload_id',
+                                  on_delete=models.PROTECT,
+                                  related_name='runs')
+
+    submitted = models.DateTimeField(default=timezone.now)
     started = models.DateField(null=True)
     done = models.DateField(null=True)
 
-    parameter_values = models.ManyToManyField('ParameterValue',related_name="+")
-    input_files = models.ManyToManyField('InputFile',related_name="+")
-
-    log = models.ManyToManyField('RunLogLine',related_name="+")
-    output_files = models.ManyToManyField('OutputFile',related_name="+")
+    # Related: parameter_values, input_files, output_files
 
     @property
     def short_id(self):
-        return short_ids.encode('run', self.id)
+        return short_ids().encode('run', self.id)
 
     def get_log(self, from_line=0):
-        return [log.line for log in self.log[from_line:]]
+        return read_log(LogSegment.objects.filter(run_id=self.id), from_line)
+
+    def get_log_page(self, cursor=0, limit=None):
+        return read_log_page(LogSegment.objects.filter(run_id=self.id),
+                             cursor, limit)
 
     def __repr__(self):
         if self.done:
@@ -173,8 +342,9 @@ class Run(models.Model):
             status = "submitted"
         return ("<Run id=%d, experiment_hash=%r, %s, %d parameters, "
                 "%d inputs, %d outputs>") % (
-            self.id, self.experiment_hash, status, len(self.parameter_values),
-            len(self.input_files), len(self.output_files))
+            self.id, self.experiment_hash_id, status,
+            self.parameter_values.count(), self.input_files.count(),
+            self.output_files.count())
 
     class Meta:
         db_table = "runs"
@@ -182,72 +352,181 @@ class Run(models.Model):
 class BuildLogLine(models.Model):
     """A line of build log.
 
-    FIXME: Storing this in the database is not a great idea.
+    Superseded by `LogSegment`, kept around for the `migrate_logs` command.
     """
 
-    experiment_hash = models.ForeignKey(Experiment, on_delete=models.CASCADE,related_name="+")
-    # experiment = models.OneToOneField('Experiment',models.CASCADE)
-    timestamp = models.DateTimeField(default=timezone.now())
+    experiment_hash = models.ForeignKey(Experiment,
+                                        db_column='experiment_hash',
+                                        db_index=False,
+                                        on_delete=models.CASCADE,
+                                        related_name='+')
+    timestamp = models.DateTimeField(default=timezone.now)
     
     line = models.TextField()
 
     def __repr__(self):
         return "<BuildLogLine id=%d, experiment_hash=%r>" % (
-            self.id, self.experiment_hash)
+            self.id, self.experiment_hash_id)
     
     class Meta:
         db_table = "build_logs"
+        indexes = [models.Index(fields=['experiment_hash', 'id'])]
 
 class RunLogLine(models.Model):
     """A line of run log.
 
-    FIXME: Storing this in the database is not a great idea.
+    Superseded by `LogSegment`, kept around for the `migrate_logs` command.
     """
     
-    run_id = models.ForeignKey(Run, on_delete=models.CASCADE, related_name="+")
-    run_RunLogLineß = models.OneToOneField('Run',models.CASCADE)
-    timestamp = models.DateTimeField(default=timezone.now())
+    run_id = models.ForeignKey(Run, db_column='run_id', db_index=False,
+                               on_delete=models.CASCADE, related_name='+')
+    timestamp = models.DateTimeField(default=timezone.now)
     line = models.TextField()
 
     def __repr__(self):
-        return "<RunLogLine id=%d, run_id=%d>" % (self.id, self.run_id)
+        return "<RunLogLine id=%d, run_id=%d>" % (self.id, self.run_id_id)
 
     class Meta:
         db_table = "run_logs"
+        indexes = [models.Index(fields=['run_id', 'id'])]
+
+
+class LogSegment(models.Model):
+    """A chunk of build or run log.
+
+    The lines are stored compressed in the object store (see
+    `common.logstore`), this is only the index used to find them.
+    """
+
+    experiment_hash = models.ForeignKey(Experiment, null=True,
+                                        db_column='experiment_hash',
+                                        on_delete=models.CASCADE,
+                                        related_name="+")
+    run_id = models.ForeignKey(Run, null=True, db_column='run_id',
+                               on_delete=models.CASCADE, related_name="+")
+    first_line = models.IntegerField()
+    nb_lines = models.IntegerField()
+    key = models.TextField()
+
+    def __repr__(self):
+        return "<LogSegment id=%d, key=%r, first_line=%d, nb_lines=%d>" % (
+            self.id, self.key, self.first_line, self.nb_lines)
+
+    class Meta:
+        db_table = "log_segments"
+        indexes = [
+            models.Index(fields=['experiment_hash', 'first_line']),
+            models.Index(fields=['run_id', 'first_line']),
+        ]
+
+
+_log_store = None
+
+
+def get_log_store():
+    global _log_store
+    if _log_store is None:
+        _log_store = LogStore(get_object_store())
+    return _log_store
+
+
+def read_log(segments, from_line=0):
+    """Get the lines of a log, starting at `from_line`.
+
+    Only the segments holding lines after `from_line` are downloaded.
+    """
+    segments = (segments
+                .annotate(end_line=F('first_line') + F('nb_lines'))
+                .filter(end_line__gt=from_line)
+                .order_by('first_line'))
+    log_store = get_log_store()
+    lines = []
+    for segment in segments:
+        segment_lines = log_store.read_segment(segment.key)
+        lines.extend(segment_lines[max(0, from_line - segment.first_line):])
+    return lines
+
+
+# Maximum number of log lines returned at once
+LOG_PAGE_SIZE = 1000
+
+
+def read_log_page(segments, cursor=0, limit=None):
+    """Get a page of a log, starting at line `cursor`.
+
+    Returns an iterator on at most `limit` lines, and the cursor of the next
+    page. Only the segments overlapping the page are looked up, with range
+    queries on the (owner, first_line) index, and they are downloaded as the
+    lines are consumed; the cost doesn't depend on the length of the log.
+    """
+    if limit is None:
+        limit = LOG_PAGE_SIZE
+    end = cursor + limit
+    segments = segments.annotate(end_line=F('first_line') + F('nb_lines'))
+
+    # The segment holding the line at the cursor, then the following ones
+    page = list(segments.filter(first_line__lte=cursor)
+                .order_by('-first_line')[:1])
+    page = [s for s in page if s.end_line > cursor]
+    page.extend(segments.filter(first_line__gt=cursor, first_line__lt=end)
+                .order_by('first_line'))
+
+    if page:
+        next_cursor = min(end, page[-1].end_line)
+    else:
+        next_cursor = cursor
+
+    def lines():
+        log_store = get_log_store()
+        for segment in page:
+            segment_lines = log_store.read_segment(segment.key)
+            start = max(0, cursor - segment.first_line)
+            stop = min(segment.nb_lines, end - segment.first_line)
+            for line in segment_lines[start:stop]:
+                yield line
+
+    return lines(), next_cursor
 
 
 class ParameterValue(models.Model):
     """A value for a parameter in a run.
     """
-    run_id = models.ForeignKey(Run, on_delete= models.CASCADE,related_name="+")
-    run_parameterValue = models.OneToOneField('Run',models.CASCADE)
+    run_id = models.ForeignKey(Run, db_column='run_id', db_index=False,
+                               on_delete=models.CASCADE,
+                               related_name='parameter_values')
     name = models.TextField()
     value = models.TextField()
 
     def __repr__(self):
         return "<ParameterValue id=%d, run_id=%d, name=%r>" % (
-            self.id, self.run_id, self.name)
+            self.id, self.run_id_id, self.name)
 
     class Meta:
         db_table = "run_parameters"
+        indexes = [models.Index(fields=['run_id', 'id'])]
 
 
 class InputFile(models.Model):
     """An input file for a run.
+
+    Files uploaded directly to the object store have no run until the run is
+    started.
     """
 
     hash = models.TextField()
-    run_id = models.ForeignKey(Run, on_delete=models.CASCADE,related_name="+")
-    run_inputFile = models.OneToOneField('Run',on_delete=models.CASCADE)
+    run_id = models.ForeignKey(Run, db_column='run_id', db_index=False,
+                               null=True, on_delete=models.CASCADE,
+                               related_name='input_files')
     name = models.TextField()
     size = models.IntegerField()
 
     def __repr__(self):
-        return "<InputFile id=%d, run_id=%d, hash=%r, name=%r>" % (
-            self.id, self.run_id, self.hash, self.name)
+        return "<InputFile id=%d, run_id=%r, hash=%r, name=%r>" % (
+            self.id, self.run_id_id, self.hash, self.name)
 
     class Meta:
         db_table = "input_files"
+        indexes = [models.Index(fields=['run_id', 'id'])]
 
 
 class OutputFile(models.Model):
@@ -255,17 +534,19 @@ class OutputFile(models.Model):
     """
 
     hash = models.TextField()
-    run_id = models.ForeignKey(Run, on_delete=models.CASCADE,related_name="+")
-    run_outputFile = models.OneToOneField('Run',on_delete=models.CASCADE)
+    run_id = models.ForeignKey(Run, db_column='run_id', db_index=False,
+                               on_delete=models.CASCADE,
+                               related_name='output_files')
     name = models.TextField()
     size = models.IntegerField()
 
     def __repr__(self):
         return "<OutputFile id=%d, run_id=%d, hash=%r, name=%r>" % (
-            self.id, self.run_id, self.hash, self.name)
+            self.id, self.run_id_id, self.hash, self.name)
 
     class Meta:
         db_table = "output_files"
+        indexes = [models.Index(fields=['run_id', 'id'])]
 
 
 def purge(url=None):
@@ -279,9 +560,6 @@ def purge(url=None):
 def connect(url=None):
     """Connect to the database using an environment variable.
     """
-    global short_ids
-    short_ids = MultiShortIDs(os.environ['SHORTIDS_SALT'])
-
     logging.info("Connecting to SQL database")
     if url is None:
         url = 'postgresql://{user}:{password}@{host}/{database}'.format(
@@ -0,0 +1,117 @@
+from django.conf import settings
+import logging
+import psycopg2
+import psycopg2.extensions
+import select
+import threading
+import time
+import uuid
+
+from common.logstore import NOTIFY_CHANNEL
+
+
+__all__ = ['get_listener']
+
+
+class Listener(object):
+    """Receives the notifications sent by the builder and runner.
+
+    A single background thread per process LISTENs on the Postgres channel,
+    and wakes up the threads waiting for a given key ('build:<hash>' or
+    'run:<id>'). Each key has a version number, incremented on every
+    notification, so that waiters don't miss updates that happen while they
+    are not waiting. The version also changes for every key when the
+    connection is re-established, since notifications might have been missed.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._instance = uuid.uuid4().hex
+        self._generation = 0
+        self._versions = {}
+        self._thread = threading.Thread(target=self._run,
+                                        name='notify-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _version(self, key):
+        return self._generation, self._versions.get(key, 0)
+
+    def version(self, key):
+        with self._cond:
+            return self._version(key)
+
+    def cache_token(self, key):
+        """Get a string identifying the current version of `key`.
+
+        This is unique across processes, so it can be used in keys of a
+        shared cache. Returns None if not listening yet, since
+        notifications would be missed.
+        """
+        with self._cond:
+            if not self._generation:
+                return None
+            return '%s.%d.%d' % ((self._instance,) + self._version(key))
+
+    def wait(self, key, version, timeout):
+        """Wait for a notification on `key`, returning the new version.
+
+        Returns immediately if the version is already different from
+        `version`.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._version(key) != version,
+                                timeout)
+            return self._version(key)
+
+    def _connect(self):
+        db = settings.DATABASES['default']
+        conn = psycopg2.connect(dbname=db['NAME'], user=db['USER'],
+                                password=db['PASSWORD'], host=db['HOST'],
+                                port=db.get('PORT') or None)
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN %s;' % NOTIFY_CHANNEL)
+        return conn
+
+    def _run(self):
+        while True:
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                logging.exception("Can't LISTEN for notifications")
+                time.sleep(5)
+                continue
+            with self._cond:
+                self._generation += 1
+                self._cond.notify_all()
+            try:
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        with self._cond:
+                            for notify in conn.notifies:
+                                key = notify.payload
+                                self._versions[key] = \
+                                    self._versions.get(key, 0) + 1
+                            del conn.notifies[:]
+                            self._cond.notify_all()
+            except (psycopg2.Error, OSError):
+                logging.exception("Lost connection listening for "
+                                  "notifications")
+                time.sleep(1)
+            finally:
+                conn.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = Listener()
+        return _listener
@@ -1,64 +1,280 @@
 from common import get_object_store
-from hashlib import sha256
+from common import metrics
+from django.core.cache import cache
+from hashlib import md5, sha256
 from web.models import *
 import logging
 import os
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import tempfile
+import threading
+import time
+from urllib3.util.retry import Retry
 
 
-__all__ = ['get_experiment_from_provider']
+__all__ = ['ProviderError', 'check_provider', 'get_metadata',
+           'get_experiment_from_provider']
 
 
 class ProviderError(Exception):
     pass
 
 
+# Timeouts for requests to providers: (connect, read between bytes)
+TIMEOUT = (10, 60)
+
+# How long to cache the metadata returned by providers, and their errors
+METADATA_TTL = 3600
+ERROR_TTL = 300
+
+# Imports in progress that haven't been updated for this long are considered
+# lost (their fetcher died), and are queued again
+STALE_TIMEOUT = 15 * 60
+
+# Number of times an interrupted download is resumed, and initial delay
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_BACKOFF = 1.0
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Get the HTTP session used for all requests to providers.
+
+    It keeps connections alive between requests, and retries failed requests
+    with exponential backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=5, backoff_factor=DOWNLOAD_BACKOFF,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _download(link, fp, size=None, progress=None):
+    """Download a file and hash it.
+
+    If the connection drops, the download is resumed where it stopped with a
+    Range request, if the server supports it.
+
+    Returns the size, the checksums, and the ETag of the file.
+    """
+    session = get_session()
+    hashers = {'sha256': sha256(), 'md5': md5()}
+    done = 0
+    etag = None
+    attempt = 0
+    while True:
+        headers = {}
+        if done:
+            headers['Range'] = 'bytes=%d-' % done
+            if etag:
+                # Don't resume from a different version of the file
+                headers['If-Range'] = etag
+        try:
+            response = session.get(link, stream=True, headers=headers,
+                                   timeout=TIMEOUT)
+            response.raise_for_status()
+            if done and response.status_code != 206:
+                logging.info("Server doesn't support resuming, restarting "
+                             "download")
+                fp.seek(0, 0)
+                fp.truncate()
+                hashers = {'sha256': sha256(), 'md5': md5()}
+                done = 0
+            etag = response.headers.get('ETag')
+            expected = response.headers.get('Content-Length')
+            if expected is not None:
+                expected = done + int(expected, 10)
+            if size is None:
+                size = expected
+            for chunk in response.iter_content(65536):
+                fp.write(chunk)
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, size)
+            if expected is not None and done < expected:
+                raise requests.ConnectionError(
+                    "Connection closed after %d bytes, expected %d" % (
+                        done, expected))
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            attempt += 1
+            if attempt >= DOWNLOAD_ATTEMPTS:
+                raise
+            logging.warning("Download interrupted after %d bytes (%s), "
+                            "resuming", done, e)
+            time.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1))
+        else:
+            return (done,
+                    dict((k, h.hexdigest()) for k, h in hashers.items()),
+                    etag)
+
+
+def check_provider(provider):
+    if provider not in _PROVIDERS:
+        raise ProviderError("No such provider %s" % provider)
+
+
 def get_experiment_from_provider(request, remote_addr,
-                                 provider, provider_path):
+                                 provider, provider_path, progress=None):
+    """Get an `Upload` for an experiment on a provider.
+
+    This might download the file, so it is called from the fetcher, not from
+    the web request. `progress(bytes_done, bytes_total)` gets called while
+    downloading, `bytes_total` being None if the size isn't known.
+    """
+    metadata = get_metadata(provider, provider_path)
+    return _get_from_link(request, remote_addr, provider, provider_path,
+                          metadata['link'], metadata['filename'],
+                          metadata['checksums'], metadata['size'], progress)
+
+
+def _metadata_cache_key(provider, provider_path):
+    # Paths come from the URL, hash them to get a valid key for any backend
+    return 'provider_metadata:%s' % sha256(
+        ('%s/%s' % (provider, provider_path)).encode('utf-8')).hexdigest()
+
+
+def get_metadata(provider, provider_path):
+    """Get the download link, filename, checksums and size of a file.
+
+    Results are cached for `METADATA_TTL` seconds, and errors for
+    `ERROR_TTL` seconds, so that repeated requests for bad IDs don't all go
+    to the provider.
+    """
+    check_provider(provider)
+    key = _metadata_cache_key(provider, provider_path)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics.counter('provider_metadata_hits').inc()
+        if 'error' in cached:
+            raise ProviderError(cached['error'])
+        return cached
+    metrics.counter('provider_metadata_misses').inc()
+
     try:
-        getter = _PROVIDERS[provider]
-    except KeyError:
-        raise ProviderError("No such provider %s" % provider)
-    return getter(request, remote_addr, provider, provider_path)
+        metadata = _PROVIDERS[provider](provider_path)
+    except ProviderError as e:
+        cache.set(key, {'error': str(e)}, ERROR_TTL)
+        raise
+    cache.set(key, metadata, METADATA_TTL)
+    return metadata
+
+
+def _find_experiment(checksums, size):
+    """Find an experiment we already have from provider-reported checksums.
+
+    Apart from sha256, which is how experiments are named, a checksum only
+    matches if the size is known and is the same. If the sha256 is known and
+    we don't have it, the other checksums are not looked at.
+    """
+    if 'sha256' in checksums:
+        return Experiment.objects.filter(hash=checksums['sha256']).first()
+    for algorithm, value in checksums.items():
+        known = (ProviderChecksum.objects
+                 .select_related('experiment_hash')
+                 .filter(algorithm=algorithm, value=value)
+                 .first())
+        if known and size is not None and known.size == size:
+            return known.experiment_hash
+    return None
+
+
+def _etag_algorithm(link, etag):
+    """Get the key under which to record the ETag of a download link.
+
+    An ETag only identifies a version of the file at this exact URL, and
+    weak ETags don't even identify its content, so they are not used.
+    """
+    if not etag or etag.startswith('W/'):
+        return None
+    return 'etag:%s' % link
+
+
+def _record_checksums(experiment, checksums, size):
+    for algorithm, value in checksums.items():
+        if algorithm == 'sha256':
+            continue
+        ProviderChecksum.objects.get_or_create(
+            algorithm=algorithm, value=value,
+            defaults=dict(experiment_hash=experiment, size=size))
 
 
 def _get_from_link(request, remote_addr, provider, provider_path,
-                   link, filename, filehash=None):
-    # Check for existence of experiment
-    if filehash is not None:
-            experiment = Experiment.objects.filter(hash = filehash)
-            print(experiment)
-    else:
-        experiment = None
+                   link, filename, checksums=None, size=None,
+                   progress=None):
+    """Get an experiment from a download link, downloading only if needed.
+
+    `checksums` maps algorithms ('sha256', 'md5') to the checksums the
+    provider reported for the file. If one of them matches a file we already
+    have, from this or another provider, nothing is downloaded. The strong
+    ETag of the download link is also checked with a HEAD request before
+    downloading, unless the provider reported a sha256.
+
+    Only checksums known to match the file are recorded: the ones reported
+    along with a matching sha256, or the ones computed while downloading.
+    """
+    checksums = dict(checksums or {})
+    experiment = _find_experiment(checksums, size)
+    if not experiment and 'sha256' not in checksums:
+        response = get_session().head(link, allow_redirects=True,
+                                      timeout=TIMEOUT)
+        etag_key = _etag_algorithm(link, response.headers.get('ETag'))
+        if response.status_code == 200 and etag_key:
+            if size is None and 'Content-Length' in response.headers:
+                size = int(response.headers['Content-Length'], 10)
+            experiment = _find_experiment(
+                {etag_key: response.headers['ETag']}, size)
     if experiment:
         logging.info("Experiment with hash exists, no need to download")
+        if experiment.hash == checksums.get('sha256'):
+            _record_checksums(experiment, checksums, size)
     else:
         logging.info("Downloading %s", link)
         fd, local_path = tempfile.mkstemp(prefix='provider_download_')
         try:
             # Download file & hash it
-            response = requests.get(link, stream=True)
-            response.raise_for_status()
-            hasher = sha256()
             with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(4096):
-                    f.write(chunk)
-                    hasher.update(chunk)
+                filesize, local_checksums, etag = _download(link, f, size,
+                                                            progress)
+            filehash = local_checksums['sha256']
+            for algorithm, value in local_checksums.items():
+                if checksums.get(algorithm, value) != value:
+                    logging.warning("Provider reported %s %s, got %s",
+                                    algorithm, checksums[algorithm], value)
 
-            filehash = hasher.hexdigest()
+            # Only record what we computed, and the ETag the file was
+            # actually downloaded with
+            checksums = dict(local_checksums)
+            etag_key = _etag_algorithm(link, etag)
+            if etag_key:
+                checksums[etag_key] = etag
 
             # Check for existence of experiment
-            experiment = Experiment.objects.filter(hash = filehash)
+            experiment = Experiment.objects.filter(hash = filehash).first()
             
             if experiment:
                 logging.info("File exists")
             else:
                 # Insert it on S3
-                # object_store = get_object_store()
-                # object_store.upload_file('experiments', filehash,
-                #                          local_path)
+                object_store = get_object_store()
+                object_store.upload_file('experiments', filehash,
+                                         local_path)
                 logging.info("Inserted file in storage")
 
                 # Insert it in database
@@ -68,6 +284,7 @@ def _get_from_link(request, remote_addr, provider, provider_path,
 
                 # Experiment.get(hash=filehash)
                 # request.session['Experiment'] = experiment
+            _record_checksums(experiment, checksums, filesize)
         finally:
             os.close(fd)
             os.remove(local_path)
@@ -91,13 +308,14 @@ def _get_from_link(request, remote_addr, provider, provider_path,
 _osf_path = re.compile('^[a-zA-Z0-9]+$')
 
 
-def _osf(session, remote_addr, provider, path):
+def _osf(path):
     if _osf_path.match(path) is None:
         raise ProviderError("ID is not in the OSF format")
     logging.info("Querying OSF for '%s'", path)
-    req = requests.get('https://api.osf.io/v2/files/{0}/'.format(path),
-                       headers={'Content-Type': 'application/json',
-                                'Accept': 'application/json'})
+    req = get_session().get('https://api.osf.io/v2/files/{0}/'.format(path),
+                            headers={'Content-Type': 'application/json',
+                                     'Accept': 'application/json'},
+                            timeout=TIMEOUT)
     if req.status_code != 200:
         logging.info("Got error %s", req.status_code)
         raise ProviderError("HTTP error from OSF")
@@ -110,21 +328,23 @@ def _osf(session, remote_addr, provider, path):
         logging.error("Got invalid JSON from osf.io")
         raise ProviderError("Invalid JSON returned from the OSF")
     else:
+        attrs = response['data'].get('attributes', {})
         try:
-            attrs = response['data']['attributes']
-            filehash = attrs['extra']['hashes']['sha256']
+            hashes = attrs['extra']['hashes']
         except KeyError:
-            filehash = None
+            hashes = {}
+        checksums = dict((k, hashes[k]) for k in ('sha256', 'md5')
+                         if hashes.get(k))
         try:
             filename = response['data']['attributes']['name']
         except KeyError:
             filename = 'unnamed_osf_file'
-        logging.info("Got response: %s %s %s", link, filehash, filename)
-        return _get_from_link(session, remote_addr, provider, path,
-                              link, filename, filehash)
+        logging.info("Got response: %s %s %s", link, checksums, filename)
+        return dict(link=link, filename=filename, checksums=checksums,
+                    size=attrs.get('size'))
 
 
-def _figshare(session, remote_addr, provider, path):
+def _figshare(path):
     # article_id/file_id
     try:
         article_id, file_id = path.split('/', 1)
@@ -134,9 +354,10 @@ def _figshare(session, remote_addr, provider, path):
         raise ProviderError("ID is not in 'article_id/file_id' format")
     logging.info("Querying Figshare for article=%s file=%s",
                  article_id, file_id)
-    req = requests.get('https://api.figshare.com/v2/articles/{0}/files/{1}'
-                       .format(article_id, file_id),
-                       headers={'Accept': 'application/json'})
+    req = get_session().get('https://api.figshare.com/v2/articles/{0}/files/{1}'
+                            .format(article_id, file_id),
+                            headers={'Accept': 'application/json'},
+                            timeout=TIMEOUT)
     if req.status_code != 200:
         logging.info("Got error %s", req.status_code)
         raise ProviderError("HTTP error from Figshare")
@@ -153,9 +374,12 @@ def _figshare(session, remote_addr, provider, path):
             filename = response['name']
         except KeyError:
             filename = 'unnamed_figshare_file'
-        logging.info("Got response: %s %s", link, filename)
-        return _get_from_link(session, remote_addr, provider, path,
-                              link, filename)
+        checksums = {}
+        if response.get('computed_md5'):
+            checksums['md5'] = response['computed_md5']
+        logging.info("Got response: %s %s %s", link, checksums, filename)
+        return dict(link=link, filename=filename, checksums=checksums,
+                    size=response.get('size'))
 
 
 _PROVIDERS = {
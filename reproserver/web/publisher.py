@@ -0,0 +1,147 @@
+from django.db import connection, transaction
+import logging
+import pika
+import pika.exceptions
+import threading
+import time
+
+from common.tasks import connect
+from web.models import OutboxMessage
+
+
+__all__ = ['get_publisher']
+
+
+# Errors meaning the broker is unavailable
+BROKER_ERRORS = (pika.exceptions.AMQPError, OSError)
+
+
+class Publisher(object):
+    """Sends tasks to the AMQP broker without blocking the requests.
+
+    Publishing saves the task in the `task_outbox` table, in the same
+    transaction as the change it goes with (e.g. the experiment going to
+    QUEUED), so the task exists if and only if the change was committed, even
+    if the process exits right after. Once the transaction commits, a sender
+    thread publishes the saved tasks as persistent messages with publisher
+    confirms, oldest first, and deletes them once confirmed (a task might be
+    sent twice if that fails).
+
+    The sender thread has its own connection (pika connections can't be
+    shared between threads), kept between tasks. It also sends the tasks
+    other processes left behind every `poll_interval` seconds, and retries
+    every `retry_delay` seconds while the broker is unavailable. Nothing
+    connects to the broker before the first task is published, so the web
+    application starts without it.
+    """
+    def __init__(self, retry_delay=5.0, poll_interval=60.0):
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self._broker_down = threading.Event()
+        self._wake = threading.Event()
+        self._conn = self._channel = None
+        self._threads = []
+        self._start_thread(self._sender, 'amqp-sender')
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def publish(self, queue_name, body):
+        """Save a task, to be sent once the current transaction commits.
+        """
+        OutboxMessage.objects.create(queue=queue_name, body=body)
+        transaction.on_commit(self._wake.set)
+
+    def publish_build_task(self, body):
+        self.publish('build_queue', body)
+
+    def publish_run_task(self, body):
+        self.publish('run_queue', body)
+
+    def publish_fetch_task(self, body):
+        self.publish('fetch_queue', body)
+
+    def _connect(self):
+        self._conn, self._channel = connect()
+        self._channel.confirm_delivery()
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except BROKER_ERRORS:
+                pass
+        self._conn = self._channel = None
+
+    def _send(self, queue_name, body):
+        confirmed = self._channel.basic_publish(
+            '', routing_key=queue_name, body=body,
+            properties=pika.BasicProperties(delivery_mode=2))
+        if not confirmed:
+            raise pika.exceptions.AMQPError("Broker didn't confirm message")
+
+    def _sender(self):
+        last_poll = time.time()
+        while True:
+            woken = self._wake.wait(self.retry_delay)
+            self._wake.clear()
+            if (not woken and not self._broker_down.is_set() and
+                    time.time() - last_poll < self.poll_interval):
+                # Keep the connection alive (heartbeats)
+                if self._conn is not None:
+                    try:
+                        self._conn.process_data_events(0)
+                    except BROKER_ERRORS:
+                        self._disconnect()
+                continue
+            last_poll = time.time()
+            try:
+                self.drain()
+            except BROKER_ERRORS:
+                logging.warning("AMQP broker unavailable, will retry")
+                self._disconnect()
+                self._broker_down.set()
+            except Exception:
+                logging.exception("Error sending saved tasks")
+                self._disconnect()
+                self._broker_down.set()
+            finally:
+                connection.close()
+
+    def drain(self):
+        """Send the tasks saved in the database.
+        """
+        # Other processes might be sending too; leave them their rows
+        lock = {}
+        if connection.features.has_select_for_update_skip_locked:
+            lock['skip_locked'] = True
+        while True:
+            with transaction.atomic():
+                messages = list(OutboxMessage.objects
+                                .select_for_update(**lock)
+                                .order_by('id')[:100])
+                if not messages:
+                    break
+                if self._channel is None:
+                    self._connect()
+                for message in messages:
+                    self._send(message.queue, message.body)
+                OutboxMessage.objects.filter(
+                    id__in=[m.id for m in messages]).delete()
+            logging.info("Sent %d tasks", len(messages))
+        self._broker_down.clear()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher()
+        return _publisher
@@ -1,3 +1,1031 @@
-from django.test import TestCase
+from django.http.multipartparser import MultiPartParser
+from django.core.cache import cache
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from botocore.exceptions import ClientError
+from datetime import timedelta
+from hashlib import md5, sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import os
+import socket
+import socketserver
+import struct
+import tarfile
+import tempfile
+import threading
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from common import metrics, objectstore, workers
+from common.docker import DockerClient, DockerError
+from common.process import run_container_and_log
+from common.shortid import get_short_ids
+from common.workers import WorkerPool
+from web import lastaccess, models, providers, uploadhandlers
+from web.management.commands import fetch_worker, migrate_logs
+from web.models import BuildLogLine, DirectUpload, Experiment, InputFile, \
+    LogSegment, OutboxMessage, Parameter, Path, ProviderChecksum, \
+    ProviderImport, Upload
+from web.publisher import Publisher
+from web.uploadhandlers import ObjectStoreUploadHandler
+
+
+class FakeObjectStore(object):
+    """Object store keeping everything in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def create_multipart_upload(self, bucket, objectname):
+        upload_id = 'upload%d' % len(self.uploads)
+        self.uploads[upload_id] = []
+        return upload_id
+
+    def upload_part(self, bucket, objectname, upload_id, part_number, data):
+        self.uploads[upload_id].append(data)
+        return 'etag%d' % part_number
+
+    def complete_multipart_upload(self, bucket, objectname, upload_id,
+                                  etags):
+        parts = self.uploads.get(upload_id)
+        if parts is None or etags != ['etag%d' % (i + 1)
+                                      for i in range(len(parts))]:
+            raise ClientError({'Error': {'Code': 'InvalidPart'}},
+                              'CompleteMultipartUpload')
+        del self.uploads[upload_id]
+        self.objects[(bucket, objectname)] = b''.join(parts)
+
+    def presigned_upload_part_url(self, bucket, objectname, upload_id,
+                                  part_number):
+        return 'http://s3/%s/%s?uploadId=%s&partNumber=%d' % (
+            bucket, objectname, upload_id, part_number)
+
+    def hash_object(self, bucket, objectname):
+        data = self.objects[(bucket, objectname)]
+        return sha256(data).hexdigest(), len(data)
+
+    def exists(self, bucket, objectname):
+        return (bucket, objectname) in self.objects
+
+    def rename(self, bucket, old, new):
+        self.objects[(bucket, new)] = self.objects.pop((bucket, old))
+
+    def abort_multipart_upload(self, bucket, objectname, upload_id):
+        del self.uploads[upload_id]
+
+    def delete(self, bucket, objectname):
+        self.objects.pop((bucket, objectname), None)
+
+
+class BrokenStream(io.BytesIO):
+    """Stream failing after some bytes, like a client disconnecting.
+    """
+    def __init__(self, data, fail_after):
+        super(BrokenStream, self).__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise IOError("Connection reset")
+        if size < 0 or self.tell() + size > self.fail_after:
+            size = self.fail_after - self.tell()
+        return super(BrokenStream, self).read(size)
+
+
+class TestUploadHandler(SimpleTestCase):
+    def parse(self, store, content, handler=None, fail_after=None):
+        fp = io.BytesIO(content)
+        fp.name = 'experiment.rpz'
+        body = encode_multipart(BOUNDARY, {'rpz_file': fp})
+        meta = {'CONTENT_TYPE': MULTIPART_CONTENT,
+                'CONTENT_LENGTH': len(body)}
+        if handler is None:
+            handler = ObjectStoreUploadHandler(None, store, 'experiments')
+        if fail_after is None:
+            stream = io.BytesIO(body)
+        else:
+            stream = BrokenStream(body, fail_after)
+        parser = MultiPartParser(meta, stream, [handler])
+        _, files = parser.parse()
+        return files['rpz_file']
+
+    def test_stream_parts(self):
+        old_part_size = uploadhandlers.PART_SIZE
+        uploadhandlers.PART_SIZE = 100000
+        try:
+            store = FakeObjectStore()
+            content = bytes(range(256)) * 1000
+            uploaded = self.parse(store, content)
+        finally:
+            uploadhandlers.PART_SIZE = old_part_size
+
+        self.assertEqual(uploaded.sha256, sha256(content).hexdigest())
+        self.assertEqual(uploaded.size, len(content))
+        self.assertTrue(uploaded.temp_key.startswith('tmp/'))
+        self.assertEqual(store.objects[('experiments', uploaded.temp_key)],
+                         content)
+        self.assertFalse(store.uploads)
+
+    def test_empty_file(self):
+        store = FakeObjectStore()
+        uploaded = self.parse(store, b'')
+        self.assertEqual(uploaded.sha256, sha256(b'').hexdigest())
+        self.assertEqual(store.objects[('experiments', uploaded.temp_key)],
+                         b'')
+
+    def test_abort(self):
+        old_part_size = uploadhandlers.PART_SIZE
+        uploadhandlers.PART_SIZE = 100000
+        try:
+            # Connection lost in the middle of the file
+            store = FakeObjectStore()
+            handler = ObjectStoreUploadHandler(None, store, 'experiments')
+            with self.assertRaises(IOError):
+                self.parse(store, bytes(256) * 1000, handler,
+                           fail_after=150000)
+            self.assertEqual(len(store.uploads), 1)
+            handler.abort()
+            self.assertFalse(store.uploads)
+            self.assertFalse(store.objects)
+
+            # Request rejected after the file was received
+            handler = ObjectStoreUploadHandler(None, store, 'experiments')
+            uploaded = self.parse(store, b'content', handler)
+            self.assertIn(('experiments', uploaded.temp_key), store.objects)
+            handler.abort()
+            self.assertFalse(store.objects)
+        finally:
+            uploadhandlers.PART_SIZE = old_part_size
+
+
+@override_settings(ROOT_URLCONF='reproserver.urls')
+class TestDirectUpload(TestCase):
+    def setUp(self):
+        from web import views
+        self.store = FakeObjectStore()
+        self.publisher = mock.Mock()
+        for name, value in [('object_store', self.store),
+                            ('client_object_store', self.store),
+                            ('get_publisher', lambda: self.publisher)]:
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, url, data):
+        response = self.client.post(url, json.dumps(data),
+                                    content_type='application/json')
+        return response.status_code, response.json()
+
+    def upload(self, bucket, content, **kwargs):
+        status, upload = self.post('/upload/start', {'bucket': bucket,
+                                                     'size': len(content)})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(upload['urls']), 1)
+        etag = self.store.upload_part(bucket, upload['key'],
+                                      upload['upload_id'], 1, content)
+        data = {'bucket': bucket, 'key': upload['key'],
+                'upload_id': upload['upload_id'], 'etags': [etag],
+                'size': len(content)}
+        data.update(kwargs)
+        return self.post('/upload/complete', data)
+
+    def check(self, result):
+        direct_upload = DirectUpload.objects.get()
+        self.assertEqual(direct_upload.status, DirectUpload.PENDING)
+        self.publisher.publish_fetch_task.assert_called_once_with(
+            'upload/%d' % direct_upload.id)
+        fetch_worker._check_upload(self.store, str(direct_upload.id))
+        response = self.client.get(result['status_url'])
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_invalid(self):
+        status, _ = self.post('/upload/start', {'bucket': 'logs',
+                                                'size': 10})
+        self.assertEqual(status, 400)
+
+        status, upload = self.post('/upload/start', {'bucket': 'inputs',
+                                                     'size': 10})
+        for upload_id, etags in [('nope', []), (upload['upload_id'],
+                                                ['"bogus"'])]:
+            status, _ = self.post('/upload/complete', {
+                'bucket': 'inputs', 'key': upload['key'],
+                'upload_id': upload_id, 'etags': etags, 'size': 10})
+            self.assertEqual(status, 400)
+        self.assertFalse(DirectUpload.objects.exists())
+
+    def test_experiment(self):
+        content = b'experiment'
+        filehash = sha256(content).hexdigest()
+        status, result = self.upload('experiments', content,
+                                     filename='exp.rpz')
+        self.assertEqual(status, 202)
+
+        # Nothing is moved before the fetcher checked it
+        self.assertNotIn(('experiments', filehash), self.store.objects)
+        status = self.check(result)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(self.store.objects, {('experiments', filehash):
+                                              content})
+        upload = Upload.objects.get()
+        self.assertEqual(upload.experiment_hash_id, filehash)
+        self.assertEqual(upload.filename, 'exp.rpz')
+        self.assertEqual(status['url'],
+                         '/reproduce_local/%s' % upload.short_id)
+
+    def test_input(self):
+        content = b'input data'
+        filehash = sha256(content).hexdigest()
+        status, result = self.upload('inputs', content, filename='in.csv',
+                                     sha256=filehash)
+        self.assertEqual(status, 202)
+        status = self.check(result)
+        self.assertEqual(status['status'], 'done')
+        input_file = InputFile.objects.get(id=status['input_file'])
+        self.assertEqual((input_file.hash, input_file.name, input_file.size,
+                          input_file.run_id),
+                         (filehash, 'in.csv', len(content), None))
+        self.assertIn(('inputs', filehash), self.store.objects)
+
+    def test_mismatch(self):
+        status, result = self.upload('inputs', b'input data',
+                                     sha256='0' * 64)
+        self.assertEqual(status, 202)
+        status = self.check(result)
+        self.assertEqual(status['status'], 'error')
+        self.assertFalse(self.store.objects)
+        self.assertFalse(InputFile.objects.exists())
+
+
+class FakeResponse(object):
+    def __init__(self, json=None, content=b'', headers=None):
+        self.status_code = 200
+        self._json = json
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return self._json
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class TestProviders(TestCase):
+    content = b'experiment file contents'
+
+    def setUp(self):
+        cache.clear()
+        self.metadata_requests = []
+        self.downloads = []
+        self.store = mock.Mock()
+        patchers = [
+            mock.patch.object(providers, 'get_session', lambda: self),
+            mock.patch.object(providers, 'get_object_store',
+                              lambda: self.store),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, url, **kwargs):
+        if url.startswith('https://api.figshare.com/'):
+            self.metadata_requests.append(url)
+            if url.endswith('/articles/9/files/9'):
+                response = FakeResponse()
+                response.status_code = 404
+                return response
+            return FakeResponse(json={
+                'name': 'exp.rpz',
+                'download_url': 'https://download.example.org/exp.rpz',
+                'computed_md5': md5(self.content).hexdigest(),
+                'size': len(self.content),
+            })
+        self.downloads.append(url)
+        return FakeResponse(content=self.content, headers=self.head_headers)
+
+    def head(self, url, **kwargs):
+        return FakeResponse(headers=self.head_headers)
+
+    head_headers = {}
+
+    def test_figshare_dedupe(self):
+        upload = providers.get_experiment_from_provider(
+            None, '127.0.0.1', 'figshare.com', '1/2')
+        filehash = sha256(self.content).hexdigest()
+        self.assertEqual(upload.experiment_hash.hash, filehash)
+        self.assertEqual(len(self.downloads), 1)
+        self.assertEqual(self.store.upload_file.call_count, 1)
+        self.assertTrue(ProviderChecksum.objects.filter(
+            algorithm='md5', value=md5(self.content).hexdigest()).exists())
+
+        # Same file, different article: found from the checksum
+        upload = providers.get_experiment_from_provider(
+            None, '127.0.0.1', 'figshare.com', '3/4')
+        self.assertEqual(upload.experiment_hash.hash, filehash)
+        self.assertEqual(len(self.downloads), 1)
+        self.assertEqual(self.store.upload_file.call_count, 1)
+        self.assertEqual(Upload.objects.count(), 2)
+        self.assertEqual(Experiment.objects.count(), 1)
+
+    def test_checksum_size(self):
+        # A checksum we have for a file of a different size doesn't match
+        experiment = Experiment.objects.create(hash='0' * 64)
+        ProviderChecksum.objects.create(
+            algorithm='md5', value=md5(self.content).hexdigest(),
+            size=len(self.content) + 1, experiment_hash=experiment)
+        for size in (None, len(self.content)):
+            self.assertIsNone(providers._find_experiment(
+                {'md5': md5(self.content).hexdigest()}, size))
+
+    def test_unknown_sha256(self):
+        # A sha256 we don't have means a new file, whatever the other
+        # checksums say
+        experiment = Experiment.objects.create(hash='0' * 64)
+        ProviderChecksum.objects.create(
+            algorithm='md5', value=md5(self.content).hexdigest(),
+            size=len(self.content), experiment_hash=experiment)
+        self.assertIsNone(providers._find_experiment(
+            {'sha256': sha256(self.content).hexdigest(),
+             'md5': md5(self.content).hexdigest()},
+            len(self.content)))
+
+    def test_etag_unverified_checksums(self):
+        link = 'https://download.example.org/exp.rpz'
+        self.head_headers = {'ETag': '"v1"'}
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '1/2',
+                                 link, 'exp.rpz')
+
+        # Found from the ETag: the md5 the provider reports was never checked
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '1/2',
+                                 link, 'exp.rpz', checksums={'md5': 'f' * 32},
+                                 size=len(self.content))
+        self.assertEqual(len(self.downloads), 1)
+        self.assertFalse(ProviderChecksum.objects.filter(
+            algorithm='md5', value='f' * 32).exists())
+
+    def test_etag(self):
+        link = 'https://download.example.org/exp.rpz'
+        self.head_headers = {'ETag': '"v1"',
+                             'Content-Length': str(len(self.content))}
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '1/2',
+                                 link, 'exp.rpz')
+        self.assertEqual(len(self.downloads), 1)
+
+        # Same link and ETag: not downloaded again
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '1/2',
+                                 link, 'exp.rpz')
+        self.assertEqual(len(self.downloads), 1)
+
+        # Same ETag on another link, or a weak ETag: downloaded
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '3/4',
+                                 link + '?v=2', 'exp.rpz')
+        self.assertEqual(len(self.downloads), 2)
+        self.head_headers = {'ETag': 'W/"v1"'}
+        providers._get_from_link(None, '127.0.0.1', 'figshare.com', '1/2',
+                                 link, 'exp.rpz')
+        self.assertEqual(len(self.downloads), 3)
+
+    def test_metadata_cache(self):
+        for i in range(2):
+            metadata = providers.get_metadata('figshare.com', '1/2')
+            self.assertEqual(metadata['filename'], 'exp.rpz')
+        self.assertEqual(len(self.metadata_requests), 1)
+
+        for i in range(2):
+            with self.assertRaises(providers.ProviderError):
+                providers.get_metadata('figshare.com', '9/9')
+        self.assertEqual(len(self.metadata_requests), 2)
+
+    def test_fetch_worker(self):
+        class FakeTasks(object):
+            builds = []
+
+            def publish_build_task(self, body):
+                self.builds.append(body)
+
+        imp = ProviderImport.objects.create(provider_key='figshare.com/1/2')
+        tasks = FakeTasks()
+        fetch_worker._fetch(tasks, str(imp.id))
+
+        imp.refresh_from_db()
+        filehash = sha256(self.content).hexdigest()
+        self.assertEqual(imp.status, ProviderImport.DONE)
+        self.assertEqual(imp.upload.experiment_hash_id, filehash)
+        self.assertEqual(tasks.builds, [filehash])
+        self.assertEqual(Experiment.objects.get(hash=filehash).status, '2')
+
+    def test_fetch_stale(self):
+        tasks = mock.Mock()
+        old = timezone.now() - timedelta(seconds=providers.STALE_TIMEOUT + 1)
+
+        # Another fetcher is on it
+        imp = ProviderImport.objects.create(provider_key='figshare.com/1/2',
+                                            status=ProviderImport.FETCHING)
+        fetch_worker._fetch(tasks, str(imp.id))
+        self.assertEqual(len(self.downloads), 0)
+
+        # That fetcher died
+        ProviderImport.objects.filter(id=imp.id).update(timestamp=old)
+        fetch_worker._fetch(tasks, str(imp.id))
+        imp.refresh_from_db()
+        self.assertEqual(imp.status, ProviderImport.DONE)
+        self.assertEqual(len(self.downloads), 1)
+
+    def test_fetch_request_error(self):
+        imp = ProviderImport.objects.create(provider_key='figshare.com/1/2')
+        channel = mock.Mock()
+        method = mock.Mock(delivery_tag=7)
+        with mock.patch.object(fetch_worker, '_fetch',
+                               side_effect=RuntimeError):
+            fetch_worker.fetch_request(None, None, channel, method, None,
+                                       str(imp.id).encode('ascii'))
+        channel.basic_ack.assert_called_once_with(delivery_tag=7)
+        imp.refresh_from_db()
+        self.assertEqual(imp.status, ProviderImport.ERROR)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Serves `content`, resetting the connection after `cut` bytes.
+    """
+    content = bytes(range(256)) * 4096
+    cut = None
+    requests = []
+
+    def do_GET(self):
+        start = 0
+        range_header = self.headers.get('Range')
+        self.requests.append(range_header)
+        if range_header:
+            start = int(range_header[6:-1], 10)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(self.content) - 1, len(self.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content) - start))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        body = self.content[start:]
+        if self.cut is not None and len(self.requests) == 1:
+            self.wfile.write(body[:self.cut])
+            self.wfile.flush()
+            # Reset the connection
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       b'\x01\x00\x00\x00\x00\x00\x00\x00')
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(SimpleTestCase):
+    def download(self, cut):
+        FlakyHandler.cut = cut
+        FlakyHandler.requests = []
+        server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/exp.rpz' % server.server_port
+
+        fp = io.BytesIO()
+        with mock.patch.object(providers, 'DOWNLOAD_BACKOFF', 0):
+            size, checksums, etag = providers._download(url, fp)
+        content = FlakyHandler.content
+        self.assertEqual(fp.getvalue(), content)
+        self.assertEqual(size, len(content))
+        self.assertEqual(checksums['sha256'], sha256(content).hexdigest())
+        self.assertEqual(checksums['md5'], md5(content).hexdigest())
+        self.assertEqual(etag, '"v1"')
+
+    def test_download(self):
+        self.download(None)
+        self.assertEqual(FlakyHandler.requests, [None])
+
+    def test_resume(self):
+        self.download(300000)
+        # Received data might be lost with the reset, so it can resume from
+        # before the cut
+        self.assertEqual(len(FlakyHandler.requests), 2)
+        self.assertIsNone(FlakyHandler.requests[0])
+        self.assertRegex(FlakyHandler.requests[1], r'^bytes=[1-9][0-9]*-$')
+
+
+class FakeDaemonHandler(BaseHTTPRequestHandler):
+    """Docker daemon with a single container 'ctr', whose files are `files`.
+    """
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    created = []
+    connections = 0
+
+    def setup(self):
+        super(FakeDaemonHandler, self).setup()
+        type(self).connections += 1
+
+    def send_body(self, status, body=b'', content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        url = urlparse(self.path)
+        assert url.path.startswith('/v1.24/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length', '0'), 10)
+        body = self.rfile.read(length)
+        if len(body) < length:
+            # The client gave up
+            self.close_connection = True
+            return
+        getattr(self, method)(url.path[6:], query, body)
+
+    def do_GET(self):
+        self.route('get')
+
+    def do_POST(self):
+        self.route('post')
+
+    def do_PUT(self):
+        self.route('put')
+
+    def do_DELETE(self):
+        self.route('delete')
+
+    def get(self, path, query, body):
+        if path == '/containers/ctr/archive':
+            if query['path'] not in self.files:
+                self.send_body(404, {'message': "Could not find the file"})
+                return
+            content = self.files[query['path']]
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w') as tar:
+                info = tarfile.TarInfo(os.path.basename(query['path']))
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            self.send_body(200, buf.getvalue(), 'application/x-tar')
+        else:
+            self.send_body(404, {'message': "No such image: %s" % path})
+
+    def put(self, path, query, body):
+        assert path == '/containers/ctr/archive'
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            for member in tar:
+                name = os.path.join(query['path'], member.name)
+                self.files[name] = tar.extractfile(member).read()
+        self.send_body(200)
+
+    def post(self, path, query, body):
+        if path == '/containers/create':
+            self.created.append((query['name'], json.loads(body.decode())))
+            self.send_body(201, {'Id': 'ctr', 'Warnings': None})
+        elif path == '/containers/ctr/start':
+            self.send_body(204)
+        elif path == '/containers/ctr/attach':
+            # Hijacked connection, raw stream until the container stops
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'application/vnd.docker.raw-stream')
+            self.end_headers()
+            for stream, data in [(1, b'out 1\nout'), (2, b'err 1\n'),
+                                 (1, b' 2\n'), (2, b'err 2')]:
+                self.wfile.write(struct.pack('>BxxxL', stream, len(data)))
+                self.wfile.write(data)
+            self.close_connection = True
+        elif path == '/containers/ctr/wait':
+            self.send_body(200, {'StatusCode': 3})
+        elif path == '/images/localhost:5000/exp/push':
+            assert query == {'tag': 'latest'}
+            self.send_body(200, b'{"status": "Pushing"}\r\n'
+                                b'{"error": "denied"}\r\n')
+        else:
+            self.send_body(404, {'message': "Not found"})
+
+    def delete(self, path, query, body):
+        assert path == '/containers/ctr' and query['force'] == '1'
+        self.send_body(204)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeLog(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class TestDocker(SimpleTestCase):
+    def setUp(self):
+        FakeDaemonHandler.files = {}
+        FakeDaemonHandler.created = []
+        FakeDaemonHandler.connections = 0
+        directory = tempfile.mkdtemp()
+        socket_path = os.path.join(directory, 'docker.sock')
+        server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                        FakeDaemonHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, socket_path)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.client = DockerClient('unix://' + socket_path)
+        self.addCleanup(self.client.close)
+
+    def test_files(self):
+        content = bytes(range(256)) * 5000 + b'end'
+        self.client.put_file('ctr', '/data/input.bin', io.BytesIO(content),
+                             len(content))
+        self.assertEqual(FakeDaemonHandler.files, {'/data/input.bin': content})
+
+        with self.client.get_file('ctr', '/data/input.bin') as (fp, size):
+            self.assertEqual(size, len(content))
+            self.assertEqual(fp.read(), content)
+
+    def test_errors(self):
+        with self.assertRaises(IOError):
+            self.client.put_file('ctr', '/data/short', io.BytesIO(b'abc'), 10)
+        with self.assertRaises(DockerError) as cm:
+            with self.client.get_file('ctr', '/data/missing'):
+                pass
+        self.assertEqual(cm.exception.status, 404)
+        self.assertEqual(cm.exception.message, "Could not find the file")
+        self.assertIsNone(self.client.inspect_image('localhost:5000/exp'))
+        with self.assertRaises(DockerError) as cm:
+            self.client.push('localhost:5000/exp')
+        self.assertIsNone(cm.exception.status)
+        self.assertEqual(cm.exception.message, "denied")
+
+    def test_run(self):
+        container = self.client.create_container(
+            'localhost:5000/exp', ['cmd', 'ls', 'run', '0'], name='run_1',
+            cpus=1.5, memory=1024, disk=None)
+        self.assertEqual(container, 'ctr')
+        name, config = FakeDaemonHandler.created[0]
+        self.assertEqual(name, 'run_1')
+        self.assertEqual(config['Cmd'], ['cmd', 'ls', 'run', '0'])
+        self.assertEqual(config['HostConfig'], {'CpuPeriod': 100000,
+                                                'CpuQuota': 150000,
+                                                'Memory': 1024})
+
+        log = FakeLog()
+        self.assertEqual(run_container_and_log(log, self.client, container),
+                         3)
+        self.assertEqual(log.lines, ['out 1', 'err 1', 'out 2', 'err 2'])
+        self.client.remove_container(container, force=True)
+
+        # Attaching hijacks a connection, the other calls shared one
+        self.assertEqual(FakeDaemonHandler.connections, 2)
+
+
+@override_settings(ROOT_URLCONF='reproserver.urls')
+class TestQueries(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestQueries, cls).setUpClass()
+        from web import views
+        cls.views = views
+
+    def setUp(self):
+        cache.clear()
+        self.token = 'a'
+        listener = mock.Mock()
+        listener.cache_token = lambda key: self.token
+        patcher = mock.patch.object(self.views, 'get_listener',
+                                    lambda: listener)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_setup_page(self):
+        experiment = Experiment.objects.create(hash='abc', status='4')
+        for i in range(10):
+            Parameter.objects.create(experiment_hash=experiment,
+                                     name='param%d' % i, description='',
+                                     optional=False)
+            Path.objects.create(experiment_hash=experiment, is_input=True,
+                                is_output=False, name='input%d' % i,
+                                path='/in%d' % i)
+        upload = Upload.objects.create(experiment_hash=experiment,
+                                       filename='exp.rpz')
+        upload = Upload.objects.select_related('experiment_hash').get(
+            id=upload.id)
+
+        # Parameters, input paths, log segments
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(3):
+            response = self.views.reproduce_common(upload, request)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'param9')
+        self.assertContains(response, 'input9')
+
+        # Served from the cache
+        with self.assertNumQueries(0):
+            response = self.views.reproduce_common(upload, request)
+        self.assertContains(response, 'param9')
+        etag = response['ETag']
+
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag)
+        response = self.views.reproduce_common(upload, request)
+        self.assertEqual(response.status_code, 304)
+
+        # Invalidated by a notification
+        self.token = 'b'
+        with self.assertNumQueries(3):
+            response = self.views.reproduce_common(upload, request)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class FakeLogStore(object):
+    def __init__(self):
+        self.segments = {}
+        self.reads = []
+
+    def read_segment(self, key):
+        self.reads.append(key)
+        return self.segments[key]
+
+
+class TestLogPages(TestCase):
+    def setUp(self):
+        self.log_store = FakeLogStore()
+        patcher = mock.patch.object(models, '_log_store', self.log_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.experiment = Experiment.objects.create(hash='abc', status='3')
+        for first_line in range(0, 15, 5):
+            key = 'build/abc/%010d.gz' % first_line
+            self.log_store.segments[key] = [
+                'line %d' % i for i in range(first_line, first_line + 5)]
+            LogSegment.objects.create(experiment_hash=self.experiment,
+                                      first_line=first_line, nb_lines=5,
+                                      key=key)
+
+    def test_pages(self):
+        with self.assertNumQueries(2):
+            lines, cursor = self.experiment.get_log_page(3, 6)
+        self.assertEqual(list(lines), ['line %d' % i for i in range(3, 9)])
+        self.assertEqual(cursor, 9)
+        self.assertEqual(len(self.log_store.reads), 2)
+
+        lines, cursor = self.experiment.get_log_page(9, 100)
+        self.assertEqual(list(lines), ['line %d' % i for i in range(9, 15)])
+        self.assertEqual(cursor, 15)
+
+        lines, cursor = self.experiment.get_log_page(15, 100)
+        self.assertEqual(list(lines), [])
+        self.assertEqual(cursor, 15)
+
+    @override_settings(ROOT_URLCONF='reproserver.urls')
+    def test_json(self):
+        from web import views
+        upload = Upload.objects.create(experiment_hash=self.experiment,
+                                       filename='exp.rpz')
+        request = RequestFactory().get('/', {'cursor': '12'},
+                                       CONTENT_TYPE='application/json')
+        response = views.reproduce_common(upload, request)
+        data = json.loads(b''.join(response.streaming_content)
+                          .decode('utf-8'))
+        self.assertEqual(data, {'status': 'BUILDING', 'params': [],
+                                'next_cursor': 15,
+                                'log': ['line 12', 'line 13', 'line 14']})
+
+
+class TestMigrateLogs(TestCase):
+    def test_skip_rewritten(self):
+        log_store = mock.Mock()
+        log_store.write_segment.return_value = 'build/old/0000000000.gz'
+        command = migrate_logs.Command(stdout=io.StringIO())
+        for h in ('old', 'new'):
+            experiment = Experiment.objects.create(hash=h)
+            for i in range(3):
+                BuildLogLine.objects.create(experiment_hash=experiment,
+                                            line='line %d' % i)
+        # Rebuilt since the upgrade
+        LogSegment.objects.create(experiment_hash_id='new', first_line=0,
+                                  nb_lines=1, key='build/new/0000000000.gz')
+
+        for h in ('old', 'new'):
+            command.migrate_log(
+                log_store, 5000, 'build', h,
+                BuildLogLine.objects.filter(experiment_hash=h),
+                dict(experiment_hash_id=h))
+
+        log_store.write_segment.assert_called_once_with(
+            'build', 'old', 0, ['line 0', 'line 1', 'line 2'])
+        log_store.delete_log.assert_not_called()
+        self.assertEqual(
+            [(seg.experiment_hash_id, seg.key)
+             for seg in LogSegment.objects.order_by('experiment_hash')],
+            [('new', 'build/new/0000000000.gz'),
+             ('old', 'build/old/0000000000.gz')])
+        self.assertFalse(BuildLogLine.objects.exists())
+
+
+class TestLastAccess(TestCase):
+    def test_coalesce(self):
+        old = timezone.now() - timedelta(days=1)
+        for h in ('abc', 'def'):
+            Experiment.objects.create(hash=h, last_access=old)
+        tracker = lastaccess.AccessTracker(interval=3600)
+        self.addCleanup(tracker.flush)
+        for i in range(5):
+            tracker.touch('abc')
+            tracker.touch('def')
+
+        with self.assertNumQueries(1):
+            tracker.flush()
+        for experiment in Experiment.objects.all():
+            self.assertGreater(experiment.last_access, old)
+
+        # Touched recently, not written again
+        tracker.touch('abc')
+        with self.assertNumQueries(0):
+            tracker.flush()
+
+
+class TestObjectStoreDedupe(SimpleTestCase):
+    def setUp(self):
+        objectstore._known_objects.clear()
+        with mock.patch.dict(os.environ, {'S3_KEY': 'key',
+                                          'S3_SECRET': 'secret'}):
+            self.store = objectstore.ObjectStore('http://localhost:1',
+                                                 'test')
+        self.client = mock.Mock()
+        self.store.s3 = mock.Mock()
+        self.store.s3.meta.client = self.client
+
+    def test_skip(self):
+        skipped = metrics.counter('object_store_skipped_bytes')
+        before = skipped.value
+        self.client.head_object.side_effect = ClientError(
+            {'Error': {'Code': '404'}}, 'HeadObject')
+
+        fp = io.BytesIO(b'content')
+        self.assertTrue(self.store.upload_fileobj_if_missing(
+            'outputs', 'abc', fp, 7))
+        self.assertEqual(self.client.upload_fileobj.call_count, 1)
+        self.assertEqual(skipped.value, before)
+
+        # Known from the upload, not checked again
+        self.assertFalse(self.store.upload_fileobj_if_missing(
+            'outputs', 'abc', fp, 7))
+        self.assertEqual(self.client.head_object.call_count, 1)
+        self.assertEqual(self.client.upload_fileobj.call_count, 1)
+        self.assertEqual(skipped.value, before + 7)
+
+        # Stored by someone else
+        self.client.head_object.side_effect = None
+        self.assertFalse(self.store.upload_fileobj_if_missing(
+            'inputs', 'def', fp, 100))
+        self.assertEqual(self.client.upload_fileobj.call_count, 1)
+        self.assertEqual(skipped.value, before + 107)
+
+    def test_exists(self):
+        # exists() always asks, an object can be deleted by someone else
+        self.store.upload_fileobj('inputs', 'abc', io.BytesIO(b'content'))
+        self.client.head_object.side_effect = ClientError(
+            {'Error': {'Code': '404'}}, 'HeadObject')
+        self.assertFalse(self.store.exists('inputs', 'abc'))
+
+        # Deleting it makes us forget it
+        self.assertTrue(self.store.skip_upload('inputs', 'abc', 7))
+        self.store.delete('inputs', 'abc')
+        self.assertFalse(self.store.skip_upload('inputs', 'abc', 7))
+
+    def test_lru(self):
+        self.client.head_object.side_effect = ClientError(
+            {'Error': {'Code': '404'}}, 'HeadObject')
+        with mock.patch.object(objectstore, 'KNOWN_OBJECTS_MAX', 2):
+            for name in ('a', 'b', 'c'):
+                self.store.upload_fileobj('outputs', name, io.BytesIO())
+                # 'a' is used again, so 'b' goes first
+                self.store.skip_upload('outputs', 'a', 0)
+        self.assertTrue(self.store.skip_upload('outputs', 'a', 0))
+        self.assertFalse(self.store.skip_upload('outputs', 'b', 0))
+        self.assertTrue(self.store.skip_upload('outputs', 'c', 0))
+
+
+class TestShortIDs(SimpleTestCase):
+    def test_batch(self):
+        short_ids = get_short_ids('salt')
+        self.assertIs(short_ids, get_short_ids('salt'))
+        nbs = list(range(0, 5000, 7)) + [2 ** 40]
+        encoded = short_ids.encode_many('upload', nbs)
+        self.assertEqual(encoded,
+                         [short_ids.encode('upload', nb) for nb in nbs])
+        self.assertEqual(short_ids.decode_many('upload', encoded), nbs)
+        self.assertNotEqual(encoded, short_ids.encode_many('run', nbs))
+        with self.assertRaises(ValueError):
+            short_ids.decode('upload', 'ab!de')
+
+    def test_upload(self):
+        upload = Upload(id=42)
+        self.assertEqual(
+            models.short_ids().decode('upload', upload.short_id), 42)
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.sent = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.sent.append((routing_key, body))
+        return True
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_ack(self, delivery_tag):
+        self.sent.append(('ack', delivery_tag))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.sent.append(('nack', delivery_tag, requeue))
+
+
+class TestWorkerPool(SimpleTestCase):
+    def test_errors(self):
+        def handle(channel, method, properties, body):
+            if body == b'late':
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            if body != b'good':
+                raise ValueError("Processing failed")
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+        channel = FakeChannel()
+        messages = [(1, False, b'good'), (2, False, b'bad'),
+                    (3, True, b'bad'), (4, False, b'late')]
+
+        def consume(tasks, callback, should_stop):
+            for tag, redelivered, body in messages:
+                method = mock.Mock(delivery_tag=tag, redelivered=redelivered)
+                callback(channel, method, None, body)
+            pool.stop()
+
+        pool = WorkerPool(1, consume, lambda: handle)
+        with mock.patch.object(workers, 'TaskQueues'):
+            pool._worker()
+        self.assertEqual(channel.sent, [('ack', 1), ('nack', 2, True),
+                                        ('nack', 3, False), ('ack', 4)])
+
+
+class TestPublisher(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Publisher, '_start_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_outbox(self):
+        publisher = Publisher()
+
+        # Saved with the transaction, sent after the commit
+        with mock.patch.object(transaction, 'on_commit') as on_commit:
+            publisher.publish_build_task('abc')
+            publisher.publish_run_task('12')
+        on_commit.assert_called_with(publisher._wake.set)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+        # Broker is down: kept
+        with mock.patch('web.publisher.connect', side_effect=OSError):
+            with self.assertRaises(OSError):
+                publisher.drain()
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+        # Broker is back
+        channel = FakeChannel()
+        publisher._broker_down.set()
+        with mock.patch('web.publisher.connect',
+                        return_value=(mock.Mock(), channel)):
+            publisher.drain()
+            publisher.publish_fetch_task('7')
+            publisher.drain()
+        self.assertEqual(channel.sent, [('build_queue', 'abc'),
+                                        ('run_queue', '12'),
+                                        ('fetch_queue', '7')])
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertFalse(publisher._broker_down.is_set())
@@ -0,0 +1,96 @@
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from hashlib import sha256
+import logging
+import uuid
+
+
+# S3 requires parts of at least 5 MB, except for the last one
+PART_SIZE = 8 * 1024 * 1024
+
+
+class ObjectStoreUploadedFile(UploadedFile):
+    """A file that was streamed to the object store during the upload.
+
+    The content is at `temp_key` in `bucket`; the caller has to move it to
+    its final name or delete it.
+    """
+    def __init__(self, name, content_type, size, charset, sha256, bucket,
+                 temp_key):
+        super(ObjectStoreUploadedFile, self).__init__(
+            None, name, content_type, size, charset)
+        self.sha256 = sha256
+        self.bucket = bucket
+        self.temp_key = temp_key
+
+
+class ObjectStoreUploadHandler(FileUploadHandler):
+    """Upload handler hashing the files while streaming them to S3.
+
+    Each uploaded file is sent as a multipart upload to a temporary key in
+    the bucket, one part at a time, so memory use is bounded by `PART_SIZE`
+    no matter the size of the file, and nothing is written to local disk.
+
+    If the request fails before the view took over the files, `abort()` has
+    to be called to remove what was already sent; Django doesn't call
+    `upload_interrupted()` when the body can't be parsed.
+    """
+    def __init__(self, request, object_store, bucket):
+        super(ObjectStoreUploadHandler, self).__init__(request)
+        self.object_store = object_store
+        self.bucket = bucket
+        self.upload_id = None
+        self.temp_keys = []
+
+    def new_file(self, *args, **kwargs):
+        super(ObjectStoreUploadHandler, self).new_file(*args, **kwargs)
+        self.temp_key = 'tmp/%s' % uuid.uuid4()
+        self.hasher = sha256()
+        self.buffer = []
+        self.buffered = 0
+        self.etags = []
+        self.upload_id = self.object_store.create_multipart_upload(
+            self.bucket, self.temp_key)
+
+    def _upload_part(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.etags.append(self.object_store.upload_part(
+            self.bucket, self.temp_key, self.upload_id,
+            len(self.etags) + 1, data))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        self.buffer.append(raw_data)
+        self.buffered += len(raw_data)
+        if self.buffered >= PART_SIZE:
+            self._upload_part()
+        return None
+
+    def file_complete(self, file_size):
+        if self.buffered or not self.etags:
+            self._upload_part()
+        self.object_store.complete_multipart_upload(
+            self.bucket, self.temp_key, self.upload_id, self.etags)
+        self.upload_id = None
+        self.temp_keys.append(self.temp_key)
+        logging.info("Streamed upload to %s/%s, %d bytes",
+                     self.bucket, self.temp_key, file_size)
+        return ObjectStoreUploadedFile(
+            self.file_name, self.content_type, file_size, self.charset,
+            self.hasher.hexdigest(), self.bucket, self.temp_key)
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def abort(self):
+        """Abort the upload in progress and delete the files already sent.
+        """
+        if self.upload_id is not None:
+            self.object_store.abort_multipart_upload(
+                self.bucket, self.temp_key, self.upload_id)
+            self.upload_id = None
+        for temp_key in self.temp_keys:
+            self.object_store.delete(self.bucket, temp_key)
+        self.temp_keys = []
@@ -21,7 +21,12 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('about', views.about, name='about'),
     path('unpack', views.unpack, name = 'unpack' ),
+    path('upload/start', views.upload_start, name = 'upload_start'),
+    path('upload/complete', views.upload_complete, name = 'upload_complete'),
+    path('upload/status/<upload_short_id>', views.upload_status, name = 'upload_status'),
     path('reproduce/<provider>/<provider_path>', views.reproduce_provider, name = 'reproduce_provider'),
     path('start_run/<upload_short_id>', views.start_run, name = 'start_run'),
     path('reproduce_local/<upload_short_id>', views.reproduce_local, name = 'reproduce_local'),
+    path('events/build/<upload_short_id>', views.build_events, name = 'build_events'),
+    path('events/run/<run_short_id>', views.run_events, name = 'run_events'),
 ]
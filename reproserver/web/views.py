@@ -1,23 +1,34 @@
 from django.shortcuts import render, redirect
-from django.http import HttpRequest, JsonResponse
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, \
+    JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
 from django.urls import reverse
-from web.providers import ProviderError, get_experiment_from_provider
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from web import lastaccess, providers
+from web.providers import ProviderError, check_provider
 from web.models import *
-from common import TaskQueues, get_object_store
+from web.notify import get_listener
+from web.publisher import get_publisher
+from web.uploadhandlers import PART_SIZE, ObjectStoreUploadHandler
+from common import get_object_store
+from common import metrics
+from botocore.exceptions import ClientError
 import functools
 from hashlib import sha256
+import json
 import logging
 import mimetypes
 import os
-from common.shortid import MultiShortIDs
+import time
+import uuid
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.utils import secure_filename
 
 
-#short_ids = MultiShortIDs(os.environ['SHORTIDS_SALT'])
-
-
 # Middleware allowing this to be run behind a reverse proxy
 if 'WEB_BEHIND_PROXY' in os.environ:
     # Use ProxyFix to fix the remote address, HTTP host and HTTP scheme
@@ -52,12 +63,14 @@ if 'WEB_BEHIND_PROXY' in os.environ:
 #    Base.metadata.create_all(bind=engine)
 
 
-# AMQP
-tasks = TaskQueues()
+# How long to keep rendered pages in the cache
+PAGE_CACHE_TTL = 24 * 3600
 
 
 # Object storage
-#object_store = get_object_store()
+object_store = get_object_store()
+# Same, but with the URL the browsers use, for presigned URLs
+client_object_store = get_object_store(os.environ.get('S3_CLIENT_URL'))
 
 #object_store.create_buckets()
 
@@ -89,43 +102,54 @@ def get_client_ip(request):
         ip = request.META.get('REMOTE_ADDR')
     return ip
 
+@csrf_exempt
 def unpack(request):
     """Target of the landing page.
         
         An experiment has been provided, store it and start the build process.
         """
+    # Stream the file to S3 while it's being received, instead of having
+    # Django write it to disk then reading it twice. The handlers have to be
+    # set before the CSRF check reads the POST data
+    handler = ObjectStoreUploadHandler(request, object_store, 'experiments')
+    request.upload_handlers = [handler]
+    try:
+        response = _unpack(request)
+    except Exception:
+        # Parsing the body failed, or the view did; don't leave the
+        # multipart upload or the temporary object behind
+        handler.abort()
+        raise
+    if response.status_code >= 400:
+        # Rejected (e.g. by the CSRF check) after the file was received
+        handler.abort()
+    return response
+
+
+@csrf_protect
+def _unpack(request):
     # Get uploaded file
     uploaded_file = request.FILES['rpz_file']
     assert uploaded_file.name
     # app.logger.info("Incoming file: %r", uploaded_file.filename)
     filename = secure_filename(uploaded_file.name)
-    
-    # Hash it
-    hasher = sha256()
-    chunk = uploaded_file.read(4096)
-    while chunk:
-        hasher.update(chunk)
-        chunk = uploaded_file.read(4096)
-    filehash = hasher.hexdigest()
+
+    # It was hashed while streaming
+    filehash = uploaded_file.sha256
     # app.logger.info("Computed hash: %s", filehash)
 
-    # Rewind it
-    uploaded_file.seek(0, 0)
-    
-    # Check for existence of experiment
-    experiment = Experiment(hash = filehash)
-    if experiment:
-        experiment.last_access = timezone.now()
-        # app.logger.info("File exists in storage")
+    # Move it to its final name, unless we already have it
+    if object_store.exists('experiments', filehash):
+        object_store.delete('experiments', uploaded_file.temp_key)
+        logging.info("File exists in storage")
     else:
-        # Insert it on S3
-        # object_store.upload_fileobj('experiments', filehash, uploaded_file)
-        # app.logger.info("Inserted file in storage")
-        
-        # Insert it in database
-        experiment = Experiment(hash=filehash)
+        object_store.rename('experiments', uploaded_file.temp_key, filehash)
+        logging.info("Inserted file in storage")
 
-    experiment.save()
+    # Check for existence of experiment, insert it in database
+    experiment, created = Experiment.objects.get_or_create(hash=filehash)
+    if not created:
+        lastaccess.touch(filehash)
 
     # Insert Upload in database
     upload = Upload(experiment_hash=experiment,filename=filename,submitted_ip=get_client_ip(request))
@@ -137,56 +161,216 @@ def unpack(request):
     # Redirect to build page
     return redirect(reverse('reproduce_local', kwargs={'upload_short_id': upload_short_id}), 302)
 
+@require_POST
+def upload_start(request):
+    """Start a direct upload from the browser to the object store.
+
+    Returns presigned URLs for each part of a multipart upload, that the
+    browser PUTs the file to, so the file doesn't go through the web server.
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        bucket = data['bucket']
+        size = int(data['size'])
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Invalid request"}, status=400)
+    if bucket not in ('experiments', 'inputs') or size < 0:
+        return JsonResponse({'error': "Invalid request"}, status=400)
+
+    # S3 allows at most 10000 parts
+    part_size = max(PART_SIZE, -(-size // 10000))
+    nb_parts = max(1, -(-size // part_size))
+
+    key = 'tmp/%s' % uuid.uuid4()
+    upload_id = object_store.create_multipart_upload(bucket, key)
+    logging.info("Started direct upload to %s/%s, %d bytes", bucket, key,
+                 size)
+    return JsonResponse({
+        'key': key,
+        'upload_id': upload_id,
+        'part_size': part_size,
+        'urls': [client_object_store.presigned_upload_part_url(
+                     bucket, key, upload_id, i + 1)
+                 for i in range(nb_parts)],
+    })
+
+
+@require_POST
+def upload_complete(request):
+    """Finish a direct upload from the browser.
+
+    The object can't be stored under its hash before it has been read back,
+    since we can't trust a hash from the browser when objects are shared by
+    content; the fetcher does that in the background, so the file doesn't go
+    through the web worker after all. This returns the URL of the status of
+    the upload, which has the URL of the experiment's page (or the ID of the
+    `InputFile` to reference when starting the run) once it is checked.
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        bucket = data['bucket']
+        key = data['key']
+        upload_id = data['upload_id']
+        etags = list(data['etags'])
+        size = int(data['size'])
+        expected_hash = data.get('sha256')
+        filename = data.get('filename')
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Invalid request"}, status=400)
+    if bucket not in ('experiments', 'inputs') or \
+            not key.startswith('tmp/'):
+        return JsonResponse({'error': "Invalid request"}, status=400)
+
+    try:
+        object_store.complete_multipart_upload(bucket, key, upload_id, etags)
+    except ClientError as e:
+        # Unknown upload, missing parts, wrong ETags
+        logging.info("Couldn't complete direct upload to %s/%s: %s",
+                     bucket, key, e)
+        return JsonResponse({'error': "Invalid upload"}, status=400)
+
+    if not filename:
+        filename = 'experiment.rpz' if bucket == 'experiments' else 'input'
+    with transaction.atomic():
+        direct_upload = DirectUpload.objects.create(
+            bucket=bucket, key=key, size=size, sha256=expected_hash,
+            filename=secure_filename(filename),
+            submitted_ip=get_client_ip(request))
+        logging.info("Queuing check of direct upload %s/%s", bucket, key)
+        get_publisher().publish_fetch_task('upload/%d' % direct_upload.id)
+
+    return JsonResponse({'status_url': reverse('upload_status', kwargs={
+                             'upload_short_id': direct_upload.short_id})},
+                        status=202)
+
+
+def upload_status(request, upload_short_id):
+    """Status of a direct upload, polled by the browser until it's checked.
+    """
+    try:
+        direct_upload_id = short_ids().decode('direct_upload',
+                                              upload_short_id)
+    except ValueError:
+        direct_upload_id = None
+    direct_upload = (DirectUpload.objects.filter(id=direct_upload_id)
+                     .first())
+    if direct_upload is None:
+        return JsonResponse({'error': "No such upload"}, status=404)
+
+    if direct_upload.status in (DirectUpload.PENDING,
+                                DirectUpload.CHECKING):
+        with transaction.atomic():
+            if _requeue_stale(DirectUpload, direct_upload,
+                              DirectUpload.PENDING):
+                logging.warning("Check of direct upload %d is stale, "
+                                "queuing it again", direct_upload.id)
+                get_publisher().publish_fetch_task(
+                    'upload/%d' % direct_upload.id)
+
+    result = {'status': direct_upload.status}
+    if direct_upload.status == DirectUpload.ERROR:
+        result['error'] = direct_upload.error
+    elif direct_upload.status == DirectUpload.DONE:
+        if direct_upload.upload_id is not None:
+            result['url'] = reverse('reproduce_local', kwargs={
+                'upload_short_id': short_ids().encode(
+                    'upload', direct_upload.upload_id)})
+        if direct_upload.input_file_id is not None:
+            result['input_file'] = direct_upload.input_file_id
+    return JsonResponse(result)
+
+
 def reproduce_local(request, upload_short_id):
     """Show build log and ask for run parameters.
     """
     # Decode info from URL
     # app.logger.info("Decoding %r", upload_short_id)
     try:
-        short_ids = MultiShortIDs(os.environ['SHORTIDS_SALT'])
-        upload_id = short_ids.decode('upload', upload_short_id)
+        upload_id = short_ids().decode('upload', upload_short_id)
     except ValueError:
         return render(request, 'setup_notfound.html')
 
-    print(upload_id)
     # Look up the experiment in database
-    upload = Upload.objects.filter(id=upload_id)
+    upload = (Upload.objects.select_related('experiment_hash')
+              .filter(id=upload_id).first())
     if not upload:
         return render(request, 'setup_notfound.html')
 
     # Also updates last access
-    experiment = Experiment(hash = upload.experiment_hash)
-    if experiment:
-        experiment.last_access = timezone.now()
-        experiment.save()
+    lastaccess.touch(upload.experiment_hash_id)
 
     return reproduce_common(upload, request)
 
 def reproduce_provider(request, provider, provider_path):
     """Reproduce an experiment from a data repository (provider).
-        """
+
+    If we don't have it yet, the download is queued for the fetcher, and the
+    progress is shown until it's done.
+    """
     # Check the database for an experiment already stored matching the URI
     provider_key = '%s/%s' % (provider, provider_path)
                 
     # Get the first row returned
-    query = Upload.objects.filter(provider_key=provider_key).order_by('id')
+    query = (Upload.objects.select_related('experiment_hash')
+             .filter(provider_key=provider_key).order_by('id'))
     upload = query.first()
-    print(upload)
-    
-    
+
     if not upload:
         try:
-            upload = get_experiment_from_provider(request, get_client_ip(request), provider, provider_path)
+            check_provider(provider)
         except ProviderError as e:
-            return render('setup_notfound.html',message=e.message), 404
+            return render(request, 'setup_notfound.html',
+                          {'message': str(e)}, status=404)
+
+        with transaction.atomic():
+            imp, created = ProviderImport.objects.get_or_create(
+                provider_key=provider_key,
+                defaults=dict(submitted_ip=get_client_ip(request)))
+            if created:
+                logging.info("Queuing import of %s", provider_key)
+                get_publisher().publish_fetch_task(str(imp.id))
+        if imp.status == ProviderImport.ERROR:
+            # Show the error; once it's old enough, the next visit will try
+            # again
+            age = timezone.now() - imp.timestamp
+            if age.total_seconds() > providers.ERROR_TTL:
+                imp.delete()
+            return render(request, 'setup_notfound.html',
+                          {'message': imp.error}, status=404)
+        elif imp.status == ProviderImport.DONE and imp.upload is not None:
+            upload = imp.upload
+        elif not created:
+            with transaction.atomic():
+                if _requeue_stale(ProviderImport, imp,
+                                  ProviderImport.QUEUED):
+                    logging.warning("Import of %s is stale, queuing it "
+                                    "again", provider_key)
+                    get_publisher().publish_fetch_task(str(imp.id))
+
+        if not upload:
+            return render(request, 'importing.html',
+                          {'provider_key': provider_key,
+                           'provider_import': imp})
 
     # Also updates last access
-    exp = Experiment(hash = upload.experiment_hash)
-    exp.last_access = timezone.now()
-    exp.save()
+    lastaccess.touch(upload.experiment_hash_id)
 
     return reproduce_common(upload, request)
 
+def _requeue_stale(model, obj, pending):
+    """Reset an import or upload check that stopped making progress.
+
+    Returns True if it should be queued again.
+    """
+    age = timezone.now() - obj.timestamp
+    if age.total_seconds() <= providers.STALE_TIMEOUT:
+        return False
+    # Only one request resets it
+    return model.objects.filter(
+        id=obj.id, status=obj.status, timestamp=obj.timestamp,
+    ).update(status=pending, timestamp=timezone.now()) > 0
+
+
 def url_for_upload(upload):
     if upload.provider_key is not None:
         provider, path = upload.provider_key.split('/', 1)
@@ -196,80 +380,241 @@ def url_for_upload(upload):
         return reverse('reproduce_local', kwargs={'upload_short_id':upload.short_id})
 
 def reproduce_common(upload, request):
-    experiment = Experiment.objects.filter(hash = upload.experiment_hash)[0]
+    experiment = upload.experiment_hash
     filename = upload.filename
     experiment_url = url_for_upload(upload)
 
     # JSON endpoint, returns data for JavaScript to update the page
     if (request.META.get('CONTENT_TYPE') == 'application/json'):
-        log_from = int(request.args.get('log_from', '0'), 10)
-        return JsonResponse({'status': experiment.status.name,'log': experiment.get_log(log_from),
-                        'params': [
-                                    {'name': p.name, 'optional': p.optional,
-                                    'default': p.default}
-                                    for p in experiment.parameters]})
+        return _log_page_response(request, experiment,
+                                  {'status': STATUS_NAMES.get(experiment.status),
+                                   'params': [
+                                       {'name': p.name, 'optional': p.optional,
+                                        'default': p.default}
+                                       for p in experiment.parameters.order_by('id')]})
     # HTML view, return the page
     else:
         # If it's done building, send build log and run form
-        if experiment.status == '4':
-            # app.logger.info("Experiment already built")
-            input_files = (Path.objects
-                        .filter(experiment_hash = experiment.hash)
-                        .filter(is_input = True)).all()
+        if experiment.status in ('4', '0'):
+            # That page only changes if the experiment gets rebuilt
+            return _cached_page(
+                request,
+                'setup:%d:%s' % (upload.id, experiment.status),
+                'build:%s' % experiment.hash,
+                lambda: _render_built(request, upload, experiment,
+                                      experiment_url))
+
+        # If it's currently building, show the log
+        if experiment.status == '3':
+            # app.logger.info("Experiment is currently building")
 
             respParams = dict()
             respParams['filename'] = filename
-            respParams['built'] = True
-            respParams['error'] = False
+            respParams['built'] = False
             respParams['log'] = experiment.get_log(0)
-            respParams['params'] = experiment.parameters
-            respParams['input_files'] = input_files
             respParams['upload_short_id'] = upload.short_id
             respParams['experiment_url'] = experiment_url
 
             return render(request, 'setup.html', respParams)
 
-        if experiment.status == '0':
-            # app.logger.info("Experiment is errored")
+        # Else, trigger the build
+        else:
+            if experiment.status == '1':
+                # Only one request gets to queue it
+                with transaction.atomic():
+                    queued = (Experiment.objects
+                              .filter(hash=experiment.hash, status='1')
+                              .update(status='2'))
+                    if queued:
+                        logging.info("Triggering a build, sending message")
+                        get_publisher().publish_build_task(experiment.hash)
 
             respParams = dict()
             respParams['filename'] = filename
-            respParams['built'] = True
-            respParams['error'] = False
-            respParams['log'] = experiment.get_log(0)
+            respParams['built'] = False
             respParams['upload_short_id'] = upload.short_id
             respParams['experiment_url'] = experiment_url
 
             return render(request, 'setup.html', respParams)
 
-        # If it's currently building, show the log
-        elif experiment.status == '3':
-            # app.logger.info("Experiment is currently building")
 
-            respParams = dict()
-            respParams['filename'] = filename
-            respParams['built'] = True
-            respParams['log'] = experiment.get_log(0)
-            respParams['upload_short_id'] = upload.short_id
-            respParams['experiment_url'] = experiment_url
+def _render_built(request, upload, experiment, experiment_url):
+    respParams = dict()
+    respParams['filename'] = upload.filename
+    respParams['built'] = True
+    respParams['log'] = experiment.get_log(0)
+    respParams['upload_short_id'] = upload.short_id
+    respParams['experiment_url'] = experiment_url
 
-            return render(request, 'setup.html', respParams)
+    if experiment.status == '0':
+        # app.logger.info("Experiment is errored")
+        respParams['error'] = True
+    else:
+        # app.logger.info("Experiment already built")
+        respParams['error'] = False
+        respParams['params'] = list(experiment.parameters.order_by('id'))
+        respParams['input_files'] = list(
+            experiment.paths.filter(is_input=True).order_by('id'))
 
-        # Else, trigger the build
-        else:
-            if experiment.status == '1':
-                # app.logger.info("Triggering a build, sending message")
-                experiment.status = '2'
-                # Need to have someone initialize the TasQueues to initaite the RabbitMQ Channel
-                # tasks.publish_build_task(experiment.hash)
+    return render(request, 'setup.html', respParams)
+
+
+def _cached_page(request, name, notify_key, render_page):
+    """Serve a page from the cache, rendering it on a miss.
+
+    The cache key includes the version of `notify_key` in the notification
+    listener; the builder and runner send a notification on every status
+    change, after which the page is rendered again. Responses have an ETag
+    and Last-Modified date, so browsers can revalidate their copy.
+    """
+    token = get_listener().cache_token(notify_key)
+    if token is None:
+        # Not listening yet, we wouldn't know when to invalidate
+        return render_page()
+    key = 'page:%s:%s' % (name, token)
+
+    cached = cache.get(key)
+    if cached is None:
+        metrics.counter('page_cache_misses').inc()
+        response = render_page()
+        if response.status_code != 200:
+            return response
+        cached = response.content, int(time.time())
+        cache.set(key, cached, PAGE_CACHE_TTL)
+    else:
+        metrics.counter('page_cache_hits').inc()
+    content, modified = cached
+
+    etag = '"%s"' % sha256(key.encode('utf-8')).hexdigest()[:32]
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    if if_none_match is not None:
+        not_modified = etag in parse_etags(if_none_match)
+    else:
+        not_modified = (if_modified_since is not None and
+                        modified <= if_modified_since)
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    # Have the browsers revalidate, the page changes on rebuild
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _log_page_response(request, owner, data):
+    """Return a page of log as JSON, along with `data`.
+
+    The page starts at line `cursor` (or `log_from`) and the response has the
+    cursor of the next page. The lines are streamed as they are read from
+    the log segments.
+    """
+    cursor = request.GET.get('cursor') or request.GET.get('log_from', '0')
+    try:
+        cursor = max(0, int(cursor, 10))
+        limit = min(LOG_PAGE_SIZE,
+                    int(request.GET.get('limit', '%d' % LOG_PAGE_SIZE), 10))
+    except ValueError:
+        return JsonResponse({'error': "Invalid cursor"}, status=400)
+    lines, next_cursor = owner.get_log_page(cursor, max(1, limit))
+    data = dict(data, next_cursor=next_cursor)
+
+    def generate():
+        yield json.dumps(data)[:-1] + ', "log": ['
+        sep = ''
+        for line in lines:
+            yield sep + json.dumps(line)
+            sep = ', '
+        yield ']}'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+
+def _event_stream(key, get_update, log_from):
+    """Generate Server-Sent Events for a build or a run.
+
+    `get_update(log_from)` returns a page of new log lines, the cursor of the
+    next page, and whether the build or run is over. Once there are no new
+    lines, it only gets called again when the builder or runner sends a
+    notification for `key`, not on a timer.
+    """
+    listener = get_listener()
+    while True:
+        version = listener.version(key)
+        lines, next_cursor, done = get_update(log_from)
+        if next_cursor > log_from:
+            log_from = next_cursor
+            yield 'id: %d\nevent: log\ndata: %s\n\n' % (log_from,
+                                                         json.dumps(lines))
+            # There might be more pages already
+            continue
+        if done:
+            yield 'event: done\ndata: {}\n\n'
+            return
+        # Don't hold on to a database connection while waiting
+        connection.close()
+        if listener.wait(key, version, 15) == version:
+            yield ': keepalive\n\n'
+
+
+def _event_response(request, key, get_update):
+    log_from = request.META.get('HTTP_LAST_EVENT_ID') or \
+        request.GET.get('log_from', '0')
+    try:
+        log_from = int(log_from, 10)
+    except ValueError:
+        log_from = 0
+    response = StreamingHttpResponse(
+        _event_stream(key, get_update, log_from),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def build_events(request, upload_short_id):
+    """Stream the build log and status of an upload's experiment.
+    """
+    try:
+        upload_id = short_ids().decode('upload', upload_short_id)
+    except ValueError:
+        return render(request, 'setup_notfound.html', status=404)
+    upload = Upload.objects.filter(id=upload_id).first()
+    if not upload:
+        return render(request, 'setup_notfound.html', status=404)
+    experiment_hash = upload.experiment_hash_id
+
+    def get_update(log_from):
+        experiment = Experiment.objects.get(hash=experiment_hash)
+        # Get the status first, so no line is missed when it's done
+        done = experiment.status in ('4', '0')
+        lines, next_cursor = experiment.get_log_page(log_from)
+        return list(lines), next_cursor, done
+
+    return _event_response(request, 'build:%s' % experiment_hash,
+                           get_update)
+
+
+def run_events(request, run_short_id):
+    """Stream the log and status of a run.
+    """
+    try:
+        run_id = short_ids().decode('run', run_short_id)
+    except ValueError:
+        return render(request, 'results_notfound.html', status=404)
+    if not Run.objects.filter(id=run_id).exists():
+        return render(request, 'results_notfound.html', status=404)
 
-                respParams = dict()
-                respParams['filename'] = filename
-                respParams['built'] = True
-                respParams['upload_short_id'] = upload.id
-                respParams['experiment_url'] = experiment_url
+    def get_update(log_from):
+        run = Run.objects.get(id=run_id)
+        done = run.done is not None
+        lines, next_cursor = run.get_log_page(log_from)
+        return list(lines), next_cursor, done
 
-                return render(request, 'setup.html', respParams)
+    return _event_response(request, 'run:%d' % run_id, get_update)
 
 
 def start_run(upload_short_id, request):
@@ -279,7 +624,7 @@ def start_run(upload_short_id, request):
     # Decode info from URL
     # app.logger.info("Decoding %r", upload_short_id)
     try:
-        upload_id = short_ids.decode('upload', upload_short_id)
+        upload_id = short_ids().decode('upload', upload_short_id)
     except ValueError:
         return render_template('setup_notfound.html'), 404
 
@@ -350,9 +695,10 @@ def start_run(upload_short_id, request):
             filesize = uploaded_file.tell()
             uploaded_file.seek(0, 0)
 
-            # Insert it on S3
-            object_store.upload_fileobj('inputs', inputfilehash, uploaded_file)
-            app.logger.info("Inserted file in storage")
+            # Insert it on S3, unless we already have it
+            if object_store.upload_fileobj_if_missing('inputs', inputfilehash,
+                                                      uploaded_file, filesize):
+                app.logger.info("Inserted file in storage")
 
             # Insert it in database
             input_file = database.InputFile(hash=inputfilehash, name=name,
@@ -361,7 +707,7 @@ def start_run(upload_short_id, request):
 
         # Trigger run
         session.commit()
-        tasks.publish_run_task(str(run.id))
+        get_publisher().publish_run_task(str(run.id))
 
         # Redirect to results page
         return redirect(url_for('results', run_short_id=run.short_id), 302)